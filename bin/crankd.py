@@ -14,47 +14,173 @@ function:     the name of a python function
 class:        the name of a python class which will be instantiated once
               and have methods called as events occur.
 method:       (class, method) tuple
+
+Events may also set these optional properties:
+
+debounce:     seconds to wait for further events before calling the handler
+              once for all of them
+max_latency:  the longest, in seconds, an event may be delayed by debounce
+timeout:      seconds after which a command is killed
+
+Python handlers are imported when their event first occurs; crankd --prewarm
+imports them in the background once the run loop has started.
+
+Handlers can run outside the event loop: see PyMacAdmin.crankd.executor.
+Handler and event loop metrics are logged on SIGUSR1 and can be written to a
+file: see PyMacAdmin.crankd.metrics.
+Commands can be started from a small helper process rather than by forking
+crankd, which is slower but keeps them out of a process with PyObjC loaded:
+see PyMacAdmin.crankd.launcher.
+
+Changes to the configuration file or to handler modules are applied without
+restarting where possible: see PyMacAdmin.crankd.reload.
+
+This file connects the Cocoa, SystemConfiguration and FSEvents APIs to the
+platform-independent PyMacAdmin.crankd.core.
 """
 
+import optparse
+import os
+import os.path
 import signal
 import sys
 
+# install-crankd.sh copies PyMacAdmin into the crankd module directory, which
+# process_commandline() doesn't add to sys.path until after we've loaded:
+try:
+  from PyMacAdmin.crankd import (check, coalesce, core, logs, metrics, reload,
+                                 replay)
+except ImportError:
+  sys.path.append("/Library/Application Support/crankd")
+  from PyMacAdmin.crankd import (check, coalesce, core, logs, metrics, reload,
+                                 replay)
+
+
+def build_parser():
+  """Returns the command-line parser and crankd's support directories.
+
+  This doesn't need PyObjC, so that --check can run before it is imported.
+
+  Returns:
+    (parser, support_path, module_path)
+  """
+  parser = optparse.OptionParser(__doc__.strip())
+  if os.getuid() == 0:
+    support_path = "/Library/"
+  else:
+    support_path = os.path.expanduser("~/Library/")
+  preference_file = os.path.join(support_path, "Preferences",
+                                 "com.googlecode.pymacadmin.crankd.plist")
+  module_path = os.path.join(support_path, "Application Support/crankd")
+
+  parser.add_option(
+      "-f",
+      "--config",
+      dest="config_file",
+      help="Use an alternate config file instead of %default",
+      default=preference_file)
+  parser.add_option(
+      "-l",
+      "--list-events",
+      action="store_true",
+      default=False,
+      help="List the events which can be monitored")
+  parser.add_option(
+      "--check",
+      action="store_true",
+      default=False,
+      help="Validate the config file and estimate its dispatch cost, then exit")
+  parser.add_option(
+      "--record",
+      metavar="FILE",
+      help="Append every event to FILE for PyMacAdmin.crankd.replay")
+  parser.add_option(
+      "--log-queue",
+      type="int",
+      default=0,
+      metavar="N",
+      help="Write log messages from a background thread, queueing at most N")
+  parser.add_option(
+      "--log-format",
+      choices=["text", "json"],
+      default="text",
+      help="Log to stderr as text (the default) or JSON lines")
+  parser.add_option(
+      "--prewarm",
+      action="store_true",
+      default=False,
+      help="Import Python handlers in the background after starting")
+  parser.add_option(
+      "-d",
+      "--debug",
+      action="count",
+      default=False,
+      help="Log detailed progress information")
+  return parser, support_path, module_path
+
+
+def run_check():
+  """Validates the config file for crankd --check and exits."""
+  parser, _, module_path = build_parser()
+  (options, args) = parser.parse_args()
+  if args:
+    parser.error("Unknown command-line arguments: %s" % args)
+  if os.path.exists(module_path):
+    sys.path.append(module_path)
+  sys.exit(check.main([options.config_file]))
+
+
+# --check validates configurations on systems without PyObjC, e.g. in CI, so
+# it runs before the Cocoa imports:
+if __name__ == "__main__" and "--check" in sys.argv[1:]:
+  run_check()
+
+# pylint: disable=C0411,C0413
 import Cocoa
 import datetime
 import FSEvents
 import functools
+import importlib.util
 import inspect
 import logging
 import logging.handlers
 import objc
-import optparse
-import os
-import os.path
-import plistlib
 from PyObjCTools import AppHelper
 import re
-import subprocess
 import SystemConfiguration
+# pylint: enable=C0411,C0413
 
 VERSION = "$Revision: #4 $"
 
-# Events which have a "class" handler use an instantiated object; we want to
-# load only one copy
-HANDLER_OBJECTS = dict()
-# Callbacks indexed by SystemConfiguration keys
-SC_HANDLERS = dict()
-# Callbacks indexed by filesystem path
-FS_WATCHED_FILES = dict()
-# handlers for workspace events
-WORKSPACE_HANDLERS = dict()
+# NotificationHandler instances, which Cocoa does not retain for us, and the
+# objects of "class" handlers, indexed by notification name
+WORKSPACE_OBSERVERS = dict()
+# The SCDynamicStore session, once SystemConfiguration events are configured
+SC_STORE = None
+# The running FSEventStream and the paths it watches
+FS_STREAM = None
+FS_STREAM_PATHS = list()
+# The CFRunLoopTimer which flushes coalesced events and its interval
+COALESCE_TIMER = None
+COALESCE_INTERVAL = None
+# The (directory, callback) of each module watched by add_conditional_restart,
+# indexed by module name
+WATCHED_MODULES = dict()
+
+# Seconds between calls of timer_callback, which measures event loop lag
+TIMER_INTERVAL = 2.0
+LOOP_LAG = metrics.LagMeter(TIMER_INTERVAL)
+# Set by the SIGUSR1 handler; timer_callback then dumps the metrics
+DUMP_METRICS_REQUESTED = False
 
 CRANKD_OPTIONS = None
 CRANKD_CONFIG = None
 
+# logs.LogWriter when crankd was started with --log-queue
+LOG_WRITER = None
 
-class BaseHandler(object):
-  # pylint: disable=C0111,R0903
-  pass
+# Older handlers subclass crankd.BaseHandler
+BaseHandler = core.BaseHandler
 
 
 class NotificationHandler(Cocoa.NSObject):
@@ -92,137 +218,12 @@ class NotificationHandler(Cocoa.NSObject):
     self.callable(user_info=user_info)  # pylint: disable=E1101
 
 
-def log_list(msg, items, level=logging.INFO):
-  """Record a a list of values with a message.
-
-  This would ordinarily be a simple logging call but we want to keep the
-  length below the 1024-byte syslog() limitation and we'll format things
-  nicely by repeating our message with as many of the values as will fit.
-
-  Individual items longer than the maximum length will be truncated.
-
-  Args:
-    msg: str, message to be logged
-    items: list, items to log
-    level: optional logger level
-  """
-  max_len = 1024 - len(msg % "")
-  cur_len = 0
-  cur_items = list()
-
-  while [i[:max_len] for i in items]:
-    i = items.pop()
-    if cur_len + len(i) + 2 > max_len:
-      logging.info(msg, ", ".join(cur_items))
-      cur_len = 0
-      cur_items = list()
-
-    cur_items.append(i)
-    cur_len += len(i) + 2
-
-  logging.log(level, msg, ", ".join(cur_items))
-
-
-def get_callable_for_event(name, event_config, context=None):
-  """Returns a callable object which can be used as a callback for any event.
-
-  The returned function has context information, logging, etc.
-  included so they do not need to be passed when the actual event
-  occurs.
-
-  NOTE: This function does not process "class" handlers - by design they
-  are passed to the system libraries which expect a delegate object with
-  various event handling methods
-
-  Args:
-    name: str
-    event_config: str, type of event
-    context: optional context
-
-  Returns:
-    A callable object for use as a callback
-  Raises:
-    AttributeError: if name is missing a required attribute
-  """
-
-  kwargs = {
-      "context": context,
-      "key": name,
-      "config": event_config,
-  }
-
-  if "command" in event_config:
-    f = functools.partial(do_shell, event_config["command"], **kwargs)
-  elif "function" in event_config:
-    f = functools.partial(
-        get_callable_from_string(event_config["function"]), **kwargs)
-  elif "method" in event_config:
-    f = functools.partial(
-        getattr(
-            get_handler_object(event_config["method"][0]),
-            event_config["method"][1]), **kwargs)
-  else:
-    raise AttributeError("%s must have a class, method, function or command" %
-                         name)
-
-  return f
-
-
-def get_mod_func(callback):
-  """Convert a fully-qualified module.function name to (module, function)."""
-  try:
-    dot = callback.rindex(".")
-  except ValueError:
-    return (callback, "")
-  return (callback[:dot], callback[dot + 1:])
-
-
-def get_callable_from_string(f_name):
-  """Takes a function name and returns a callable object."""
-  try:
-    mod_name, func_name = get_mod_func(f_name)
-    if not mod_name and not func_name:
-      raise AttributeError(
-          "%s couldn't be converted to a module or function name" % f_name)
-
-    module = __import__(mod_name)
-
-    if not func_name:
-      func_name = mod_name  # The common case is an eponymous class
-
-    return getattr(module, func_name)
-
-  except (ImportError, AttributeError) as exc:
-    raise RuntimeError("Unable to create a callable object for '%s': %s" %
-                       (f_name, exc))
-
-
-def get_handler_object(class_name):
-  """Return a single instance of class_name, instantiating it if necessary."""
-
-  if class_name not in HANDLER_OBJECTS:
-    h_obj = get_callable_from_string(class_name)()
-    if isinstance(h_obj, BaseHandler):
-      pass  # TODO(anyone): Do we even need BaseHandler any more?
-    HANDLER_OBJECTS[class_name] = h_obj
-
-  return HANDLER_OBJECTS[class_name]
-
-
 def handle_sc_event(unused_store, changed_keys, info):
-  """Fire every event handler for one or more events."""
-  try:
-    for key in changed_keys:
-      SC_HANDLERS[key](key=key, info=info)
-  except KeyError:
-    # If there's no exact match, go through the list again assuming regex
-    for key in changed_keys:
-      for handler in SC_HANDLERS:
-        if re.match(handler, key):
-          SC_HANDLERS[handler](key=key, info=info)
+  """Pass SystemConfiguration changes to the crankd core."""
+  core.dispatch_sc_event(changed_keys, info)
 
 
-def list_events(*_):
+def list_events():
   """Displays list of events which can be monitored on the current system."""
 
   print("On this system SystemConfiguration supports these events:")
@@ -252,14 +253,7 @@ def list_events(*_):
 
 def process_commandline():
   """Process command-line options, load prefs, configure module path."""
-  parser = optparse.OptionParser(__doc__.strip())
-  if os.getuid() == 0:
-    support_path = "/Library/"
-  else:
-    support_path = os.path.expanduser("~/Library/")
-  preference_file = os.path.join(support_path, "Preferences",
-                                 "com.googlecode.pymacadmin.crankd.plist")
-  module_path = os.path.join(support_path, "Application Support/crankd")
+  parser, support_path, module_path = build_parser()
 
   if os.path.exists(module_path):
     sys.path.append(module_path)
@@ -269,30 +263,19 @@ def process_commandline():
         "Python handlers will need to use absolute pathnames" % module_path,
         file=sys.stderr)
 
-  parser.add_option(
-      "-f",
-      "--config",
-      dest="config_file",
-      help="Use an alternate config file instead of %default",
-      default=preference_file)
-  parser.add_option(
-      "-l",
-      "--list-events",
-      action="callback",
-      callback=list_events,
-      help="List the events which can be monitored")
-  parser.add_option(
-      "-d",
-      "--debug",
-      action="count",
-      default=False,
-      help="Log detailed progress information")
   (options, args) = parser.parse_args()
 
   if args:
     parser.error("Unknown command-line arguments: %s" % args)
 
+  if options.list_events:
+    list_events()
+
   options.support_path = support_path
+  # The parsed configuration is cached alongside the handler modules:
+  options.config_cache = None
+  if os.path.isdir(module_path):
+    options.config_cache = os.path.join(module_path, "config.cache")
   options.config_file = os.path.realpath(options.config_file)
 
   # This is somewhat messy but we want to alter the command-line to use full
@@ -309,65 +292,21 @@ def process_commandline():
     sys.argv.append("--config")
     sys.argv.append(options.config_file)
 
-  return options
+  if options.record:
+    options.record = os.path.realpath(options.record)
+    sys.argv.append("--record")
+    sys.argv.append(options.record)
 
+  if options.prewarm:
+    sys.argv.append("--prewarm")
 
-def load_config(options):
-  """Load our configuration from plist or create if none exists."""
-  if not os.path.exists(options.config_file):
-    logging.info(
-        "%s does not exist - initializing with an example configuration",
-        CRANKD_OPTIONS.config_file)
-    print(
-        "Creating %s with default options for you to customize" %
-        options.config_file,
-        file=sys.stderr)
-    print(
-        "%s --list-events will list the events you can monitor on this system" %
-        sys.argv[0],
-        file=sys.stderr)
-    example_config = {
-        "SystemConfiguration": {
-            "State:/Network/Global/IPv4": {
-                "command": '/bin/echo "Global IPv4 config changed"'
-            }
-        },
-        "NSWorkspace": {
-            "NSWorkspaceDidMountNotification": {
-                "command": '/bin/echo "A new volume was mounted!"'
-            },
-            "NSWorkspaceDidWakeNotification": {
-                "command": '/bin/echo "The system woke from sleep!"'
-            },
-            "NSWorkspaceWillSleepNotification": {
-                "command": '/bin/echo "The system is about to go to sleep!"'
-            }
-        }
-    }
-    try:
-      with open(options.config_file, "wb") as f:
-        plistlib.dump(example_config, f)
-    except (TypeError, OSError) as e:
-      logging.error("Could not write %s: %s", options.config_file, str(e))
-      sys.exit(1)
-
-  logging.info("Loading configuration from %s", CRANKD_OPTIONS.config_file)
+  if options.log_queue:
+    sys.argv.append("--log-queue=%d" % options.log_queue)
 
-  try:
-    with open(options.config_file, "rb") as f:
-      plist = plistlib.load(f)
-  except (TypeError, OSError) as e:
-    logging.error("Could not read %s: %s", options.config_file, str(e))
-    sys.exit(1)
+  if options.log_format != "text":
+    sys.argv.append("--log-format=%s" % options.log_format)
 
-  if "imports" in plist:
-    for module in plist["imports"]:
-      try:
-        __import__(module)
-      except ImportError as exc:
-        print("Unable to import %s: %s" % (module, exc), file=sys.stderr)
-        sys.exit(1)
-  return plist
+  return options
 
 
 def configure_logging():
@@ -384,6 +323,34 @@ def configure_logging():
   logging.getLogger().addHandler(syslog)
 
 
+def configure_log_pipeline(options):
+  """Applies the --log-format and --log-queue options."""
+  global LOG_WRITER
+
+  root = logging.getLogger()
+
+  if options.log_format == "json":
+    # syslog adds its own framing so only the stderr handler uses JSON:
+    for handler in root.handlers:
+      if not isinstance(handler, logging.handlers.SysLogHandler):
+        handler.setFormatter(logs.JSONFormatter())
+
+  if options.log_queue:
+    LOG_WRITER = logs.start_queue_logging(
+        root,
+        max_records=options.log_queue,
+        on_drop=lambda: core.METRICS.increment("log_records_dropped"))
+
+
+def stop_log_pipeline():
+  """Writes any queued log messages."""
+  global LOG_WRITER
+
+  if LOG_WRITER is not None:
+    LOG_WRITER.stop()
+    LOG_WRITER = None
+
+
 def get_sc_store():
   """Returns an SCDynamicStore instance."""
   return SystemConfiguration.SCDynamicStoreCreate(None, "crankd",
@@ -392,38 +359,66 @@ def get_sc_store():
 
 def add_workspace_notifications(nsw_config):
   """Add workspace notifications."""
-  notification_center = Cocoa.NSWorkspace.sharedWorkspace().notificationCenter()
-
   for event in nsw_config:
-    event_config = nsw_config[event]
-
-    if "class" in event_config:
-      obj = get_handler_object(event_config["class"])
-      objc_method = "on%s:" % event
-      py_method = objc_method.replace(":", "_")
-      if not hasattr(obj, py_method) or not callable(getattr(obj, py_method)):
-        print(
-            "NSWorkspace Notification %s: "
-            "handler class %s must define a %s method" %
-            (event, event_config["class"], py_method),
-            file=sys.stderr)
+    if "class" in nsw_config[event]:
+      try:
+        add_workspace_class_observer(event, nsw_config[event]["class"])
+      except AttributeError as exc:
+        print(exc, file=sys.stderr)
         sys.exit(1)
 
-      notification_center.addObserver_selector_name_object_(
-          obj, objc_method, event, None)
-    else:
-      handler = NotificationHandler.new()
-      handler.name = "NSWorkspace Notification %s" % event
-      handler.callable = get_callable_for_event(
-          event, event_config, context=handler.name)
+  for event in core.add_workspace_handlers(nsw_config):
+    add_workspace_observer(event)
+  core.log_list("Listening for these NSWorkspace notifications: %s",
+                list(nsw_config.keys()))
+
+
+def add_workspace_class_observer(event, class_name):
+  """Registers the object for a "class" handler as an observer of event.
+
+  Raises:
+    AttributeError: if the class doesn't have a method for the notification
+  """
+  obj = core.get_handler_object(class_name)
+  objc_method = "on%s:" % event
+  py_method = objc_method.replace(":", "_")
+  if not hasattr(obj, py_method) or not callable(getattr(obj, py_method)):
+    raise AttributeError("NSWorkspace Notification %s: "
+                         "handler class %s must define a %s method" %
+                         (event, class_name, py_method))
+
+  Cocoa.NSWorkspace.sharedWorkspace().notificationCenter(
+  ).addObserver_selector_name_object_(obj, objc_method, event, None)
+  WORKSPACE_OBSERVERS[event] = obj
+
+
+def add_workspace_observer(event):
+  """Registers a NotificationHandler which passes event to the core."""
+  handler = NotificationHandler.new()
+  handler.name = "NSWorkspace Notification %s" % event
+  handler.callable = functools.partial(core.dispatch_workspace_event, event)
+
+  assert callable(handler.onNotification_)
 
-      assert callable(handler.onNotification_)
+  Cocoa.NSWorkspace.sharedWorkspace().notificationCenter(
+  ).addObserver_selector_name_object_(handler, "onNotification:", event, None)
+  WORKSPACE_OBSERVERS[event] = handler
 
-      notification_center.addObserver_selector_name_object_(
-          handler, "onNotification:", event, None)
-      WORKSPACE_HANDLERS[event] = handler
-  log_list("Listening for these NSWorkspace notifications: %s",
-           list(nsw_config.keys()))
+
+def update_workspace_notifications(diff, nsw_config):
+  """Replaces the observers of notifications a reload added or changed."""
+  notification_center = Cocoa.NSWorkspace.sharedWorkspace().notificationCenter()
+
+  for event in diff.removed["NSWorkspace"] + diff.changed["NSWorkspace"]:
+    observer = WORKSPACE_OBSERVERS.pop(event, None)
+    if observer is not None:
+      notification_center.removeObserver_name_object_(observer, event, None)
+
+  for event in diff.added["NSWorkspace"] + diff.changed["NSWorkspace"]:
+    if "class" in nsw_config[event]:
+      add_workspace_class_observer(event, nsw_config[event]["class"])
+    else:
+      add_workspace_observer(event)
 
 
 def add_sc_notifications(sc_config):
@@ -445,63 +440,60 @@ def add_sc_notifications(sc_config):
     sc_config: dict
   """
 
-  keys = list(sc_config.keys())
-
   try:
-    for key in keys:
-      SC_HANDLERS[key] = get_callable_for_event(
-          key, sc_config[key], context="SystemConfiguration: %s" % key)
-  except AttributeError as exc:
+    keys = core.add_sc_handlers(sc_config)
+  except (AttributeError, re.error) as exc:
     print(
         "Error configuring SystemConfiguration events: %s" % exc,
         file=sys.stderr)
     sys.exit(1)
 
-  store = get_sc_store()
+  update_sc_notifications()
 
-  SystemConfiguration.SCDynamicStoreSetNotificationKeys(store, None, keys)
+  core.log_list("Listening for these SystemConfiguration events: %s", keys)
 
-  # Get a CFRunLoopSource and add it to the application's runloop:
-  Cocoa.CFRunLoopAddSource(
-      Cocoa.NSRunLoop.currentRunLoop().getCFRunLoop(),
-      SystemConfiguration.SCDynamicStoreCreateRunLoopSource(None, store, 0),
-      Cocoa.kCFRunLoopCommonModes)
 
-  log_list("Listening for these SystemConfiguration events: %s", keys)
+def update_sc_notifications():
+  """Sets the SCDynamicStore notification keys to those in core.SC_HANDLERS."""
+  global SC_STORE
 
+  if SC_STORE is None:
+    if not core.SC_HANDLERS:
+      return
+    SC_STORE = get_sc_store()
 
-def add_fs_notifications(fs_config):
-  for path in fs_config:
-    add_fs_notification(
-        path,
-        get_callable_for_event(
-            path, fs_config[path], context="FSEvent: %s" % path))
+    # Get a CFRunLoopSource and add it to the application's runloop:
+    Cocoa.CFRunLoopAddSource(
+        Cocoa.NSRunLoop.currentRunLoop().getCFRunLoop(),
+        SystemConfiguration.SCDynamicStoreCreateRunLoopSource(None, SC_STORE,
+                                                              0),
+        Cocoa.kCFRunLoopCommonModes)
 
+  SystemConfiguration.SCDynamicStoreSetNotificationKeys(
+      SC_STORE, None, list(core.SC_HANDLERS))
 
-def add_fs_notification(f_path, callback):
-  """Adds an FSEvent notification for the specified path."""
-  path = os.path.realpath(os.path.expanduser(f_path))
-  if not os.path.exists(path):
-    raise AttributeError(
-        "Cannot add an FSEvent notification: %s does not exist!" % path)
 
-  if not os.path.isdir(path):
-    path = os.path.dirname(path)
+def start_fs_events(since=None):
+  """Start FSEevents stream.
 
-  try:
-    FS_WATCHED_FILES[path].append(callback)
-  except KeyError:
-    FS_WATCHED_FILES[path] = [callback]
+  Args:
+    since: optional FSEventStreamEventId to start from, which defaults to the
+      checkpoint, if any, or now
+  """
+  global FS_STREAM, FS_STREAM_PATHS
 
+  if since is None:
+    since = FSEvents.kFSEventStreamEventIdSinceNow  # Only events in the future
+    if core.CHECKPOINT is not None:
+      since = core.CHECKPOINT.resume_id() or since
 
-def start_fs_events():
-  """Start FSEevents stream."""
+  FS_STREAM_PATHS = sorted(str(f) for f in core.FS_WATCHED_FILES.keys())
   stream_ref = FSEvents.FSEventStreamCreate(
       None,  # Use the default Cocoa.CFAllocator
       fsevent_callback,
       None,  # We don't need a FSEventStreamContext
-      list([str(f) for f in FS_WATCHED_FILES.keys()]),
-      FSEvents.kFSEventStreamEventIdSinceNow,  # Only events in the future
+      FS_STREAM_PATHS,
+      since,
       1.0,  # Process events within 1 second
       0  # We don't need any special flags for our stream
   )
@@ -516,118 +508,205 @@ def start_fs_events():
 
   if not FSEvents.FSEventStreamStart(stream_ref):
     raise RuntimeError("Unable to start FSEvent stream!")
+  FS_STREAM = stream_ref
+
+  logging.debug("FSEventStream started for %d paths: %s",
+                len(core.FS_WATCHED_FILES), ", ".join(core.FS_WATCHED_FILES))
+
 
-  logging.debug("FSEventStream started for %d paths: %s", len(FS_WATCHED_FILES),
-                b", ".join(FS_WATCHED_FILES))
+def update_fs_events():
+  """Replaces the FSEvents stream if the set of watched directories changed.
+
+  The new stream starts from the last event the old one delivered so nothing
+  which happens while they are swapped is missed.
+  """
+  if sorted(str(f) for f in core.FS_WATCHED_FILES.keys()) == FS_STREAM_PATHS:
+    return
+
+  since = FSEvents.FSEventStreamGetLatestEventId(FS_STREAM)
+  FSEvents.FSEventStreamStop(FS_STREAM)
+  FSEvents.FSEventStreamInvalidate(FS_STREAM)
+  FSEvents.FSEventStreamRelease(FS_STREAM)
+  start_fs_events(since=since)
 
 
 def fsevent_callback(unused_stream_ref, unused_full_path, event_count, paths,
-                     masks, unused_ids):
+                     masks, ids):
   """Process an FSEvent and call each handler for that path or parent."""
-  for i in list(range(event_count)):
-    path = os.path.dirname(paths[i])
+  core.dispatch_fsevents(paths[:event_count], masks[:event_count],
+                         ids[:event_count])
 
-    if masks[i] & FSEvents.kFSEventStreamEventFlagMustScanSubDirs:
-      recursive = True
 
-    if masks[i] & FSEvents.kFSEventStreamEventFlagUserDropped:
-      logging.error(
-          "We were too slow processing FSEvents and some events were dropped")
-      recursive = True
+def coalesce_timer_callback(*unused_args):
+  """Invokes any coalesced handlers whose events are due."""
+  core.flush_coalescers()
 
-    if masks[i] & FSEvents.kFSEventStreamEventFlagKernelDropped:
-      logging.error("The kernel was too slow processing FSEvents "
-                    "and some events were dropped!")
-      recursive = True
-    else:
-      recursive = False
 
-    for j in [k for k in FS_WATCHED_FILES if path.startswith(k)]:
-      logging.debug("FSEvent: %s: processing %d callback(s) for path %s", j,
-                    len(FS_WATCHED_FILES[j]), path)
-      for l in FS_WATCHED_FILES[j]:
-        l(j, path=path, recursive=recursive)
+def update_coalesce_timer():
+  """Creates or replaces the timer which flushes coalesced events."""
+  global COALESCE_TIMER, COALESCE_INTERVAL
+
+  interval = coalesce.poll_interval(core.COALESCERS) if core.COALESCERS else None
+  if interval == COALESCE_INTERVAL:
+    return
+
+  if COALESCE_TIMER is not None:
+    Cocoa.CFRunLoopTimerInvalidate(COALESCE_TIMER)
+    COALESCE_TIMER = None
+
+  COALESCE_INTERVAL = interval
+  if interval is not None:
+    COALESCE_TIMER = Cocoa.CFRunLoopTimerCreate(
+        None, Cocoa.CFAbsoluteTimeGetCurrent(), interval, 0, 0,
+        coalesce_timer_callback, None)
+    Cocoa.CFRunLoopAddTimer(Cocoa.NSRunLoop.currentRunLoop().getCFRunLoop(),
+                            COALESCE_TIMER, Cocoa.kCFRunLoopCommonModes)
+
+
+def prewarm_timer_callback(*unused_args):
+  """Imports any handlers which haven't been called yet."""
+  core.prewarm_handlers()
 
 
 def timer_callback(*unused_args):
   """Handles the timer events.
 
   We use this to have the runloop run regularly. Currently this logs a
-  timestamp for debugging purposes.
+  timestamp for debugging purposes, measures how late the timer fires,
+  which is how far behind the event loop is, and dumps the metrics when
+  SIGUSR1 has been received.
   """
+  global DUMP_METRICS_REQUESTED
   logging.debug("timer callback at %s", datetime.datetime.now())
+  if DUMP_METRICS_REQUESTED:
+    DUMP_METRICS_REQUESTED = False
+    dump_metrics()
+  lag = LOOP_LAG.tick()
+  if lag is not None:
+    core.METRICS.record_loop_lag(lag)
+  if core.CRANKD_EXECUTOR is not None:
+    logging.debug("handler queue depth: %d",
+                  core.CRANKD_EXECUTOR.queue_depth())
 
 
-def create_env_name(name):
-  """Converts input names into more traditional shell environment name style.
+def metrics_timer_callback(*unused_args):
+  """Writes the metrics file."""
+  core.write_metrics()
 
-  >>> create_env_name("NSApplicationBundleIdentifier")
-  'NSAPPLICATION_BUNDLE_IDENTIFIER'
-  >>> create_env_name("NSApplicationBundleIdentifier-1234$foobar!")
-  'NSAPPLICATION_BUNDLE_IDENTIFIER_1234_FOOBAR'
 
-  Args:
-    name: str, name to convert
+def request_metrics_dump(*unused_args):
+  """SIGUSR1 handler: asks timer_callback to dump the metrics.
 
-  Returns:
-    str, converted name
+  The dump takes the metrics lock, which the main thread may be holding
+  when the signal arrives, so it must not run in the signal handler.
   """
-  new_name = re.sub(r"""(?<=[a-z])([A-Z])""", "_\\1", name)
-  new_name = re.sub(r"\W+", "_", new_name)
-  new_name = re.sub(r"_{2,}", "_", new_name)
-  return new_name.upper().strip("_")
-
-
-def do_shell(command, context=None, **kwargs):
-  """Executes a shell command with logging."""
-  logging.info("%s: executing %s", context, command)
+  global DUMP_METRICS_REQUESTED
+  DUMP_METRICS_REQUESTED = True
 
-  child_env = {"CRANKD_CONTEXT": context}
 
-  # We'll pull a subset of the available information in for shell scripts.
-  # Anyone who needs more will probably want to write a Python handler
-  # instead so they can reuse things like our logger & config info and avoid
-  # ordeals like associative arrays in Bash
-  for k in ["info", "key"]:
-    if k in kwargs and kwargs[k]:
-      child_env["CRANKD_%s" % k.upper()] = str(kwargs[k])
+def dump_metrics():
+  """Logs the current metrics and writes the metrics file."""
+  for line in metrics.format_summary(core.collect_metrics()):
+    logging.info("Metrics: %s", line)
+  core.write_metrics()
 
-  if "user_info" in kwargs:
-    for k, v in kwargs["user_info"].items():
-      child_env[create_env_name(k)] = str(v)
 
-  try:
-    rc = subprocess.call(command, shell=True, env=child_env)
-    if rc == 0:
-      logging.debug("`%s` returned %d", command, rc)
-    elif rc < 0:
-      logging.error("`%s` was terminated by signal %d", command, -rc)
-    else:
-      logging.error("`%s` returned %d", command, rc)
-  except OSError as exc:
-    logging.error("Got an exception when executing %s: %s", command, exc)
+def add_conditional_restart(file_name, reason, on_change=None):
+  """Use stat to call on_change(reason) only if file mtime has changed.
 
-
-def add_conditional_restart(file_name, reason):
-  """Use stat to restart only if file mtime has changed."""
+  Returns:
+    (watched directory, callback), for core.remove_fs_notification
+  """
   file_name = os.path.realpath(file_name.encode())
   while not os.path.exists(file_name):
     file_name = os.path.dirname(file_name)
-  orig_stat = os.stat(file_name).st_mtime
+  last_mtime = os.stat(file_name).st_mtime
 
   def cond_restart(*unused_args, **unused_kwargs):
+    nonlocal last_mtime
     try:
-      if os.stat(file_name).st_mtime != orig_stat:
-        restart(reason)
+      mtime = os.stat(file_name).st_mtime
+      if mtime != last_mtime:
+        last_mtime = mtime
+        (on_change or restart)(reason)
     except (OSError, IOError, RuntimeError) as exc:
       restart("Exception while checking %s: %s" % (file_name, exc))
 
-  add_fs_notification(file_name, cond_restart)
+  return core.add_fs_notification(file_name, cond_restart), cond_restart
+
+
+def watch_modules():
+  """Reloads or restarts when any loaded or handler module's file changes."""
+  module_files = dict(
+      (i.__name__, i.__file__)
+      for i in list(sys.modules.values())
+      if i and hasattr(i, "__file__") and i.__file__ is not None)
+
+  # Handler modules aren't imported until their events occur:
+  config_modules = reload.config_modules(CRANKD_CONFIG)
+  for name in config_modules:
+    if name in module_files or name in WATCHED_MODULES:
+      continue
+    try:
+      spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+      spec = None
+    if spec is not None and spec.has_location:
+      module_files[name] = spec.origin
+
+  # Stop watching handler modules which the configuration no longer uses and
+  # which were never imported:
+  for name in list(WATCHED_MODULES):
+    if name not in module_files and name not in config_modules:
+      core.remove_fs_notification(*WATCHED_MODULES.pop(name))
+
+  for name, file_name in module_files.items():
+    if name in WATCHED_MODULES:
+      continue
+
+    if name == "__main__":
+      WATCHED_MODULES[name] = add_conditional_restart(
+          file_name, "%s was updated" % file_name, on_change=restart)
+    else:
+      WATCHED_MODULES[name] = add_conditional_restart(
+          file_name,
+          "Module %s was updated" % name,
+          on_change=functools.partial(reload_config, changed_modules=[name]))
+
+
+def reload_config(reason, changed_modules=()):
+  """Applies configuration or handler module changes without restarting.
+
+  Falls back to restart() if the changes can't be applied incrementally.
+
+  Args:
+    reason: str, logged
+    changed_modules: names of modules whose files have changed
+  """
+  global CRANKD_CONFIG
+
+  logging.info("Reloading: %s", reason)
+  try:
+    new_config = reload.read_config(CRANKD_OPTIONS.config_file)
+    diff = reload.reload_config(CRANKD_CONFIG, new_config, changed_modules)
+    CRANKD_CONFIG = new_config
+    update_workspace_notifications(diff, new_config.get("NSWorkspace", {}))
+    update_sc_notifications()
+    watch_modules()
+    update_fs_events()
+    update_coalesce_timer()
+  except reload.RestartRequired as exc:
+    restart("%s: %s" % (reason, exc))
+  except Exception as exc:  # pylint: disable=W0703
+    logging.exception("Reloading failed")
+    restart("%s: reloading failed: %s" % (reason, exc))
 
 
 def restart(reason, *unused_args, **unused_kwargs):
   """Perform a complete restart of the current process using exec()."""
   logging.info("Restarting: %s", reason)
+  core.shutdown_handlers()
+  stop_log_pipeline()
   os.execv(sys.argv[0], sys.argv)
 
 
@@ -636,7 +715,20 @@ def main():
 
   global CRANKD_OPTIONS, CRANKD_CONFIG
   CRANKD_OPTIONS = process_commandline()
-  CRANKD_CONFIG = load_config(CRANKD_OPTIONS)
+  configure_log_pipeline(CRANKD_OPTIONS)
+  CRANKD_CONFIG = core.load_config(CRANKD_OPTIONS, CRANKD_OPTIONS.config_cache)
+
+  core.configure_executor(CRANKD_CONFIG)
+  core.configure_launcher(CRANKD_CONFIG)
+  core.configure_metrics(CRANKD_CONFIG)
+
+  core.configure_checkpoint(
+      CRANKD_CONFIG,
+      os.path.join(CRANKD_OPTIONS.support_path,
+                   "Application Support/crankd/fsevents.checkpoint"))
+
+  if CRANKD_OPTIONS.record:
+    core.RECORDER = replay.EventRecorder(CRANKD_OPTIONS.record)
 
   if "NSWorkspace" in CRANKD_CONFIG:
     add_workspace_notifications(CRANKD_CONFIG["NSWorkspace"])
@@ -645,25 +737,19 @@ def main():
     add_sc_notifications(CRANKD_CONFIG["SystemConfiguration"])
 
   if "FSEvents" in CRANKD_CONFIG:
-    add_fs_notifications(CRANKD_CONFIG["FSEvents"])
+    core.add_fs_handlers(CRANKD_CONFIG["FSEvents"])
 
   # We reuse our FSEvents code to watch for changes to our files and
-  # restart if any of our libraries have been updated:
+  # reload or restart if the configuration or any of our libraries have been
+  # updated:
   add_conditional_restart(
       CRANKD_OPTIONS.config_file,
-      "Configuration file %s changed" % CRANKD_OPTIONS.config_file)
-  for m in [
-      i for i in list(sys.modules.values())
-      if i and hasattr(i, "__file__") and i.__file__ is not None
-  ]:
-    if m.__name__ == "__main__":
-      msg = "%s was updated" % m.__file__
-    else:
-      msg = "Module %s was updated" % m.__name__
-
-    add_conditional_restart(m.__file__, msg)
+      "Configuration file %s changed" % CRANKD_OPTIONS.config_file,
+      on_change=reload_config)
+  watch_modules()
 
   signal.signal(signal.SIGHUP, functools.partial(restart, "SIGHUP received"))
+  signal.signal(signal.SIGUSR1, request_metrics_dump)
 
   start_fs_events()
 
@@ -672,15 +758,34 @@ def main():
   # often enough to appear tolerably responsive:
   Cocoa.CFRunLoopAddTimer(
       Cocoa.NSRunLoop.currentRunLoop().getCFRunLoop(),
-      Cocoa.CFRunLoopTimerCreate(None, Cocoa.CFAbsoluteTimeGetCurrent(), 2.0, 0,
-                                 0, timer_callback, None),
+      Cocoa.CFRunLoopTimerCreate(None, Cocoa.CFAbsoluteTimeGetCurrent(),
+                                 TIMER_INTERVAL, 0, 0, timer_callback, None),
       Cocoa.kCFRunLoopCommonModes)
 
+  if core.METRICS_FILE is not None:
+    Cocoa.CFRunLoopAddTimer(
+        Cocoa.NSRunLoop.currentRunLoop().getCFRunLoop(),
+        Cocoa.CFRunLoopTimerCreate(None, Cocoa.CFAbsoluteTimeGetCurrent(),
+                                   core.METRICS_FILE.interval, 0, 0,
+                                   metrics_timer_callback, None),
+        Cocoa.kCFRunLoopCommonModes)
+
+  update_coalesce_timer()
+
+  if CRANKD_OPTIONS.prewarm:
+    Cocoa.CFRunLoopAddTimer(
+        Cocoa.NSRunLoop.currentRunLoop().getCFRunLoop(),
+        Cocoa.CFRunLoopTimerCreate(None, Cocoa.CFAbsoluteTimeGetCurrent(), 0,
+                                   0, 0, prewarm_timer_callback, None),
+        Cocoa.kCFRunLoopCommonModes)
+
   try:
     AppHelper.runConsoleEventLoop(installInterrupt=True)
   except KeyboardInterrupt:
     logging.info("KeyboardInterrupt received, exiting")
 
+  core.shutdown_handlers()
+  stop_log_pipeline()
   sys.exit(0)
 
 
@@ -10,15 +10,116 @@ http://developer.apple.com/documentation/Security/Reference/keychainservices/Ref
 
 import os
 import ctypes
+import struct
+import threading
 from PyMacAdmin import Security
 
+class KeychainHandleCache(object):
+    """
+    Process-wide cache of keychain handles indexed by path
+
+    Keychain(path) acquires a handle from HANDLE_CACHE and Keychain.close()
+    releases it. Released handles stay open so long-running processes, e.g.
+    crankd handlers, only call SecKeychainOpen once per keychain; purge()
+    closes the handles which are no longer in use.
+    """
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.handles = {}   # path: [SecKeychainRef, number of users]
+        self.opens   = 0
+        self.closes  = 0
+        self.hits    = 0
+
+    def acquire(self, path):
+        """Returns the handle for the keychain at path, opening it if necessary"""
+        path = os.path.realpath(path)
+        with self.lock:
+            if path in self.handles:
+                self.hits += 1
+            else:
+                self.handles[path] = [open_keychain(path), 0]
+                self.opens += 1
+            entry = self.handles[path]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, path):
+        """Releases a handle returned by acquire(); it stays open until purge()"""
+        path = os.path.realpath(path)
+        with self.lock:
+            if path not in self.handles or not self.handles[path][1]:
+                raise ValueError("Keychain %s has not been acquired" % path)
+            self.handles[path][1] -= 1
+
+    def purge(self, path=None):
+        """Closes the unused handles, or only the one for path, and returns the number closed"""
+        with self.lock:
+            if path is None:
+                paths = list(self.handles)
+            else:
+                paths = [os.path.realpath(path)]
+
+            closed = 0
+            for p in paths:
+                if p in self.handles and not self.handles[p][1]:
+                    Security.lib.CFRelease(self.handles.pop(p)[0])
+                    self.closes += 1
+                    closed += 1
+            return closed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'open':   len(self.handles),
+                'in_use': sum(1 for handle, users in self.handles.values() if users),
+                'opens':  self.opens,
+                'closes': self.closes,
+                'hits':   self.hits,
+            }
+
+HANDLE_CACHE = KeychainHandleCache()
+
+def open_keychain(path):
+    """Returns a new SecKeychainRef for path; most callers should use HANDLE_CACHE"""
+    keychain     = ctypes.c_void_p()
+    keychain_ptr = ctypes.pointer(keychain)
+
+    rc           = Security.lib.SecKeychainOpen(path.encode("utf-8"), keychain_ptr)
+    if rc != 0:
+        raise RuntimeError("Couldn't open system keychain: rc=%d" % rc)
+
+    return keychain
+
 class Keychain(object):
-    """A friendlier wrapper for the Keychain API"""
+    """
+    A friendlier wrapper for the Keychain API
+
+    Keychains opened by path share a handle from HANDLE_CACHE, which is
+    released by close() or by using the Keychain as a context manager:
+
+        with Keychain("/Library/Keychains/System.keychain") as keychain:
+            keychain.find_generic_password(account_name=ssid)
+    """
     # TODO: Add support for SecKeychainSetUserInteractionAllowed
 
+    keychain_path = None # Set while a handle is acquired from HANDLE_CACHE
+    closed        = False
+
     def __init__(self, keychain_name=None):
         self.keychain_handle = self.open_keychain(keychain_name)
 
+    @property
+    def keychain_handle(self):
+        # Using a closed keychain must not fall back to the default keychain:
+        if self.closed:
+            raise ValueError("I/O operation on a closed Keychain")
+        return self._keychain_handle
+
+    @keychain_handle.setter
+    def keychain_handle(self, handle):
+        self._keychain_handle = handle
+
     def open_keychain(self, path=None):
         """Open a keychain file - if no path is provided, the user's default keychain will be used"""
         if not path:
@@ -27,20 +128,34 @@ class Keychain(object):
         if path and not os.path.exists(path):
             raise IOError("Keychain %s does not exist" % path)
 
-        keychain     = ctypes.c_void_p()
-        keychain_ptr = ctypes.pointer(keychain)
+        handle             = HANDLE_CACHE.acquire(path)
+        self.keychain_path = path
+        return handle
 
-        rc           = Security.lib.SecKeychainOpen(path, keychain_ptr)
-        if rc != 0:
-            raise RuntimeError("Couldn't open system keychain: rc=%d" % rc)
+    def close(self):
+        """Releases this keychain's handle; the Keychain can't be used afterwards"""
+        if self.keychain_path is not None:
+            HANDLE_CACHE.release(self.keychain_path)
+            self.keychain_path = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
 
-        return keychain
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def find_generic_password(self, service_name="", account_name=""):
-        """Pythonic wrapper for SecKeychainFindGenericPassword"""
-        item_p          = ctypes.c_uint32()
+    def find_generic_password(self, service_name="", account_name="", prefetch=False):
+        """
+        Pythonic wrapper for SecKeychainFindGenericPassword
+
+        The item's label and password are copied from the keychain when they
+        are first used, so checking that an item exists or deleting it never
+        copies the password. Pass prefetch=True to copy both immediately.
+        """
+        item            = ctypes.c_void_p()
         password_length = ctypes.c_uint32(0)
-        password_data   = ctypes.c_char_p(256)
+        password_data   = ctypes.c_void_p()
 
         # For our purposes None and "" should be equivalent but we need a real
         # string for len() below:
@@ -49,15 +164,18 @@ class Keychain(object):
         if not account_name:
             account_name = ""
 
+        service = service_name.encode("utf-8")
+        account = account_name.encode("utf-8")
+
         rc = Security.lib.SecKeychainFindGenericPassword (
             self.keychain_handle,
-            len(service_name),                  # Length of service name
-            service_name,                       # Service name
-            len(account_name),                  # Account name length
-            account_name,                       # Account name
-            ctypes.byref(password_length),      # Will be filled with pw length
-            ctypes.pointer(password_data),      # Will be filled with pw data
-            ctypes.byref(item_p)
+            len(service),                       # Length of service name
+            service,                            # Service name
+            len(account),                       # Account name length
+            account,                            # Account name
+            ctypes.pointer(password_length) if prefetch else None,  # Will be filled with pw length
+            ctypes.pointer(password_data) if prefetch else None,    # Will be filled with pw data
+            ctypes.pointer(item)
         )
 
         if rc == -25300:
@@ -65,53 +183,27 @@ class Keychain(object):
         elif rc != 0:
             raise RuntimeError('Unable to retrieve generic password (service=%s, account=%s): rc=%d' % (service_name, account_name, rc))
 
-        password = password_data.value[0:password_length.value]
-
-        Security.lib.SecKeychainItemFreeContent(None, password_data)
-
-        # itemRef: A reference to the keychain item from which you wish to
-        # retrieve data or attributes.
-        #
-        # info:  A pointer to a list of tags of attributes to retrieve.
-        #
-        # itemClass: A pointer to the item’s class. You should pass NULL if not
-        # required. See “Keychain Item Class Constants” for valid constants.
-        #
-        # attrList: On input, the list of attributes in this item to get; on
-        # output the attributes are filled in. You should call the function
-        # SecKeychainItemFreeAttributesAndData when you no longer need the
-        # attributes and data.
-        #
-        # length: On return, a pointer to the actual length of the data.
-        #
-        # outData: A pointer to a buffer containing the data in this item. Pass
-        # NULL if not required. You should call the function
-        # SecKeychainItemFreeAttributesAndData when you no longer need the
-        # attributes and data.
-
-        info    = SecKeychainAttributeInfo()
-        attrs_p = SecKeychainAttributeList_p()
-
-        # Thank you Wil Shipley:
-        # http://www.wilshipley.com/blog/2006/10/pimp-my-code-part-12-frozen-in.html
-        info.count = 1
-        info.tag.contents   = Security.kSecLabelItemAttr
-
-        Security.lib.SecKeychainItemCopyAttributesAndData(item_p, ctypes.pointer(info), None, ctypes.byref(attrs_p), None, None)
-        attrs = attrs_p.contents
-        assert(attrs.count >= 1)
-
-        label = attrs.attr[0].data[:attrs.attr[0].length]
-
-        Security.lib.SecKeychainItemFreeAttributesAndData(attrs_p)
-
-        return GenericPassword(service_name=service_name, account_name=account_name, password=password, keychain_item=item_p, label=label)
-
-    def find_internet_password(self, account_name="", password="", server_name="", security_domain="", path="", port=0, protocol_type=None, authentication_type=None):
-        """Pythonic wrapper for SecKeychainFindInternetPassword"""
+        # Empty search terms match anything so only the others are known:
+        known = dict((k, v) for k, v in (('service_name', service_name), ('account_name', account_name)) if v)
+        if prefetch:
+            known['password'] = ctypes.string_at(password_data, password_length.value)
+            Security.lib.SecKeychainItemFreeContent(None, password_data)
+
+        item = GenericPassword.from_keychain(item, **known)
+        if prefetch:
+            item.load()
+        return item
+
+    def find_internet_password(self, account_name="", password="", server_name="", security_domain="", path="", port=0, protocol_type=None, authentication_type=None, prefetch=False):
+        """
+        Pythonic wrapper for SecKeychainFindInternetPassword
+
+        As with find_generic_password the password is copied when first used
+        unless prefetch is True.
+        """
         item            = ctypes.c_void_p()
         password_length = ctypes.c_uint32(0)
-        password_data   = ctypes.c_char_p(256)
+        password_data   = ctypes.c_void_p()
 
         if protocol_type and len(protocol_type) != 4:
             raise TypeError("protocol_type must be a valid FourCharCode - see http://developer.apple.com/documentation/Security/Reference/keychainservices/Reference/reference.html#//apple_ref/doc/c_ref/SecProtocolType")
@@ -122,21 +214,26 @@ class Keychain(object):
         if not isinstance(port, int):
             port = int(port)
 
+        server  = server_name.encode("utf-8")
+        domain  = (security_domain or "").encode("utf-8")
+        account = account_name.encode("utf-8")
+        path_b  = path.encode("utf-8")
+
         rc = Security.lib.SecKeychainFindInternetPassword(
             self.keychain_handle,
-            len(server_name),
-            server_name,
-            len(security_domain) if security_domain else 0,
-            security_domain,
-            len(account_name),
-            account_name,
-            len(path),
-            path,
+            len(server),
+            server,
+            len(domain),
+            domain or None,
+            len(account),
+            account,
+            len(path_b),
+            path_b,
             port,
-            protocol_type,
-            authentication_type,
-            ctypes.byref(password_length),      # Will be filled with pw length
-            ctypes.pointer(password_data),      # Will be filled with pw data
+            ctypes.c_uint32(four_char_code(protocol_type) if protocol_type else 0),
+            ctypes.c_uint32(four_char_code(authentication_type) if authentication_type else 0),
+            ctypes.pointer(password_length) if prefetch else None,  # Will be filled with pw length
+            ctypes.pointer(password_data) if prefetch else None,    # Will be filled with pw data
             ctypes.pointer(item)
         )
 
@@ -145,45 +242,117 @@ class Keychain(object):
         elif rc != 0:
             raise RuntimeError('Unable to retrieve internet password (server=%s, account=%s): rc=%d' % (server_name, account_name, rc))
 
-        password = password_data.value[0:password_length.value]
+        # Empty search terms match anything so only the others are known:
+        known = dict((k, v) for k, v in (
+            ('server_name', server_name), ('account_name', account_name), ('security_domain', security_domain),
+            ('path', path), ('port', port), ('protocol_type', protocol_type), ('authentication_type', authentication_type)
+        ) if v)
+        if prefetch:
+            known['password'] = ctypes.string_at(password_data, password_length.value)
+            Security.lib.SecKeychainItemFreeContent(None, password_data)
+
+        item = InternetPassword.from_keychain(item, **known)
+        if prefetch:
+            item.load()
+        return item
+
+    def search(self, item_class=None, with_password=False, prefetch=True, **filters):
+        """
+        Iterates over the items of item_class which match every filter, e.g.
+
+            for item in keychain.search(GenericPassword, service_name="AirPort"):
+                print(item.account_name)
+
+        item_class is GenericPassword (the default) or InternetPassword and
+        filters are their attributes - see ATTRIBUTES. Items are read one at a
+        time as the search is iterated, with all of their attributes copied
+        by a single SecKeychainItemCopyAttributesAndData call, or when they're
+        first used if prefetch is False. Passwords are copied in the same call
+        if with_password is True or, like the attributes of items which aren't
+        prefetched, on first use - which may prompt the user.
+        """
+        if item_class is None:
+            item_class = GenericPassword
+
+        attributes = dict(item_class.ATTRIBUTES)
+        for k in filters:
+            if k not in attributes:
+                raise AttributeError("Unknown %s attribute %s" % (item_class.__name__, k))
+
+        query = SecKeychainAttributeList.from_attributes(
+            (attribute_tag(attributes[k]), encode_attribute(k, v)) for k, v in filters.items()
+        )
+        info = SecKeychainAttributeInfo.from_tags(attribute_tag(tag) for name, tag in item_class.ATTRIBUTES)
+        names = dict((attribute_tag(tag), name) for name, tag in item_class.ATTRIBUTES)
 
-        Security.lib.SecKeychainItemFreeContent(None, password_data)
+        search_ref = ctypes.c_void_p()
+        Security.lib.SecKeychainSearchCreateFromAttributes(
+            self.keychain_handle,
+            ctypes.c_uint32(getattr(Security, item_class.ITEM_CLASS).value),
+            ctypes.pointer(query),
+            ctypes.pointer(search_ref)
+        )
 
-        return InternetPassword(server_name=server_name, account_name=account_name, password=password, keychain_item=item, security_domain=security_domain, path=path, port=port, protocol_type=protocol_type, authentication_type=authentication_type)
+        try:
+            while True:
+                item_ref = ctypes.c_void_p()
+                try:
+                    Security.lib.SecKeychainSearchCopyNext(search_ref, ctypes.pointer(item_ref))
+                except KeyError: # errSecItemNotFound marks the end of the search
+                    return
+
+                if not (prefetch or with_password):
+                    yield item_class.from_keychain(item_ref, **filters)
+                    continue
+
+                values = copy_attributes_and_data(item_ref, info if prefetch else None, with_password)
+                props  = dict((names[k], decode_attribute(names[k], v)) for k, v in values.items() if k is not None)
+                props.update(filters)
+                if with_password:
+                    props['password'] = values[None]
+                yield item_class.from_keychain(item_ref, **props)
+        finally:
+            Security.lib.CFRelease(search_ref)
 
     def add(self, item):
         """Add the provided GenericPassword or InternetPassword object to this Keychain"""
         assert(isinstance(item, GenericPassword))
 
         item_ref = ctypes.c_void_p()
+        account  = to_bytes(item.account_name or "")
+        password = to_bytes(item.password or "")
 
         if isinstance(item, InternetPassword):
+            server = to_bytes(item.server_name or "")
+            domain = to_bytes(item.security_domain or "")
+            path   = to_bytes(item.path or "")
             rc = Security.lib.SecKeychainAddInternetPassword(
                 self.keychain_handle,
-                len(item.server_name),
-                item.server_name,
-                len(item.security_domain),
-                item.security_domain,
-                len(item.account_name),
-                item.account_name,
-                len(item.path),
-                item.path,
+                len(server),
+                server,
+                len(domain),
+                domain,
+                len(account),
+                account,
+                len(path),
+                path,
                 item.port,
-                item.protocol_type,
-                item.authentication_type,
-                len(item.password),
-                item.password,
+                ctypes.c_uint32(four_char_code(item.protocol_type) if item.protocol_type else 0),
+                ctypes.c_uint32(four_char_code(item.authentication_type) if item.authentication_type else 0),
+                len(password),
+                password,
                 ctypes.pointer(item_ref)
             )
         else:
+            service = to_bytes(item.service_name or "")
             rc = Security.lib.SecKeychainAddGenericPassword(
                 self.keychain_handle,
-                len(item.service_name),
-                item.service_name,
-                len(item.account_name),
-                item.account_name,
-                len(item.password),
-                item.password,
+                len(service),
+                service,
+                len(account),
+                account,
+                len(password),
+                password,
                 ctypes.pointer(item_ref)
             )
 
@@ -197,16 +366,210 @@ class Keychain(object):
         assert(isinstance(item, GenericPassword))
         item.delete()
 
+    def find(self, item):
+        """
+        Returns the item in this keychain with the same service and account
+        or, for an InternetPassword, the same server, account, etc. as item.
+        Raises KeyError if there isn't one.
+        """
+        if isinstance(item, InternetPassword):
+            return self.find_internet_password(
+                account_name=item.account_name or "",
+                server_name=item.server_name or "",
+                security_domain=item.security_domain,
+                path=item.path or "",
+                port=item.port or 0,
+                protocol_type=item.protocol_type,
+                authentication_type=item.authentication_type
+            )
+        return self.find_generic_password(item.service_name, item.account_name)
+
+    def batch(self, upserts=(), deletes=(), atomic=False):
+        """
+        Adds or updates the password of each item in upserts, then deletes each
+        item in deletes, and returns a BatchResult for each item in that order.
+
+        Items are matched with find(), so they only need their identifying
+        properties. Every operation uses this Keychain's handle so a locked
+        keychain is only unlocked once.
+
+        Failures are recorded in the results and the batch continues, unless
+        atomic is True: then the first failure stops the batch, the items it
+        changed are restored and BatchError is raised with the results. The
+        passwords and attributes of items being updated or deleted are copied
+        beforehand so they can be restored; a deleted item is restored as a
+        new item, so its access controls are not. The batch is also rolled
+        back if it is interrupted, e.g. by KeyboardInterrupt, which is then
+        re-raised.
+        """
+        operations = [('upsert', i) for i in upserts] + [('delete', i) for i in deletes]
+        results    = []
+        undo       = [] # (BatchResult, callable) for the completed operations
+
+        for operation, item in operations:
+            result = BatchResult(item, operation)
+            results.append(result)
+            try:
+                if operation == 'upsert':
+                    undo_func = self._upsert(item, result, atomic)
+                else:
+                    undo_func = self._delete(item, result, atomic)
+            except Exception as exc: # Anything an operation raises only fails that operation
+                result.error = exc
+                if atomic:
+                    break
+            except BaseException:
+                if atomic:
+                    self._rollback(undo)
+                raise
+            else:
+                undo.append((result, undo_func))
+
+        failed = [r for r in results if r.error is not None]
+        if atomic and failed:
+            self._rollback(undo)
+            for operation, item in operations[len(results):]:
+                results.append(BatchResult(item, operation, skipped=True))
+            raise BatchError("%d of %d keychain operations failed: %s" % (len(failed), len(operations), failed[0].error), results)
+
+        return results
+
+    @staticmethod
+    def _rollback(undo):
+        """Used by batch() to reverse its completed operations, newest first"""
+        for result, undo_func in reversed(undo):
+            try:
+                undo_func()
+                result.rolled_back = True
+            except Exception as exc:
+                result.rollback_error = exc
+
+    def _upsert(self, item, result, atomic=False):
+        """Used by batch() to add or update item; returns a callable which reverses it"""
+        if item.password is None:
+            raise TypeError("No password to store for %s" % item)
+
+        try:
+            existing = self.find(item)
+        except KeyError:
+            self.add(item)
+            result.action = 'add'
+            added = item.__class__.from_keychain(item.keychain_item)
+
+            def undo_add():
+                added.delete()
+                item.keychain_item = None
+            return undo_add
+
+        result.action = 'update'
+        old_password  = existing.password if atomic else None
+        existing.update_password(item.password)
+        item.keychain_item = existing.keychain_item
+        return lambda: existing.update_password(old_password)
+
+    def _delete(self, item, result, atomic=False):
+        """Used by batch() to delete item; returns a callable which restores it"""
+        existing = item if item.keychain_item is not None else self.find(item)
+        result.action = 'delete'
+
+        copy  = None
+        label = None
+        if atomic:
+            props = dict((name, getattr(existing, name)) for name, tag in existing.ATTRIBUTES if name != 'label')
+            copy  = existing.__class__(password=existing.password, **props)
+            label = existing.label
+
+        existing.delete()
+
+        def undo_delete():
+            # SecKeychainAdd*Password can't set the label, so it's restored after:
+            self.add(copy)
+            if label:
+                copy.modify_attributes(label=label)
+        return undo_delete
+
+
+class BatchResult(object):
+    """The outcome of one operation in Keychain.batch()"""
+
+    def __init__(self, item, action, skipped=False):
+        self.item        = item
+        self.action      = action   # 'upsert' until it becomes 'add', 'update' or 'delete'
+        self.error       = None     # The exception which stopped it
+        self.skipped     = skipped  # Not attempted because an atomic batch failed
+        self.rolled_back = False
+        self.rollback_error = None  # Raised while restoring the previous item
+
+    @property
+    def ok(self):
+        return self.error is None and not (self.skipped or self.rolled_back)
+
+    def __repr__(self):
+        if self.error is not None:
+            status = "error=%r" % self.error
+        elif self.skipped:
+            status = "skipped"
+        elif self.rollback_error is not None:
+            status = "rollback error=%r" % self.rollback_error
+        elif self.rolled_back:
+            status = "rolled back"
+        else:
+            status = "ok"
+        return "BatchResult(%s %s: %s)" % (self.action, self.item, status)
+
+
+class BatchError(RuntimeError):
+    """Raised when an atomic Keychain.batch() fails; results are the BatchResults"""
+
+    def __init__(self, message, results):
+        super(BatchError, self).__init__(message)
+        self.results = results
+
+
+class ItemProperty(object):
+    """
+    A keychain item property which is copied from the keychain when it is
+    first used, for items returned by Keychain.find_*() and Keychain.search()
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.name    = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, item, owner):
+        if item is None:
+            return self
+        if self.name in item.unloaded:
+            item.load(password=self.name == 'password')
+        return item.__dict__.get(self.name, self.default)
+
+    def __set__(self, item, value):
+        item.__dict__[self.name] = value
+        item.unloaded = item.unloaded.difference([self.name])
+
 
 class GenericPassword(object):
     """Generic keychain password used with SecKeychainAddGenericPassword and SecKeychainFindGenericPassword"""
     # TODO: Add support for access control and attributes
 
-    account_name  = None
-    service_name  = None
-    label         = None
-    password      = None
+    # The item class and the (property, attribute tag) pairs used by
+    # Keychain.search(), as the names of constants in PyMacAdmin.Security:
+    ITEM_CLASS = 'kSecGenericPasswordItemClass'
+    ATTRIBUTES = (
+        ('service_name',        'kSecServiceItemAttr'),
+        ('account_name',        'kSecAccountItemAttr'),
+        ('label',               'kSecLabelItemAttr'),
+    )
+
+    account_name  = ItemProperty()
+    service_name  = ItemProperty()
+    label         = ItemProperty()
+    password      = ItemProperty()
     keychain_item = None # An SecKeychainItemRef treated as an opaque object
+    unloaded      = frozenset() # Properties not yet copied from the keychain
 
     def __init__(self, **kwargs):
         super(GenericPassword, self).__init__()
@@ -215,20 +578,83 @@ class GenericPassword(object):
                 raise AttributeError("Unknown property %s" % k)
             setattr(self, k, v)
 
+    @classmethod
+    def from_keychain(cls, keychain_item, **known):
+        """
+        Returns an item for a SecKeychainItemRef. The properties which aren't
+        known are copied from the keychain when they are first used.
+        """
+        item          = cls(keychain_item=keychain_item, **known)
+        item.unloaded = frozenset(['password'] + [name for name, tag in cls.ATTRIBUTES]).difference(known)
+        return item
+
+    def load(self, password=False):
+        """
+        Copies every unloaded attribute from the keychain using one
+        SecKeychainItemCopyAttributesAndData call, with the password if
+        password is True
+        """
+        names     = [name for name, tag in self.ATTRIBUTES if name in self.unloaded]
+        with_data = password and 'password' in self.unloaded
+        if not (names or with_data):
+            return
+
+        tags   = dict((attribute_tag(tag), name) for name, tag in self.ATTRIBUTES if name in names)
+        info   = SecKeychainAttributeInfo.from_tags(tags) if names else None
+        values = copy_attributes_and_data(self.keychain_item, info, with_data)
+
+        for tag, data in values.items():
+            if tag is None:
+                self.__dict__['password'] = data
+            else:
+                self.__dict__[tags[tag]] = decode_attribute(tags[tag], data)
+
+        self.unloaded = self.unloaded.difference(names + (['password'] if with_data else []))
+
     def update_password(self, new_password):
         """Change the stored password"""
+        if new_password is None:
+            raise TypeError("No new password for %s" % self)
 
+        data = to_bytes(new_password)
         rc = Security.lib.SecKeychainItemModifyAttributesAndData(
             self.keychain_item,
             None,
-            len(new_password),
-            new_password
+            len(data),
+            data
         )
 
         if rc == -61:
             raise RuntimeError("Permission denied updating %s" % self)
         elif rc != 0:
-            raise RuntimeError("Unable to update password for %s: rc = %d" % rc)
+            raise RuntimeError("Unable to update password for %s: rc = %d" % (self, rc))
+
+        self.password = new_password
+
+    def modify_attributes(self, **values):
+        """Changes the stored attributes, e.g. label, leaving the password unchanged"""
+        tags = dict(self.ATTRIBUTES)
+        for k in values:
+            if k not in tags:
+                raise AttributeError("Unknown attribute %s" % k)
+
+        attrs = SecKeychainAttributeList.from_attributes(
+            (attribute_tag(tags[k]), encode_attribute(k, v)) for k, v in values.items()
+        )
+        rc = Security.lib.SecKeychainItemModifyAttributesAndData(
+            self.keychain_item,
+            ctypes.pointer(attrs),
+            0,
+            None
+        )
+
+        if rc == -61:
+            raise RuntimeError("Permission denied updating %s" % self)
+        elif rc != 0:
+            raise RuntimeError("Unable to update attributes of %s: rc = %d" % (self, rc))
+
+        for k, v in values.items():
+            setattr(self, k, v)
 
     def delete(self):
         """Removes this item from the keychain"""
@@ -236,10 +662,10 @@ class GenericPassword(object):
         if rc != 0:
             raise RuntimeError("Unable to delete %s: rc=%d" % (self, rc))
 
-        from CoreFoundation import CFRelease
-        CFRelease(self.keychain_item)
+        Security.lib.CFRelease(self.keychain_item)
 
         self.keychain_item = None
+        self.unloaded      = frozenset()
         self.service_name  = None
         self.account_name  = None
         self.password      = None
@@ -257,15 +683,25 @@ class GenericPassword(object):
 
 class InternetPassword(GenericPassword):
     """Specialized keychain item for internet passwords used with SecKeychainAddInternetPassword and SecKeychainFindInternetPassword"""
-    account_name        = ""
-    password            = None
-    keychain_item       = None
-    server_name         = ""
-    security_domain     = ""
-    path                = ""
-    port                = 0
-    protocol_type       = None
-    authentication_type = None
+    account_name        = ItemProperty("")
+    server_name         = ItemProperty("")
+    security_domain     = ItemProperty("")
+    path                = ItemProperty("")
+    port                = ItemProperty(0)
+    protocol_type       = ItemProperty()
+    authentication_type = ItemProperty()
+
+    ITEM_CLASS = 'kSecInternetPasswordItemClass'
+    ATTRIBUTES = (
+        ('account_name',        'kSecAccountItemAttr'),
+        ('server_name',         'kSecServerItemAttr'),
+        ('security_domain',     'kSecSecurityDomainItemAttr'),
+        ('path',                'kSecPathItemAttr'),
+        ('port',                'kSecPortItemAttr'),
+        ('protocol_type',       'kSecProtocolItemAttr'),
+        ('authentication_type', 'kSecAuthenticationTypeItemAttr'),
+        ('label',               'kSecLabelItemAttr'),
+    )
 
     def __init__(self, **kwargs):
         super(InternetPassword, self).__init__(**kwargs)
@@ -283,12 +719,12 @@ class SecKeychainAttribute(ctypes.Structure):
 
     tag:    A 4-byte attribute tag.
     length: The length of the buffer pointed to by data.
-    data:   A pointer to the attribute data.
+    data:   A pointer to the attribute data, which may contain NUL bytes.
     """
     _fields_ = [
         ('tag',     ctypes.c_uint32),
         ('length',  ctypes.c_uint32),
-        ('data',    ctypes.c_char_p)
+        ('data',    ctypes.c_void_p)
     ]
 
 class SecKeychainAttributeList(ctypes.Structure):
@@ -298,24 +734,35 @@ class SecKeychainAttributeList(ctypes.Structure):
     attr:   A pointer to the first keychain attribute in the array.
     """
 
-    # TODO: Standard iterator support for SecKeychainAttributeList:
-    #
-    #   for offset in range(0, attrs.count):
-    #     print "[%d]: %s: %s" % (offset, attrs.attr[offset].tag, attrs.attr[offset].data[:attrs.attr[offset].length])
-    #
-    # becomes:
-    #
-    #   for tag, data in attrs:
-    #       …
-    #
-    #   attrs[tag] should also work
-    #
+    # TODO: attrs[tag] should also work
 
     _fields_ = [
         ('count',   ctypes.c_uint),
         ('attr',    ctypes.POINTER(SecKeychainAttribute))
     ]
 
+    @classmethod
+    def from_attributes(cls, attributes):
+        """Returns a list containing (tag, bytes) pairs, which it keeps alive"""
+        attributes = list(attributes)
+        buffers    = [ctypes.create_string_buffer(data, len(data)) for tag, data in attributes]
+        array      = (SecKeychainAttribute * len(attributes))()
+
+        for i, (tag, data) in enumerate(attributes):
+            array[i].tag    = tag
+            array[i].length = len(data)
+            array[i].data   = ctypes.cast(buffers[i], ctypes.c_void_p)
+
+        attr_list         = cls(len(attributes), ctypes.cast(array, ctypes.POINTER(SecKeychainAttribute)))
+        attr_list._buffers = (array, buffers)
+        return attr_list
+
+    def __iter__(self):
+        """Yields (tag, bytes) for each attribute"""
+        for offset in range(0, self.count):
+            attr = self.attr[offset]
+            yield attr.tag, ctypes.string_at(attr.data, attr.length) if attr.data else b""
+
 class SecKeychainAttributeInfo(ctypes.Structure):
     """Represents a keychain attribute as a pair of tag and format values.
 
@@ -330,6 +777,104 @@ class SecKeychainAttributeInfo(ctypes.Structure):
         ('format',  ctypes.POINTER(ctypes.c_uint))
     ]
 
+    @classmethod
+    def from_tags(cls, tags):
+        """Returns info for the attribute tags, leaving their formats unspecified"""
+        tags = list(tags)
+        return cls(len(tags), (ctypes.c_uint * len(tags))(*tags), None)
+
 # The APIs expect pointers to SecKeychainAttributeInfo objects:
 SecKeychainAttributeInfo_p = ctypes.POINTER(SecKeychainAttributeInfo)
 SecKeychainAttributeList_p = ctypes.POINTER(SecKeychainAttributeList)
+
+def encode_uint32(value):
+    return struct.pack("=L", int(value))
+
+def decode_uint32(data):
+    return struct.unpack("=L", data)[0] if data else 0
+
+def four_char_code(value):
+    """Returns the integer for a FourCharCode like 'http'"""
+    return struct.unpack(">L", value.encode("ascii"))[0]
+
+def encode_four_char_code(value):
+    """FourCharCodes are stored as native-endian integers"""
+    return encode_uint32(four_char_code(value))
+
+def decode_four_char_code(data):
+    return struct.pack(">L", decode_uint32(data)).decode("ascii") if data else None
+
+# Properties which aren't stored as UTF-8 strings and their (encode, decode)
+# functions:
+ATTRIBUTE_CODECS = {
+    'port':                 (encode_uint32, decode_uint32),
+    'protocol_type':        (encode_four_char_code, decode_four_char_code),
+    'authentication_type':  (encode_four_char_code, decode_four_char_code),
+}
+
+def to_bytes(value):
+    """Returns str values encoded as UTF-8 for the Security calls"""
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+def attribute_tag(name):
+    """Returns the integer tag for a constant name like kSecAccountItemAttr"""
+    return getattr(Security, name).value
+
+def encode_attribute(name, value):
+    """Returns the bytes stored in the keychain for an item property"""
+    if name in ATTRIBUTE_CODECS:
+        return ATTRIBUTE_CODECS[name][0](value)
+    return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+
+def decode_attribute(name, data):
+    """Reverses encode_attribute"""
+    if name in ATTRIBUTE_CODECS:
+        return ATTRIBUTE_CODECS[name][1](data)
+    return data.decode("utf-8", "replace")
+
+def copy_attributes_and_data(item_ref, info, with_data=False):
+    """
+    Returns {tag: bytes} for the attributes in info with a single
+    SecKeychainItemCopyAttributesAndData call. If with_data is True the item's
+    data (i.e. its password) is also returned under the key None. info may be
+    None to copy only the data.
+    """
+    # itemRef: A reference to the keychain item from which you wish to
+    # retrieve data or attributes.
+    #
+    # info:  A pointer to a list of tags of attributes to retrieve.
+    #
+    # itemClass: A pointer to the item’s class. You should pass NULL if not
+    # required. See “Keychain Item Class Constants” for valid constants.
+    #
+    # attrList: On input, the list of attributes in this item to get; on
+    # output the attributes are filled in. You should call the function
+    # SecKeychainItemFreeAttributesAndData when you no longer need the
+    # attributes and data.
+    #
+    # length: On return, a pointer to the actual length of the data.
+    #
+    # outData: A pointer to a buffer containing the data in this item. Pass
+    # NULL if not required. You should call the function
+    # SecKeychainItemFreeAttributesAndData when you no longer need the
+    # attributes and data.
+    attrs_p = SecKeychainAttributeList_p()
+    length  = ctypes.c_uint32(0)
+    data    = ctypes.c_void_p()
+
+    Security.lib.SecKeychainItemCopyAttributesAndData(
+        item_ref,
+        ctypes.pointer(info) if info is not None else None,
+        None,
+        ctypes.pointer(attrs_p) if info is not None else None,
+        ctypes.pointer(length) if with_data else None,
+        ctypes.pointer(data) if with_data else None
+    )
+
+    try:
+        values = dict(attrs_p.contents) if attrs_p else {}
+        if with_data:
+            values[None] = ctypes.string_at(data, length.value) if data else b""
+        return values
+    finally:
+        Security.lib.SecKeychainItemFreeAttributesAndData(attrs_p, data)
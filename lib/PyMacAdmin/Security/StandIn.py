@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A pure-Python stand-in for the Security.framework keychain calls
+
+StandInSecurity implements the Sec* functions used by PyMacAdmin.Security
+with the same arguments, return codes and out-parameters as the framework,
+storing keychain items in SQLite. Like the framework loaded by
+PyMacAdmin.load_carbon_framework, each call passes its return code through
+checked_carbon_call so errSecItemNotFound raises KeyError and other errors
+raise RuntimeError. It can be used to run code using PyMacAdmin.Security
+where Security.framework isn't available:
+
+    from PyMacAdmin import Security
+    from PyMacAdmin.Security.StandIn import StandInSecurity
+
+    Security.use_backend(StandInSecurity())
+
+or by setting PYMACADMIN_SECURITY_BACKEND=standin before importing
+PyMacAdmin.Security, with PYMACADMIN_SECURITY_STANDIN_DB naming a database
+file to keep the items between processes. Nothing is encrypted: this is
+for tests and benchmarks, not secrets.
+"""
+
+import collections
+import ctypes
+import functools
+import sqlite3
+import threading
+
+import PyMacAdmin
+from PyMacAdmin import Security
+from PyMacAdmin.Security import Keychain
+
+errSecParam         = -50
+errSecDuplicateItem = -25299
+errSecItemNotFound  = -25300
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS items (
+        id          INTEGER PRIMARY KEY,
+        keychain    TEXT NOT NULL,
+        item_class  INTEGER NOT NULL,
+        data        BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS attributes (
+        item        INTEGER NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+        tag         INTEGER NOT NULL,
+        value       BLOB NOT NULL,
+        PRIMARY KEY (item, tag)
+    );
+"""
+
+def tag(name):
+    return getattr(Security, name).value
+
+def value_of(arg):
+    """Returns the Python value of a ctypes argument"""
+    return arg.value if hasattr(arg, "value") else arg
+
+def uint32(arg):
+    arg = value_of(arg)
+    return Keychain.encode_uint32(arg) if arg else None
+
+def carbon_call(method):
+    """Counts each call and checks its return code like load_carbon_framework"""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        with self.lock:
+            self.calls[method.__name__] += 1
+            rc = method(self, *args)
+        return PyMacAdmin.checked_carbon_call(rc, method, args)
+    return wrapper
+
+class StandInSecurity(object):
+    """Implements the keychain item functions of Security.framework using SQLite"""
+
+    def __init__(self, database=":memory:"):
+        self.lock        = threading.RLock()
+        self.db          = sqlite3.connect(database, check_same_thread=False)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        self.calls       = collections.Counter()
+        self.refs        = {}   # CFTypeRef: (kind, value) for keychains, searches and items
+        self.allocations = {}   # address: buffer returned to the caller until it's freed
+        self.failures    = {}   # account: rc, to make changes to those items fail
+        self.next_ref    = 0x1000
+
+    def new_ref(self, kind, value):
+        self.next_ref += 1
+        self.refs[self.next_ref] = (kind, value)
+        return self.next_ref
+
+    def open_refs(self, kind):
+        """Returns the values of the unreleased references of kind"""
+        return [v for k, v in self.refs.values() if k == kind]
+
+    def keychain_path(self, keychain):
+        """Returns the path for a keychain reference, or "" for the default keychain"""
+        keychain = value_of(keychain)
+        if not keychain:
+            return ""
+        kind, path = self.refs[keychain]
+        assert kind == "keychain"
+        return path
+
+    def item_id(self, item_ref):
+        kind, item_id = self.refs[value_of(item_ref)]
+        assert kind == "item"
+        return item_id
+
+    def find(self, keychain, item_class, attributes):
+        """Returns the ids of the items matching every non-empty attribute"""
+        sql  = "SELECT id FROM items WHERE keychain = ? AND item_class = ?"
+        args = [keychain, item_class]
+        for t, v in sorted(attributes.items()):
+            if v:
+                sql += " AND id IN (SELECT item FROM attributes WHERE tag = ? AND value = ?)"
+                args += [t, v]
+        return [row[0] for row in self.db.execute(sql + " ORDER BY id", args)]
+
+    def attributes(self, item_id):
+        return dict(self.db.execute("SELECT tag, value FROM attributes WHERE item = ?", (item_id,)))
+
+    def failure(self, item_id=None, attributes=None):
+        if attributes is None:
+            attributes = self.attributes(item_id)
+        account = attributes.get(tag('kSecAccountItemAttr'))
+        return self.failures.get(account.decode("utf-8") if account else account, 0)
+
+    def return_data(self, data, length_p, data_p):
+        """Fills in the length and data out-parameters with a copy of data"""
+        buf = ctypes.create_string_buffer(data, len(data))
+        self.allocations[ctypes.addressof(buf)] = buf
+        data_p.contents.value   = ctypes.addressof(buf)
+        length_p.contents.value = len(data)
+
+    def insert(self, item_class, attributes, data, keychain=""):
+        """
+        Stores an item and returns its id; also used to set up tests with
+        attributes which the Add functions don't set, e.g. labels
+
+        Args:
+            item_class: int, e.g. Security.kSecGenericPasswordItemClass.value
+            attributes: dict of {tag: bytes}; empty values aren't stored
+            data: bytes, the password
+            keychain: str, the keychain path or "" for the default keychain
+        """
+        with self.lock, self.db:
+            cursor  = self.db.execute("INSERT INTO items (keychain, item_class, data) VALUES (?, ?, ?)",
+                                      (keychain, item_class, data))
+            item_id = cursor.lastrowid
+            self.db.executemany("INSERT INTO attributes (item, tag, value) VALUES (?, ?, ?)",
+                                [(item_id, t, v) for t, v in attributes.items() if v])
+        return item_id
+
+    def add(self, keychain, item_class, attributes, data, item_ref_p):
+        attributes = dict((t, v) for t, v in attributes.items() if v)
+        rc = self.failure(attributes=attributes)
+        if rc:
+            return rc
+
+        keychain = self.keychain_path(keychain)
+        if self.find(keychain, item_class, attributes):
+            return errSecDuplicateItem
+
+        item_id = self.insert(item_class, attributes, data, keychain)
+        if item_ref_p is not None:
+            item_ref_p.contents.value = self.new_ref("item", item_id)
+        return 0
+
+    def found(self, item_ids, length_p, data_p, item_ref_p):
+        if not item_ids:
+            return errSecItemNotFound
+        if data_p is not None:
+            data = self.db.execute("SELECT data FROM items WHERE id = ?", (item_ids[0],)).fetchone()[0]
+            self.return_data(data, length_p, data_p)
+        if item_ref_p is not None:
+            item_ref_p.contents.value = self.new_ref("item", item_ids[0])
+        return 0
+
+    def generic_attributes(self, service, service_length, account, account_length):
+        return {
+            tag('kSecServiceItemAttr'): service[:service_length] if service else None,
+            tag('kSecAccountItemAttr'): account[:account_length] if account else None,
+        }
+
+    def internet_attributes(self, server, server_length, domain, domain_length, account, account_length,
+                            path, path_length, port, protocol, authentication):
+        return {
+            tag('kSecServerItemAttr'):              server[:server_length] if server else None,
+            tag('kSecSecurityDomainItemAttr'):      domain[:domain_length] if domain else None,
+            tag('kSecAccountItemAttr'):             account[:account_length] if account else None,
+            tag('kSecPathItemAttr'):                path[:path_length] if path else None,
+            tag('kSecPortItemAttr'):                uint32(port),
+            tag('kSecProtocolItemAttr'):            uint32(protocol),
+            tag('kSecAuthenticationTypeItemAttr'):  uint32(authentication),
+        }
+
+    @carbon_call
+    def SecKeychainOpen(self, path, keychain_p):
+        keychain_p.contents.value = self.new_ref("keychain", path.decode("utf-8"))
+        return 0
+
+    @carbon_call
+    def SecKeychainFindGenericPassword(self, keychain, service_length, service, account_length, account,
+                                       length_p, data_p, item_ref_p):
+        attributes = self.generic_attributes(service, service_length, account, account_length)
+        item_ids   = self.find(self.keychain_path(keychain), tag('kSecGenericPasswordItemClass'), attributes)
+        return self.found(item_ids, length_p, data_p, item_ref_p)
+
+    @carbon_call
+    def SecKeychainFindInternetPassword(self, keychain, server_length, server, domain_length, domain,
+                                        account_length, account, path_length, path, port, protocol,
+                                        authentication, length_p, data_p, item_ref_p):
+        attributes = self.internet_attributes(server, server_length, domain, domain_length, account,
+                                              account_length, path, path_length, port, protocol, authentication)
+        item_ids   = self.find(self.keychain_path(keychain), tag('kSecInternetPasswordItemClass'), attributes)
+        return self.found(item_ids, length_p, data_p, item_ref_p)
+
+    @carbon_call
+    def SecKeychainAddGenericPassword(self, keychain, service_length, service, account_length, account,
+                                      password_length, password, item_ref_p):
+        attributes = self.generic_attributes(service, service_length, account, account_length)
+        return self.add(keychain, tag('kSecGenericPasswordItemClass'), attributes,
+                        password[:password_length], item_ref_p)
+
+    @carbon_call
+    def SecKeychainAddInternetPassword(self, keychain, server_length, server, domain_length, domain,
+                                       account_length, account, path_length, path, port, protocol,
+                                       authentication, password_length, password, item_ref_p):
+        attributes = self.internet_attributes(server, server_length, domain, domain_length, account,
+                                              account_length, path, path_length, port, protocol, authentication)
+        return self.add(keychain, tag('kSecInternetPasswordItemClass'), attributes,
+                        password[:password_length], item_ref_p)
+
+    @carbon_call
+    def SecKeychainItemModifyAttributesAndData(self, item_ref, attrs_p, length, data):
+        item_id = self.item_id(item_ref)
+        rc      = self.failure(item_id)
+        if rc:
+            return rc
+
+        with self.db:
+            if attrs_p:
+                self.db.executemany("INSERT OR REPLACE INTO attributes (item, tag, value) VALUES (?, ?, ?)",
+                                    [(item_id, t, v) for t, v in attrs_p.contents])
+            if data is not None:
+                self.db.execute("UPDATE items SET data = ? WHERE id = ?", (data[:length], item_id))
+        return 0
+
+    @carbon_call
+    def SecKeychainItemDelete(self, item_ref):
+        item_id = self.item_id(item_ref)
+        rc      = self.failure(item_id)
+        if rc:
+            return rc
+
+        with self.db:
+            cursor = self.db.execute("DELETE FROM items WHERE id = ?", (item_id,))
+        return 0 if cursor.rowcount else errSecItemNotFound
+
+    @carbon_call
+    def SecKeychainItemCopyAttributesAndData(self, item_ref, info_p, class_p, attrs_pp, length_p, data_p):
+        item_id = self.item_id(item_ref)
+        row     = self.db.execute("SELECT item_class, data FROM items WHERE id = ?", (item_id,)).fetchone()
+        if row is None:
+            return errSecItemNotFound
+
+        if class_p is not None:
+            class_p.contents.value = row[0]
+
+        if attrs_pp is not None:
+            if info_p is None:
+                return errSecParam
+            info       = info_p.contents
+            attributes = self.attributes(item_id)
+            attr_list  = Keychain.SecKeychainAttributeList.from_attributes(
+                (info.tag[i], attributes.get(info.tag[i], b"")) for i in range(info.count)
+            )
+            self.allocations[ctypes.addressof(attr_list)] = attr_list
+            attrs_pp[0] = ctypes.pointer(attr_list)
+
+        if data_p is not None:
+            self.return_data(row[1], length_p, data_p)
+        return 0
+
+    @carbon_call
+    def SecKeychainItemFreeAttributesAndData(self, attrs_p, data):
+        if attrs_p:
+            del self.allocations[ctypes.addressof(attrs_p.contents)]
+        if value_of(data):
+            del self.allocations[value_of(data)]
+        return 0
+
+    @carbon_call
+    def SecKeychainItemFreeContent(self, attrs_p, data):
+        return self.SecKeychainItemFreeAttributesAndData.__wrapped__(self, attrs_p, data)
+
+    @carbon_call
+    def SecKeychainSearchCreateFromAttributes(self, keychain, item_class, attrs_p, search_ref_p):
+        attributes = dict(attrs_p.contents) if attrs_p else {}
+        item_ids   = self.find(self.keychain_path(keychain), value_of(item_class), attributes)
+        search_ref_p.contents.value = self.new_ref("search", iter(item_ids))
+        return 0
+
+    @carbon_call
+    def SecKeychainSearchCopyNext(self, search_ref, item_ref_p):
+        kind, item_ids = self.refs[value_of(search_ref)]
+        assert kind == "search"
+        for item_id in item_ids:
+            # Skip items deleted since the search started:
+            if self.db.execute("SELECT 1 FROM items WHERE id = ?", (item_id,)).fetchone():
+                item_ref_p.contents.value = self.new_ref("item", item_id)
+                return 0
+        return errSecItemNotFound
+
+    @carbon_call
+    def CFRelease(self, ref):
+        del self.refs[value_of(ref)]
+        return 0
@@ -1,13 +1,70 @@
 # encoding: utf-8
 import PyMacAdmin
 import ctypes
+import os
 import struct
 import sys
 
+SECURITY_FRAMEWORK = '/System/Library/Frameworks/Security.framework/Versions/Current/Security'
+
+OSStatus    = ctypes.c_int32
+UInt16      = ctypes.c_uint16
+UInt32      = ctypes.c_uint32
+CFTypeRef   = ctypes.c_void_p
+CFTypeRef_p = ctypes.POINTER(ctypes.c_void_p)
+
+# The (restype, argtypes) of the Security.framework functions PyMacAdmin
+# uses, declared once by load_carbon_framework. Out-parameters for items,
+# searches, keychains and returned data are all pointers to c_void_p:
+PROTOTYPES = {
+    'SecKeychainOpen':                          (OSStatus, [ctypes.c_char_p, CFTypeRef_p]),
+    'SecKeychainFindGenericPassword':           (OSStatus, [CFTypeRef, UInt32, ctypes.c_char_p, UInt32, ctypes.c_char_p,
+                                                            ctypes.POINTER(UInt32), CFTypeRef_p, CFTypeRef_p]),
+    'SecKeychainFindInternetPassword':          (OSStatus, [CFTypeRef, UInt32, ctypes.c_char_p, UInt32, ctypes.c_char_p,
+                                                            UInt32, ctypes.c_char_p, UInt32, ctypes.c_char_p, UInt16,
+                                                            UInt32, UInt32, ctypes.POINTER(UInt32), CFTypeRef_p, CFTypeRef_p]),
+    'SecKeychainAddGenericPassword':            (OSStatus, [CFTypeRef, UInt32, ctypes.c_char_p, UInt32, ctypes.c_char_p,
+                                                            UInt32, ctypes.c_void_p, CFTypeRef_p]),
+    'SecKeychainAddInternetPassword':           (OSStatus, [CFTypeRef, UInt32, ctypes.c_char_p, UInt32, ctypes.c_char_p,
+                                                            UInt32, ctypes.c_char_p, UInt32, ctypes.c_char_p, UInt16,
+                                                            UInt32, UInt32, UInt32, ctypes.c_void_p, CFTypeRef_p]),
+    'SecKeychainItemModifyAttributesAndData':   (OSStatus, [CFTypeRef, ctypes.c_void_p, UInt32, ctypes.c_void_p]),
+    'SecKeychainItemDelete':                    (OSStatus, [CFTypeRef]),
+    'SecKeychainItemCopyAttributesAndData':     (OSStatus, [CFTypeRef, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                                            ctypes.POINTER(UInt32), CFTypeRef_p]),
+    'SecKeychainItemFreeAttributesAndData':     (OSStatus, [ctypes.c_void_p, ctypes.c_void_p]),
+    'SecKeychainItemFreeContent':               (OSStatus, [ctypes.c_void_p, ctypes.c_void_p]),
+    'SecKeychainSearchCreateFromAttributes':    (OSStatus, [CFTypeRef, UInt32, ctypes.c_void_p, CFTypeRef_p]),
+    'SecKeychainSearchCopyNext':                (OSStatus, [CFTypeRef, CFTypeRef_p]),
+    # Exported by CoreFoundation, which Security.framework links against:
+    'CFRelease':                                (None, [CFTypeRef]),
+}
+
 # This is not particularly elegant but to avoid everything having to load the
 # Security framework we use a single copy hanging of this module so everything
 # else can simply use Security.lib.SecKeychainFoo(…)
-lib = PyMacAdmin.load_carbon_framework('/System/Library/Frameworks/Security.framework/Versions/Current/Security')
+#
+# lib is the backend implementing those calls: Security.framework unless
+# PYMACADMIN_SECURITY_BACKEND=standin selects PyMacAdmin.Security.StandIn,
+# which is set up at the end of this module, or use_backend() replaces it.
+# It is None if Security.framework couldn't be loaded.
+BACKEND = os.environ.get('PYMACADMIN_SECURITY_BACKEND', 'framework')
+
+if BACKEND not in ('framework', 'standin'):
+    raise ImportError("Unknown PYMACADMIN_SECURITY_BACKEND %r: use framework or standin" % BACKEND)
+
+lib = None
+if BACKEND == 'framework':
+    try:
+        lib = PyMacAdmin.load_carbon_framework(SECURITY_FRAMEWORK, PROTOTYPES)
+    except OSError:
+        pass
+
+def use_backend(backend):
+    """Replaces lib, e.g. with a PyMacAdmin.Security.StandIn.StandInSecurity, and returns the old one"""
+    global lib
+    old, lib = lib, backend
+    return old
 
 CSSM_DB_RECORDTYPE_APP_DEFINED_START = 0x80000000
 CSSM_DL_DB_RECORD_X509_CERTIFICATE   = CSSM_DB_RECORDTYPE_APP_DEFINED_START + 0x1000
@@ -56,5 +113,10 @@ for k in CARBON_DEFINES:
     v = CARBON_DEFINES[k]
     if isinstance(v, str):
         assert(len(v) == 4)
-        v = ctypes.c_ulong(struct.unpack(">L", v)[0])
-    setattr(sys.modules[__name__], k, v)
\ No newline at end of file
+        v = ctypes.c_ulong(struct.unpack(">L", v.encode("ascii"))[0])
+    setattr(sys.modules[__name__], k, v)
+
+if BACKEND == 'standin':
+    # Imported last as the stand-in uses the constants above:
+    from PyMacAdmin.Security import StandIn
+    lib = StandIn.StandInSecurity(os.environ.get('PYMACADMIN_SECURITY_STANDIN_DB', ':memory:'))
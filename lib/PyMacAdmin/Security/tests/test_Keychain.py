@@ -1,9 +1,25 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
 import sys
 import unittest
+from PyMacAdmin import Security
 from PyMacAdmin.Security.Keychain import Keychain, GenericPassword, InternetPassword
+from PyMacAdmin.Security.StandIn import StandInSecurity
+
+SYSTEM_KEYCHAIN = "/Library/Keychains/System.keychain"
+
+def setUpModule():
+    # Without Security.framework, e.g. in CI, the tests use an empty stand-in:
+    if Security.lib is None:
+        Security.use_backend(StandInSecurity())
+
+def tearDownModule():
+    if isinstance(Security.lib, StandInSecurity):
+        Security.use_backend(None)
+
+requires_system_keychain = unittest.skipUnless(os.path.exists(SYSTEM_KEYCHAIN), "requires %s" % SYSTEM_KEYCHAIN)
 
 class KeychainTests(unittest.TestCase):
     """Unit test for the Keychain module"""
@@ -13,23 +29,26 @@ class KeychainTests(unittest.TestCase):
 
     def test_load_default_keychain(self):
         k = Keychain()
-        self.failIfEqual(k, None)
+        self.assertNotEqual(k, None)
 
+    @requires_system_keychain
     def test_load_system_keychain(self):
-        k = Keychain('/Library/Keychains/System.keychain')
-        self.failIfEqual(k, None)
+        k = Keychain(SYSTEM_KEYCHAIN)
+        self.assertNotEqual(k, None)
 
+    @requires_system_keychain
     def test_find_airport_password(self):
-        system_keychain = Keychain("/Library/Keychains/System.keychain")
+        system_keychain = Keychain(SYSTEM_KEYCHAIN)
         try:
             system_keychain.find_generic_password(account_name="linksys")
         except KeyError:
-            print >> sys.stderr, "test_find_airport_password: assuming the non-existence of linksys SSID is correct"
+            print("test_find_airport_password: assuming the non-existence of linksys SSID is correct", file=sys.stderr)
             pass
 
+    @requires_system_keychain
     def test_find_nonexistent_generic_password(self):
         import uuid
-        system_keychain = Keychain("/Library/Keychains/System.keychain")
+        system_keychain = Keychain(SYSTEM_KEYCHAIN)
         self.assertRaises(KeyError, system_keychain.find_generic_password, **{ 'account_name': "NonExistantGenericPassword-%s" % uuid.uuid4() })
 
     def test_add_and_remove_generic_password(self):
@@ -43,15 +62,16 @@ class KeychainTests(unittest.TestCase):
 
         k.add(i)
 
-        self.assertEquals(i.password, k.find_generic_password(service_name, account_name).password)
+        self.assertEqual(i.password.encode("utf-8"), k.find_generic_password(service_name, account_name).password)
  
         k.remove(i)
         self.assertRaises(KeyError, k.find_generic_password, **{"service_name": service_name, "account_name": account_name})
 
+    @unittest.skipIf(isinstance(Security.lib, StandInSecurity) or Security.lib is None, "requires a real login keychain")
     def test_find_internet_password(self):
         keychain = Keychain()
         i = keychain.find_internet_password(server_name="connect.apple.com")
-        self.failIfEqual(i, None)
+        self.assertNotEqual(i, None)
 
     def test_add_and_remove_internet_password(self):
         import uuid
@@ -67,7 +87,7 @@ class KeychainTests(unittest.TestCase):
         i = InternetPassword(**kwargs)
         k.add(i)
 
-        self.assertEquals(i.password, k.find_internet_password(server_name=kwargs['server_name'], account_name=kwargs['account_name']).password)
+        self.assertEqual(i.password.encode("utf-8"), k.find_internet_password(server_name=kwargs['server_name'], account_name=kwargs['account_name']).password)
 
         k.remove(i)
         self.assertRaises(KeyError, k.find_internet_password, **{"server_name": kwargs['server_name'], "account_name": kwargs['account_name']})
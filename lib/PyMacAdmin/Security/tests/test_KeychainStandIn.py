@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin import Security
+from PyMacAdmin.Security import Keychain
+from PyMacAdmin.Security.Keychain import GenericPassword, InternetPassword
+from PyMacAdmin.Security.StandIn import StandInSecurity
+
+def attributes(**kwargs):
+    tags = dict(GenericPassword.ATTRIBUTES + InternetPassword.ATTRIBUTES)
+    return dict((Keychain.attribute_tag(tags[k]), Keychain.encode_attribute(k, v)) for k, v in kwargs.items())
+
+GENP = Security.kSecGenericPasswordItemClass.value
+INET = Security.kSecInternetPasswordItemClass.value
+
+def stand_in(items):
+    """Returns a StandInSecurity holding items, as (item class, {tag: bytes}, password)"""
+    lib = StandInSecurity()
+    for item in items:
+        lib.insert(*item)
+    return lib
+
+class KeychainSearchTests(unittest.TestCase):
+    """Unit tests for Keychain searches and lazy items"""
+
+    def setUp(self):
+        self.lib      = stand_in([
+            (GENP, attributes(account_name="linksys", label="AirPort"), b"secret1"),
+            (GENP, attributes(account_name="corp", label="AirPort"), b"secret2"),
+            (GENP, attributes(account_name="corp", label="VPN"), b"secret3"),
+            (INET, attributes(server_name="example.com", port=8080, protocol_type="http"), b"secret4"),
+        ])
+        self.real_lib = Security.use_backend(self.lib)
+        self.keychain = Keychain.Keychain()
+
+    def tearDown(self):
+        Security.use_backend(self.real_lib)
+
+    def test_search(self):
+        items = list(self.keychain.search(label="AirPort"))
+        self.assertEqual([i.account_name for i in items], ["linksys", "corp"])
+        self.assertEqual(self.lib.refs[items[0].keychain_item.value], ("item", 1))
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 2)
+        self.assertEqual((self.lib.open_refs("search"), self.lib.allocations), ([], {}))
+
+        # Passwords are copied when they're first used:
+        self.assertEqual(items[1].password, b"secret2")
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 3)
+
+    def test_search_without_prefetch(self):
+        items = list(self.keychain.search(prefetch=False, label="AirPort"))
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 0)
+        self.assertEqual(items[0].label, "AirPort")
+        self.assertEqual(items[0].account_name, "linksys")
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 1)
+
+    def test_search_with_password(self):
+        items = list(self.keychain.search(GenericPassword, with_password=True, account_name="corp"))
+        self.assertEqual([(i.label, i.password) for i in items], [("AirPort", b"secret2"), ("VPN", b"secret3")])
+        self.assertEqual(self.lib.allocations, {})
+
+    def test_search_internet_passwords(self):
+        items = list(self.keychain.search(InternetPassword, port=8080))
+        self.assertEqual(len(items), 1)
+        self.assertEqual((items[0].server_name, items[0].port, items[0].protocol_type), ("example.com", 8080, "http"))
+        self.assertEqual(items[0].authentication_type, None)
+
+    def test_lazy_iteration(self):
+        search = self.keychain.search()
+        next(search)
+        self.assertEqual(self.lib.calls["SecKeychainSearchCopyNext"], 1)
+        search.close()
+        self.assertEqual(self.lib.open_refs("search"), [])
+
+    def test_no_matches(self):
+        self.assertEqual(list(self.keychain.search(account_name="missing")), [])
+
+    def test_find_generic_password(self):
+        item = self.keychain.find_generic_password(account_name="corp")
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 0)
+        self.assertEqual(item.account_name, "corp")
+        self.assertEqual(item.service_name, "")
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 1)
+        self.assertEqual(item.label, "AirPort")
+        self.assertEqual(item.password, b"secret2")
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 2)
+        self.assertEqual(item.password, b"secret2")
+        self.assertEqual(self.lib.allocations, {})
+
+    def test_find_generic_password_prefetch(self):
+        item = self.keychain.find_generic_password(account_name="linksys", prefetch=True)
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 1)
+        self.assertEqual((item.label, item.password), ("AirPort", b"secret1"))
+        self.assertEqual(self.lib.calls["SecKeychainItemCopyAttributesAndData"], 1)
+        self.assertEqual(self.lib.allocations, {})
+
+    def test_find_missing_generic_password(self):
+        self.assertRaises(KeyError, self.keychain.find_generic_password, account_name="missing")
+
+    def test_unknown_attribute(self):
+        self.assertRaises(AttributeError, list, self.keychain.search(server_name="example.com"))
+
+class KeychainBatchTests(unittest.TestCase):
+    """Unit tests for batches of keychain changes"""
+
+    def setUp(self):
+        self.lib      = stand_in([
+            (GENP, attributes(account_name="linksys", service_name="AirPort"), b"old1"),
+            (GENP, attributes(account_name="corp", service_name="AirPort"), b"old2"),
+            (INET, attributes(account_name="admin", server_name="example.com", protocol_type="http"), b"old3"),
+        ])
+        self.real_lib = Security.use_backend(self.lib)
+        self.keychain = Keychain.Keychain()
+
+    def tearDown(self):
+        Security.use_backend(self.real_lib)
+
+    def passwords(self):
+        return sorted(self.lib.db.execute(
+            "SELECT value, data FROM items JOIN attributes ON item = id WHERE tag = ?",
+            (Security.kSecAccountItemAttr.value,)))
+
+    def test_batch(self):
+        results = self.keychain.batch(
+            upserts=[
+                GenericPassword(service_name="AirPort", account_name="linksys", password="new1"),
+                GenericPassword(service_name="AirPort", account_name="guest", password="new4"),
+                InternetPassword(server_name="example.com", account_name="admin", protocol_type="http", password="new3"),
+            ],
+            deletes=[
+                GenericPassword(service_name="AirPort", account_name="corp"),
+                GenericPassword(service_name="AirPort", account_name="missing"),
+            ]
+        )
+        self.assertEqual([r.action for r in results], ["update", "add", "update", "delete", "delete"])
+        self.assertEqual([r.ok for r in results], [True, True, True, True, False])
+        self.assertTrue(isinstance(results[4].error, KeyError))
+        self.assertEqual(self.passwords(), [(b"admin", b"new3"), (b"guest", b"new4"), (b"linksys", b"new1")])
+
+    def test_atomic_rollback(self):
+        self.lib.failures["corp"] = -61
+        upserts = [
+            GenericPassword(service_name="AirPort", account_name="linksys", password="new1"),
+            GenericPassword(service_name="AirPort", account_name="guest", password="new4"),
+            GenericPassword(service_name="AirPort", account_name="corp", password="new2"),
+            GenericPassword(service_name="AirPort", account_name="other", password="new5"),
+        ]
+        deletes = [GenericPassword(service_name="AirPort", account_name="linksys")]
+        before  = self.passwords()
+
+        try:
+            self.keychain.batch(upserts, deletes, atomic=True)
+            self.fail("BatchError was not raised")
+        except Keychain.BatchError as exc:
+            results = exc.results
+
+        self.assertEqual(self.passwords(), before)
+        self.assertEqual([r.action for r in results], ["update", "add", "update", "upsert", "delete"])
+        self.assertEqual([r.rolled_back for r in results], [True, True, False, False, False])
+        self.assertEqual([r.skipped for r in results], [False, False, False, True, True])
+        self.assertEqual(upserts[1].keychain_item, None)
+
+    def test_atomic_delete_restores_item(self):
+        self.lib.failures["corp"] = -61
+        deletes = [
+            GenericPassword(service_name="AirPort", account_name="linksys"),
+            GenericPassword(service_name="AirPort", account_name="corp"),
+        ]
+        self.assertRaises(Keychain.BatchError, self.keychain.batch, deletes=deletes, atomic=True)
+        self.assertEqual(self.keychain.find_generic_password("AirPort", "linksys").password, b"old1")
+
+    def test_atomic_delete_restores_label(self):
+        self.keychain.find_generic_password("AirPort", "linksys").modify_attributes(label="Home")
+        self.lib.failures["corp"] = -61
+        deletes = [
+            GenericPassword(service_name="AirPort", account_name="linksys"),
+            GenericPassword(service_name="AirPort", account_name="corp"),
+        ]
+        self.assertRaises(Keychain.BatchError, self.keychain.batch, deletes=deletes, atomic=True)
+        self.assertEqual(self.keychain.find_generic_password("AirPort", "linksys").label, "Home")
+
+    def test_atomic_rollback_on_missing_password(self):
+        upserts = [
+            GenericPassword(service_name="AirPort", account_name="linksys", password="new1"),
+            GenericPassword(service_name="AirPort", account_name="corp"),
+        ]
+        before  = self.passwords()
+
+        try:
+            self.keychain.batch(upserts, atomic=True)
+            self.fail("BatchError was not raised")
+        except Keychain.BatchError as exc:
+            results = exc.results
+
+        self.assertEqual(self.passwords(), before)
+        self.assertTrue(isinstance(results[1].error, TypeError))
+        self.assertTrue(results[0].rolled_back)
+
+    def test_update_password_rejects_none(self):
+        item = self.keychain.find_generic_password("AirPort", "linksys")
+        self.assertRaises(TypeError, item.update_password, None)
+        self.assertTrue((b"linksys", b"old1") in self.passwords())
+
+class KeychainHandleCacheTests(unittest.TestCase):
+    """Unit tests for sharing keychain handles"""
+
+    def setUp(self):
+        self.lib              = StandInSecurity()
+        self.real_lib         = Security.use_backend(self.lib)
+        self.real_cache       = Keychain.HANDLE_CACHE
+        Keychain.HANDLE_CACHE = self.cache = Keychain.KeychainHandleCache()
+        self.tmp_dir          = tempfile.mkdtemp()
+        self.path             = os.path.join(self.tmp_dir, "test.keychain")
+        open(self.path, "w").close()
+
+    def tearDown(self):
+        Security.use_backend(self.real_lib)
+        Keychain.HANDLE_CACHE = self.real_cache
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reuse(self):
+        for i in range(3):
+            with Keychain.Keychain(self.path) as keychain:
+                self.assertEqual(self.lib.refs[keychain.keychain_handle.value], ("keychain", self.path))
+        self.assertEqual(self.lib.calls["SecKeychainOpen"], 1)
+        self.assertEqual(self.cache.stats(), {'open': 1, 'in_use': 0, 'opens': 1, 'closes': 0, 'hits': 2})
+
+        self.assertEqual(self.cache.purge(), 1)
+        self.assertEqual(self.lib.open_refs("keychain"), [])
+        self.assertEqual(self.cache.stats()['closes'], 1)
+
+    def test_purge_skips_handles_in_use(self):
+        keychain = Keychain.Keychain(self.path)
+        self.assertEqual(self.cache.purge(self.path), 0)
+        keychain.close()
+        self.assertEqual(self.cache.purge(self.path), 1)
+
+    def test_closed(self):
+        keychain = Keychain.Keychain(self.path)
+        keychain.close()
+        self.assertRaises(ValueError, keychain.find_generic_password, account_name="corp")
+        self.assertRaises(ValueError, self.cache.release, self.path)
+
+    def test_default_keychain(self):
+        with Keychain.Keychain() as keychain:
+            self.assertEqual(keychain.keychain_handle, None)
+        self.assertEqual(self.cache.stats()['opens'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import ctypes
+import ctypes.util
+import unittest
+
+import PyMacAdmin
+
+# Any C library will do to test the loader; libc is available everywhere:
+LIBC = ctypes.util.find_library("c")
+
+@unittest.skipUnless(LIBC, "requires the C library")
+class LoadCarbonFrameworkTests(unittest.TestCase):
+    """Unit tests for load_carbon_framework"""
+
+    def setUp(self):
+        self.libc = PyMacAdmin.load_carbon_framework(LIBC, {
+            'atoi': (ctypes.c_int32, [ctypes.c_char_p]),
+            'labs': (ctypes.c_long, [ctypes.c_long]),
+        })
+
+    def test_prototyped_functions_are_attributes(self):
+        self.assertTrue('atoi' in vars(self.libc))
+        self.assertEqual(self.libc.atoi.argtypes, [ctypes.c_char_p])
+
+    def test_error_checking(self):
+        self.assertEqual(self.libc.atoi(b"42"), 42)
+        self.assertRaises(KeyError, self.libc.atoi, b"-25300")
+        self.assertRaises(RuntimeError, self.libc.atoi, b"-1")
+
+    def test_other_restypes_are_not_checked(self):
+        self.assertEqual(self.libc.labs(-2 ** 40), 2 ** 40)
+
+    def test_argtypes(self):
+        self.assertRaises(ctypes.ArgumentError, self.libc.atoi, 42)
+
+    def test_unprototyped_functions(self):
+        self.assertEqual(self.libc.abs(-3), 3)
+
+if __name__ == '__main__':
+    unittest.main()
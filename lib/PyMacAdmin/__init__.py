@@ -30,20 +30,36 @@ def checked_carbon_call(rc, func, args):
         else:
             exc_class = RuntimeError
 
-        raise exc_class("%s(%s) returned %d: %s" % (func.__name__, map(repr, args), rc, mac_strerror(rc)))
+        raise exc_class("%s(%s) returned %d: %s" % (func.__name__, ", ".join(map(repr, args)), rc, mac_strerror(rc)))
     return rc
 
-def load_carbon_framework(f_path):
+def load_carbon_framework(f_path, prototypes=None):
     """
     Load a Carbon framework using ctypes.CDLL and add an errcheck wrapper to
     replace traditional errno-style error checks with exception handling.
 
+    prototypes is an optional dict of {function name: (restype, argtypes)}.
+    Those functions are resolved and declared once, when the framework is
+    loaded, and set as plain attributes of the returned CDLL so calls skip
+    the lookup and ctypes converts their arguments to the declared types.
+    Functions returning OSStatus (ctypes.c_int32) get checked_carbon_call
+    as their errcheck; the others, e.g. CFRelease, return their result.
+    Any other function is resolved, and checked, on first use as before.
+
     Example:
     >>> load_carbon_framework('/System/Library/Frameworks/Security.framework/Versions/Current/Security') # doctest: +ELLIPSIS
     <CDLL '/System/Library/Frameworks/Security.framework/Versions/Current/Security', handle ... at ...>
     """
     framework = ctypes.cdll.LoadLibrary(f_path)
 
+    for name, (restype, argtypes) in (prototypes or {}).items():
+        func          = framework[name]
+        func.restype  = restype
+        func.argtypes = argtypes
+        if restype is ctypes.c_int32:
+            func.errcheck = checked_carbon_call
+        setattr(framework, name, func)
+
     # TODO: Do we ever need to wrap framework.__getattr__ too?
     old_getitem = framework.__getitem__
     @wraps(old_getitem)
@@ -55,4 +71,3 @@ def load_carbon_framework(f_path):
     framework.__getitem__ = new_getitem
 
     return framework
-
@@ -19,5 +19,10 @@ def not_implemented(*args, **kwargs):
         )
     )
 
-from . import handlers
-sys.modules[handlers.__name__] = handlers
\ No newline at end of file
+# The handlers require PyObjC but the dispatch code does not, which allows it to
+# be tested and benchmarked on systems without Cocoa:
+try:
+    from . import handlers
+    sys.modules[handlers.__name__] = handlers
+except ImportError:
+    handlers = None
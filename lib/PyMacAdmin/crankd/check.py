@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Validates and profiles a crankd configuration without starting crankd.
+
+crankd only finds most configuration errors while starting, after PyObjC
+has loaded and some handlers have already been registered. This checks a
+configuration on any system, e.g. in CI:
+
+  python3 -m PyMacAdmin.crankd.check crankd.plist
+  python3 -m PyMacAdmin.crankd.check --no-import --json crankd.plist
+
+It reports:
+
+- structural errors: events without exactly one handler, invalid options,
+  invalid regular expressions and unknown sections
+- handlers, imports and NSWorkspace handler classes which can't be resolved
+  (skipped with --no-import, for handler modules which need macOS)
+- FSEvents paths which don't exist or overlap, so that one change fires
+  several handlers
+- redundant SystemConfiguration patterns: equivalent patterns, patterns
+  which make another one fire the same handler twice and regular expressions
+  which are shadowed by an exact key
+- the estimated dispatch cost per event, from the pattern counts and a
+  timed sample of lookups
+
+The exit status is 1 if there are any errors.
+"""
+
+import importlib
+import json
+import optparse
+import os
+import plistlib
+import re
+import sys
+import time
+
+from PyMacAdmin.crankd import core
+from PyMacAdmin.crankd import dispatch
+from PyMacAdmin.crankd import metrics
+
+ERROR = "error"
+WARNING = "warning"
+
+SECTIONS = ("NSWorkspace", "SystemConfiguration", "FSEvents")
+SETTINGS = ("imports", "Executor", "Checkpoint", "Launcher", "Metrics")
+HANDLER_TYPES = ("command", "function", "class", "method")
+
+
+def is_number(value):
+  """Returns True for ints and floats, but not bools, which are also ints."""
+  return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_integer(value):
+  """Returns True for ints, but not bools."""
+  return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Event options and a test for valid values:
+OPTIONS = {
+    "debounce": lambda v: is_number(v) and v >= 0,
+    "max_latency": lambda v: is_number(v) and v >= 0,
+    "timeout": lambda v: is_number(v) and v > 0,
+    "concurrency": lambda v: is_integer(v) and v >= 1,
+    "max_pending": lambda v: is_integer(v) and v >= 0,
+    "async": lambda v: isinstance(v, bool),
+}
+
+# Tests for the settings sections, as {section: {setting: test}}:
+SETTING_OPTIONS = {
+    "Executor": {
+        "threads": lambda v: is_integer(v) and v >= 1,
+        "processes": lambda v: is_integer(v) and v >= 1,
+    },
+    "Checkpoint": {
+        "path": lambda v: isinstance(v, str),
+        "interval": lambda v: is_number(v) and v >= 0,
+        "max_catchup": lambda v: is_integer(v) and v >= 0,
+    },
+    "Launcher": {
+        "shell": lambda v: isinstance(v, str) and os.path.isabs(v),
+    },
+    "Metrics": {
+        "path": lambda v: isinstance(v, str),
+        "format": lambda v: v in metrics.FORMATS,
+        "interval": lambda v: is_number(v) and v > 0,
+    },
+}
+
+# The most patterns whose sample keys are timed by estimate_sc_cost:
+MAX_SAMPLED_PATTERNS = 5000
+
+
+class Report(object):
+  """The problems found in a configuration and its estimated costs."""
+
+  def __init__(self):
+    self.problems = list()
+    self.costs = dict()
+
+  def add(self, level, section, key, message):
+    self.problems.append({
+        "level": level,
+        "section": section,
+        "key": key,
+        "message": message
+    })
+
+  def error(self, section, key, message):
+    self.add(ERROR, section, key, message)
+
+  def warning(self, section, key, message):
+    self.add(WARNING, section, key, message)
+
+  @property
+  def errors(self):
+    return [p for p in self.problems if p["level"] == ERROR]
+
+  def as_dict(self):
+    return {"problems": self.problems, "costs": self.costs}
+
+  def format(self):
+    lines = list()
+    for p in self.problems:
+      where = p["section"] if p["key"] is None else "%(section)s %(key)s" % p
+      lines.append("%s: %s: %s" % (p["level"], where, p["message"]))
+    for section, cost in sorted(self.costs.items()):
+      lines.append("%s: %s" % (section, cost["summary"]))
+    lines.append("%d error(s), %d warning(s)" %
+                 (len(self.errors), len(self.problems) - len(self.errors)))
+    return "\n".join(lines)
+
+
+def normalize_pattern(pattern):
+  """Returns an equivalent pattern for comparing SystemConfiguration patterns.
+
+  crankd uses re.match, so a leading ^ and a trailing .* change nothing:
+
+  >>> normalize_pattern("^State:/Network/Global/.*")
+  'State:/Network/Global/'
+  """
+  if pattern.startswith("^"):
+    pattern = pattern[1:]
+  while pattern.endswith(".*") and not pattern.endswith("\\.*"):
+    pattern = pattern[:-2]
+  return pattern
+
+
+def check_handler(report, section, key, event_config, resolve=True):
+  """Checks one event's handler and options."""
+  if not isinstance(event_config, dict):
+    report.error(section, key, "must be a dictionary")
+    return
+
+  handler_types = [t for t in HANDLER_TYPES if t in event_config]
+  if len(handler_types) != 1:
+    report.error(section, key, "must have exactly one of %s" %
+                 ", ".join(HANDLER_TYPES))
+    return
+
+  for option, valid in OPTIONS.items():
+    if option in event_config and not valid(event_config[option]):
+      report.error(section, key, "invalid %s: %r" %
+                   (option, event_config[option]))
+
+  handler_type = handler_types[0]
+  value = event_config[handler_type]
+
+  if handler_type == "class" and section != "NSWorkspace":
+    report.error(section, key, "class handlers are only supported for "
+                 "NSWorkspace notifications")
+    return
+
+  if handler_type == "method" and (not isinstance(value, (list, tuple)) or
+                                   len(value) != 2):
+    report.error(section, key, "method must be a (class, method) list")
+    return
+
+  if handler_type == "command" or not resolve:
+    return
+
+  try:
+    if handler_type == "function":
+      obj = core.get_callable_from_string(value)
+      if not callable(obj):
+        report.error(section, key, "%s is not callable" % value)
+    elif handler_type == "method":
+      cls = core.get_callable_from_string(value[0])
+      if not callable(getattr(cls, value[1], None)):
+        report.error(section, key,
+                     "%s has no method %s" % (value[0], value[1]))
+    else:
+      cls = core.get_callable_from_string(value)
+      method = "on%s_" % key
+      if not callable(getattr(cls, method, None)):
+        report.error(section, key, "handler class %s must define a %s method" %
+                     (value, method))
+  except RuntimeError as exc:
+    report.error(section, key, str(exc))
+
+
+def check_settings(report, config, resolve=True):
+  """Checks the sections which configure crankd rather than events."""
+  for section in config:
+    if section not in SECTIONS and section not in SETTINGS:
+      report.warning(section, None, "unknown section")
+
+  if resolve:
+    for module in config.get("imports", []):
+      try:
+        importlib.import_module(module)
+      except ImportError as exc:
+        report.error("imports", module, "unable to import: %s" % exc)
+
+  for section, tests in SETTING_OPTIONS.items():
+    if section not in config:
+      continue
+    if not isinstance(config[section], dict):
+      report.error(section, None, "must be a dictionary")
+      continue
+    for setting, value in config[section].items():
+      if setting not in tests:
+        report.warning(section, setting, "unknown setting")
+      elif not tests[setting](value):
+        report.error(section, setting, "invalid value %r" % (value,))
+
+  if "Metrics" in config and "path" not in config["Metrics"]:
+    report.error("Metrics", None, "must have a path")
+
+
+def check_sc(report, sc_config):
+  """Checks SystemConfiguration patterns and estimates their dispatch cost."""
+  section = "SystemConfiguration"
+  valid = dict()
+  for pattern in sc_config:
+    try:
+      re.compile(pattern)
+      valid[pattern] = sc_config[pattern]
+    except re.error as exc:
+      report.error(section, pattern, "invalid regular expression: %s" % exc)
+
+  exact = [p for p in valid if dispatch.REGEX_METACHARACTERS.isdisjoint(p)]
+  regexes = [p for p in valid if p not in exact]
+
+  # Equivalent patterns:
+  seen = dict()
+  for pattern in valid:
+    normalized = normalize_pattern(pattern)
+    if normalized in seen:
+      report.warning(section, pattern, "is equivalent to %s" % seen[normalized])
+    else:
+      seen[normalized] = pattern
+
+  # A literal pattern also matches every key which starts with it, so a
+  # pattern whose literal prefix starts with it fires both handlers:
+  literals = dispatch.PrefixTrie()
+  for pattern in exact:
+    literals.add(pattern, pattern)
+  for pattern in valid:
+    prefix = dispatch.literal_prefix(normalize_pattern(pattern))
+    for literal in literals.prefixes_of(prefix):
+      if literal == pattern or normalize_pattern(pattern) == literal:
+        continue
+      if valid[literal] == valid[pattern]:
+        report.warning(section, pattern, "keys it matches also fire %s, which "
+                       "calls the same handler" % literal)
+
+  # Exact keys win, so a regex never fires for them:
+  for pattern in regexes:
+    compiled = re.compile(pattern)
+    shadowed = sorted(k for k in exact if compiled.match(k))
+    if shadowed:
+      more = " and %d more" % (len(shadowed) - 3) if len(shadowed) > 3 else ""
+      report.warning(section, pattern, "never fires for %s%s, which have their "
+                     "own handlers" % (", ".join(shadowed[:3]), more))
+
+  report.costs[section] = estimate_sc_cost(valid)
+
+
+def sample_keys(patterns):
+  """Returns keys likely to exercise each pattern, plus an unmatched key.
+
+  >>> sample_keys(["State:/Users/.*"])
+  ['State:/Users/en0/Link', 'State:/Users/check/unmatched', \
+'State:/crankd/check/unmatched']
+  """
+  keys = list()
+  for pattern in list(patterns)[:MAX_SAMPLED_PATTERNS]:
+    prefix = dispatch.literal_prefix(pattern)
+    keys.append(pattern if prefix == pattern else prefix + "en0/Link")
+    keys.append(prefix + "check/unmatched")
+  keys.append("State:/crankd/check/unmatched")
+  return keys
+
+
+def estimate_sc_cost(sc_config, clock=time.monotonic):
+  """Returns the SystemConfiguration dispatch cost estimate as a dict."""
+  index = dispatch.SCDispatchIndex(dict((k, k) for k in sc_config))
+  regexes = sum(
+      1 for p in sc_config if not dispatch.REGEX_METACHARACTERS.isdisjoint(p))
+  unprefixed = sum(1 for p in sc_config
+                   if not dispatch.REGEX_METACHARACTERS.isdisjoint(p) and
+                   not dispatch.literal_prefix(p))
+
+  keys = sample_keys(sc_config)
+  start = clock()
+  for key in keys:
+    index.cache.clear()
+    index.lookup(key)
+  per_lookup = (clock() - start) / len(keys)
+
+  cost = {
+      "patterns": len(sc_config),
+      "exact": len(sc_config) - regexes,
+      "regexes": regexes,
+      "regexes_without_prefix": unprefixed,
+      "combined_prefilter": index.combined is not None,
+      "uncached_lookup_us": per_lookup * 1e6,
+      # Without the index every pattern is tried for every changed key:
+      "linear_matches_per_key": len(sc_config),
+  }
+  cost["summary"] = (
+      "%(patterns)d patterns (%(exact)d exact, %(regexes)d regular "
+      "expressions, %(regexes_without_prefix)d without a literal prefix); "
+      "~%(uncached_lookup_us)0.1fus per uncached key lookup versus "
+      "%(linear_matches_per_key)d re.match calls without the index" % cost)
+  return cost
+
+
+def check_fs(report, fs_config):
+  """Checks FSEvents paths for existence and overlap."""
+  section = "FSEvents"
+  trie = dispatch.PathTrie()
+  watched = dict()
+
+  for path in fs_config:
+    real = os.path.realpath(os.path.expanduser(path))
+    if not os.path.exists(real):
+      report.error(section, path, "does not exist")
+      continue
+    if not os.path.isdir(real):
+      real = os.path.dirname(real)
+      report.warning(section, path, "is a file: every change in %s will fire "
+                     "its handler" % real)
+    if real in watched:
+      report.warning(section, path, "watches the same directory as %s" %
+                     watched[real])
+    watched.setdefault(real, path)
+    trie.add(real, path)
+
+  depth = 0
+  for real, path in sorted(watched.items()):
+    # Paths watching the same directory were reported above:
+    ancestors = [p for directory, paths in trie.ancestors(real) for p in paths
+                 if directory != real]
+    depth = max(depth, len(trie.split(real)))
+    if ancestors:
+      report.warning(section, path, "is inside %s, so changes fire both "
+                     "handlers" % ", ".join(sorted(ancestors)))
+
+  report.costs[section] = {
+      "paths": len(fs_config),
+      "directories": len(watched),
+      "max_depth": depth,
+      "summary": "%d watched directories; each event walks at most %d path "
+                 "components" % (len(watched), depth),
+  }
+
+
+def check_config(config, resolve=True):
+  """Checks a configuration and returns a Report.
+
+  Args:
+    config: dict, the configuration
+    resolve: bool, import and check handlers
+  """
+  report = Report()
+  if not isinstance(config, dict):
+    report.error("configuration", None, "must be a dictionary")
+    return report
+
+  check_settings(report, config, resolve=resolve)
+
+  for section in SECTIONS:
+    section_config = config.get(section, {})
+    if not isinstance(section_config, dict):
+      report.error(section, None, "must be a dictionary")
+      continue
+    for key, event_config in section_config.items():
+      check_handler(report, section, key, event_config, resolve=resolve)
+
+  if isinstance(config.get("SystemConfiguration"), dict):
+    check_sc(report, config["SystemConfiguration"])
+  if isinstance(config.get("FSEvents"), dict):
+    check_fs(report, config["FSEvents"])
+  return report
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(
+      "Usage: %prog [--no-import] [--json] CONFIG_FILE")
+  parser.add_option("--no-import", action="store_false", dest="resolve",
+                    default=True, help="Don't import handler modules")
+  parser.add_option("--json", action="store_true", default=False,
+                    help="Print the report as JSON")
+  (options, args) = parser.parse_args(argv)
+
+  if len(args) != 1:
+    parser.error("A configuration file is required")
+
+  try:
+    with open(args[0], "rb") as f:
+      config = plistlib.load(f)
+  except (OSError, ValueError, plistlib.InvalidFileException) as exc:
+    print("error: unable to read %s: %s" % (args[0], exc), file=sys.stderr)
+    return 1
+
+  report = check_config(config, resolve=options.resolve)
+
+  if options.json:
+    json.dump(report.as_dict(), sys.stdout, indent=2, sort_keys=True)
+    print()
+  else:
+    print(report.format())
+  return 1 if report.errors else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,160 @@
+# encoding: utf-8
+"""Persistent FSEvents event ID checkpoints.
+
+crankd restarts itself whenever its configuration or code changes. Without a
+checkpoint the new process only sees FSEvents which happen after it starts,
+so anything which changed during the restart is silently missed. With a
+"Checkpoint" section in the configuration the ID of the last dispatched event
+is periodically written to disk and the next FSEvents stream starts from it:
+
+  <key>Checkpoint</key>
+  <dict>
+    <key>path</key>
+    <string>/var/db/crankd-fsevents.checkpoint</string>
+    <key>interval</key>
+    <real>30</real>
+    <key>max_catchup</key>
+    <integer>10000</integer>
+  </dict>
+
+FSEvents then replays the historical events through the normal dispatch path
+before sending kFSEventStreamEventFlagHistoryDone. If more than max_catchup
+historical events arrive, the rest are discarded and every watched path is
+dispatched once with recursive=True instead, as FSEvents itself does when it
+has dropped events.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+# From <CoreServices/FSEvents.h>, so this module can be used without PyObjC:
+FLAG_MUST_SCAN_SUBDIRS = 0x00000001
+FLAG_USER_DROPPED = 0x00000002
+FLAG_KERNEL_DROPPED = 0x00000004
+FLAG_EVENT_IDS_WRAPPED = 0x00000008
+FLAG_HISTORY_DONE = 0x00000010
+
+# Actions returned by Checkpoint.observe()
+DISPATCH = "dispatch"
+SKIP = "skip"
+RESCAN = "rescan"
+
+DEFAULT_INTERVAL = 30.0
+DEFAULT_MAX_CATCHUP = 10000
+
+
+class Checkpoint(object):
+  """Tracks the last FSEvents event ID and saves it atomically."""
+
+  def __init__(self, path, interval=DEFAULT_INTERVAL,
+               max_catchup=DEFAULT_MAX_CATCHUP, clock=time.monotonic):
+    """Creates a Checkpoint.
+
+    Args:
+      path: str, file used to store the event ID
+      interval: float, minimum seconds between writes
+      max_catchup: int or None, the number of historical events which will be
+        dispatched individually after resuming
+      clock: optional callable returning the current time in seconds
+    """
+    self.path = path
+    self.interval = interval
+    self.max_catchup = max_catchup
+    self.clock = clock
+
+    self.last_id = None
+    self.saved_id = None
+    self.last_save = clock()
+
+    self.catching_up = False
+    self.catchup_events = 0
+    self.overflowed = False
+
+  def load(self):
+    """Returns the stored event ID or None if there isn't a usable one."""
+    try:
+      with open(self.path) as f:
+        event_id = int(json.load(f)["event_id"])
+    except (OSError, IOError, ValueError, KeyError, TypeError) as exc:
+      if os.path.exists(self.path):
+        logging.warning("Ignoring unreadable checkpoint %s: %s", self.path, exc)
+      return None
+    return event_id if event_id > 0 else None
+
+  def resume_id(self):
+    """Returns the event ID to start a stream from, or None for "now"."""
+    event_id = self.load()
+    if event_id is not None:
+      logging.info("Resuming FSEvents after event %d", event_id)
+      self.last_id = self.saved_id = event_id
+      self.catching_up = True
+      self.catchup_events = 0
+      self.overflowed = False
+    return event_id
+
+  def observe(self, event_id, flags):
+    """Records an event and returns what should be done with it.
+
+    Args:
+      event_id: int, the FSEventStreamEventId
+      flags: int, the FSEventStreamEventFlags
+
+    Returns:
+      DISPATCH, SKIP or RESCAN
+    """
+    if flags & FLAG_EVENT_IDS_WRAPPED:
+      self.last_id = None
+
+    if event_id and (self.last_id is None or event_id > self.last_id):
+      self.last_id = event_id
+
+    if flags & FLAG_HISTORY_DONE:
+      if self.catching_up:
+        logging.info("Caught up with %d historical FSEvents",
+                     self.catchup_events)
+      self.catching_up = False
+      return SKIP
+
+    if not self.catching_up:
+      return DISPATCH
+
+    self.catchup_events += 1
+    if self.max_catchup is None or self.catchup_events <= self.max_catchup:
+      return DISPATCH
+
+    if not self.overflowed:
+      logging.warning("More than %d FSEvents occurred while crankd was not "
+                      "running: rescanning all watched paths instead",
+                      self.max_catchup)
+      self.overflowed = True
+      return RESCAN
+    return SKIP
+
+  def maybe_save(self):
+    """Saves the checkpoint if interval seconds have passed since the last."""
+    if self.clock() - self.last_save >= self.interval:
+      self.save()
+
+  def save(self):
+    """Atomically writes the last event ID to disk."""
+    self.last_save = self.clock()
+    if self.last_id is None or self.last_id == self.saved_id:
+      return
+
+    directory = os.path.dirname(self.path) or "."
+    tmp_name = None
+    try:
+      fd, tmp_name = tempfile.mkstemp(dir=directory, prefix=".checkpoint-")
+      with os.fdopen(fd, "w") as f:
+        json.dump({"event_id": self.last_id, "saved": time.time()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_name, self.path)
+      self.saved_id = self.last_id
+    except (OSError, IOError) as exc:
+      logging.error("Unable to save FSEvents checkpoint %s: %s", self.path, exc)
+      if tmp_name is not None and os.path.exists(tmp_name):
+        os.unlink(tmp_name)
@@ -0,0 +1,178 @@
+# encoding: utf-8
+"""Coalescing of bursts of events into a single handler invocation.
+
+A software install can generate thousands of FSEvents and a network change
+dozens of SystemConfiguration keys. Handlers configured with "debounce" or
+"max_latency" are wrapped in a Coalescer, which collects events and calls the
+handler once when no event has arrived for debounce seconds or the oldest
+pending event is max_latency seconds old, whichever comes first:
+
+  <key>/Library/Managed Preferences</key>
+  <dict>
+    <key>command</key>
+    <string>/usr/local/sbin/refresh-mcx</string>
+    <key>debounce</key>
+    <real>2.0</real>
+    <key>max_latency</key>
+    <real>30</real>
+  </dict>
+
+The merged call receives the arguments of the most recent event plus "paths"
+and "keys" lists of every distinct path and key seen in the burst (shell
+commands get these as the newline-separated CRANKD_PATHS and CRANKD_KEYS
+environment variables) and "coalesced", the number of events it represents.
+"recursive" is true if it was for any event in the burst, so a required
+rescan of subdirectories is never lost.
+"""
+
+import logging
+import time
+
+# Used when a handler sets debounce but not max_latency so a continuous storm
+# of events can't postpone the handler indefinitely:
+DEFAULT_MAX_LATENCY = 10.0
+
+# Bounds for how often the run loop should check for due handlers:
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+
+class Coalescer(object):
+  """Wraps a callable, merging calls which arrive in quick succession.
+
+  Calls are buffered until flush() is called after the coalescing window has
+  closed; crankd calls flush() for every Coalescer from a run loop timer.
+  """
+
+  def __init__(self, callback, name=None, debounce=0.0, max_latency=None,
+               clock=time.monotonic):
+    """Creates a Coalescer.
+
+    Args:
+      callback: callable to invoke with the merged event
+      name: optional str used for logging
+      debounce: float, seconds without new events before callback fires
+      max_latency: optional float, maximum seconds an event can be delayed
+      clock: optional callable returning the current time in seconds
+
+    Raises:
+      ValueError: if debounce or max_latency are negative
+    """
+    debounce = float(debounce or 0)
+    if max_latency is None:
+      max_latency = max(debounce, DEFAULT_MAX_LATENCY)
+    max_latency = float(max_latency)
+
+    if debounce < 0 or max_latency < 0:
+      raise ValueError("%s: debounce and max_latency must not be negative" %
+                       name)
+
+    self.callback = callback
+    self.name = name or repr(callback)
+    self.debounce = debounce
+    self.max_latency = max(max_latency, debounce)
+    self.clock = clock
+
+    # Counters for the lifetime of this handler:
+    self.events = 0
+    self.delivered = 0
+    self.invocations = 0
+
+    self._reset()
+
+  def _reset(self):
+    self.first_event = None
+    self.last_event = None
+    self.pending = 0
+    self.args = ()
+    self.kwargs = dict()
+    self.paths = list()
+    self.keys = list()
+    self.recursive = False
+    self._seen = set()
+
+  @property
+  def collapsed(self):
+    """Returns the number of events merged into another's invocation."""
+    return self.delivered - self.invocations
+
+  def stats(self):
+    return {
+        "events": self.events,
+        "invocations": self.invocations,
+        "collapsed": self.collapsed,
+        "pending": self.pending,
+    }
+
+  def __call__(self, *args, **kwargs):
+    now = self.clock()
+
+    if not self.pending:
+      self.first_event = now
+    self.last_event = now
+    self.pending += 1
+    self.events += 1
+
+    self.args = args
+    self.kwargs = kwargs
+    self.recursive = self.recursive or bool(kwargs.get("recursive"))
+
+    for attr, kwarg in (("paths", "path"), ("keys", "key")):
+      value = kwargs.get(kwarg)
+      if value is not None and (attr, value) not in self._seen:
+        self._seen.add((attr, value))
+        getattr(self, attr).append(value)
+
+  def deadline(self):
+    """Returns the time at which the pending events are due or None."""
+    if not self.pending:
+      return None
+    return min(self.last_event + self.debounce,
+               self.first_event + self.max_latency)
+
+  def flush(self, now=None, force=False):
+    """Invokes the callback if the pending events are due.
+
+    Args:
+      now: optional float, the current time according to clock
+      force: bool, invoke the callback for any pending events immediately
+
+    Returns:
+      bool, True if the callback was invoked
+    """
+    deadline = self.deadline()
+    if deadline is None:
+      return False
+
+    if now is None:
+      now = self.clock()
+
+    if not force and now < deadline:
+      return False
+
+    args = self.args
+    kwargs = dict(self.kwargs)
+    kwargs["paths"] = self.paths
+    kwargs["keys"] = self.keys
+    kwargs["coalesced"] = self.pending
+    if self.recursive:
+      kwargs["recursive"] = True
+
+    self.invocations += 1
+    self.delivered += self.pending
+    self._reset()
+
+    if kwargs["coalesced"] > 1:
+      logging.debug("%s: coalesced %d events (%d collapsed so far)", self.name,
+                    kwargs["coalesced"], self.collapsed)
+
+    self.callback(*args, **kwargs)
+    return True
+
+
+def poll_interval(coalescers):
+  """Returns how often, in seconds, the coalescers should be flushed."""
+  windows = [c.debounce for c in coalescers if c.debounce > 0]
+  if not windows:
+    return MIN_POLL_INTERVAL
+  return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, min(windows) / 4))
@@ -0,0 +1,175 @@
+# encoding: utf-8
+"""Cache of parsed crankd configurations.
+
+Generated configurations can have thousands of SystemConfiguration keys and
+parsing the XML plist and building the SCDispatchIndex for them is most of
+crankd's startup time. After the first start, the parsed configuration and
+its index are pickled to a cache file. Later starts, and every restart,
+load them from there while the configuration file is unchanged:
+
+  compiled = configcache.load("crankd.plist", "config.cache")
+  compiled.config      # the configuration dict
+  compiled.sc_index    # dispatch.SCDispatchIndex, to bind() to the handlers
+  compiled.warm        # True if it came from the cache
+
+The cache saves parsing the plist and building the index's tries and table
+of exact keys. It doesn't save compiling the index's regular expressions:
+pickle stores them as their patterns, so they are compiled again on every
+load. utilities/benchmarks/crankd_config_cache.py measures this: for 5000
+keys and 50 regular expressions, about 120ms without the cache against
+48ms with it.
+
+The cache is keyed by a SHA-256 hash of the configuration file, the cache
+format, the Python version, the dispatch module and the version of crankd
+passed to load(), normally source_version(), so it is rebuilt whenever any
+of them change. An unreadable or stale cache is ignored.
+
+The cache is unpickled so it must be kept somewhere only crankd's user can
+write, like the configuration itself.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import plistlib
+import re
+import sys
+import tempfile
+import time
+
+from PyMacAdmin.crankd import dispatch
+
+CACHE_FORMAT = 1
+
+
+class CompiledConfig(object):
+  """A configuration and the dispatch index built for it."""
+
+  def __init__(self, config, sc_index, warm=False, seconds=None):
+    self.config = config
+    self.sc_index = sc_index
+    self.warm = warm
+    self.seconds = seconds
+
+
+def version_key(version=""):
+  """Returns a string which changes when cached data can't be reused.
+
+  Args:
+    version: optional str, e.g. crankd's own version
+  """
+  try:
+    dispatch_stat = os.stat(dispatch.__file__)
+    dispatch_version = "%d:%d" % (dispatch_stat.st_mtime_ns,
+                                  dispatch_stat.st_size)
+  except OSError:
+    dispatch_version = ""
+  return "%d/%x/%s/%s" % (CACHE_FORMAT, sys.hexversion, dispatch_version,
+                          version)
+
+
+def source_version(package_dir=os.path.dirname(os.path.abspath(__file__))):
+  """Returns a hash of the crankd package's sources, as its version.
+
+  Only each module's name, size and mtime are hashed, so this is cheap
+  enough to call on every start.
+
+  Args:
+    package_dir: optional str, the directory of the package
+  """
+  sources = hashlib.sha256()
+  for name in sorted(os.listdir(package_dir)):
+    if not name.endswith(".py"):
+      continue
+    try:
+      st = os.stat(os.path.join(package_dir, name))
+    except OSError:
+      continue
+    sources.update(("%s:%d:%d\n" % (name, st.st_mtime_ns, st.st_size))
+                   .encode())
+  return sources.hexdigest()[:16]
+
+
+def compile_config(data):
+  """Parses a configuration and builds its SCDispatchIndex.
+
+  Args:
+    data: bytes, the plist
+
+  Returns:
+    CompiledConfig; sc_index is None if a pattern is invalid, leaving the
+    error to be reported when the handlers are added
+  """
+  config = plistlib.loads(data)
+  sc_config = config.get("SystemConfiguration", {})
+  try:
+    sc_index = dispatch.SCDispatchIndex(dict((k, None) for k in sc_config))
+  except re.error:
+    sc_index = None
+  return CompiledConfig(config, sc_index)
+
+
+def load(path, cache_path, version="", clock=time.monotonic):
+  """Returns the CompiledConfig for path, using cache_path if it's current.
+
+  Args:
+    path: str, the configuration file
+    cache_path: str or None to disable the cache
+    version: optional str included in the cache key
+    clock: optional callable returning the current time in seconds
+
+  Raises:
+    OSError: if path can't be read
+    plistlib.InvalidFileException, ValueError: if path isn't a valid plist
+  """
+  start = clock()
+  with open(path, "rb") as f:
+    data = f.read()
+
+  key = "%s/%s" % (hashlib.sha256(data).hexdigest(), version_key(version))
+
+  if cache_path is not None:
+    try:
+      with open(cache_path, "rb") as f:
+        # The key is pickled separately so a stale cache isn't fully loaded:
+        if pickle.load(f) == key:
+          compiled = pickle.load(f)
+        else:
+          compiled = None
+      if compiled is not None:
+        compiled.warm = True
+        compiled.seconds = clock() - start
+        logging.info("Loaded cached configuration in %0.1fms",
+                     compiled.seconds * 1000)
+        return compiled
+    except FileNotFoundError:
+      pass
+    except Exception as exc:  # pylint: disable=W0703
+      # Unpickling can fail in many ways; none of them matter:
+      logging.debug("Ignoring configuration cache %s: %s", cache_path, exc)
+
+  compiled = compile_config(data)
+  compiled.seconds = clock() - start
+  logging.info("Parsed configuration in %0.1fms", compiled.seconds * 1000)
+
+  if cache_path is not None:
+    save(cache_path, key, compiled)
+  return compiled
+
+
+def save(cache_path, key, compiled):
+  """Atomically writes compiled to cache_path, logging any error."""
+  tmp_name = None
+  try:
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(cache_path) or ".", prefix=".config-cache-")
+    with os.fdopen(fd, "wb") as f:
+      pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+      pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_name, cache_path)
+  except (OSError, IOError, pickle.PicklingError) as exc:
+    logging.warning("Unable to write configuration cache %s: %s", cache_path,
+                    exc)
+    if tmp_name is not None and os.path.exists(tmp_name):
+      os.unlink(tmp_name)
@@ -0,0 +1,842 @@
+# encoding: utf-8
+"""Platform-independent core of crankd.
+
+This module holds everything crankd does which doesn't require PyObjC:
+loading the configuration, creating handler callables, routing events to them
+and running shell commands. bin/crankd.py connects it to the NSWorkspace,
+SystemConfiguration and FSEvents APIs; PyMacAdmin.crankd.sources provides
+event sources which work elsewhere, which allows the dispatch and handler
+code to be tested and benchmarked on any system.
+
+Event sources deliver events through the dispatch_* functions:
+
+  dispatch_sc_event(changed_keys, info)
+  dispatch_fs_event(path, recursive)
+  dispatch_workspace_event(name, user_info)
+"""
+
+import functools
+import importlib
+import logging
+import os
+import plistlib
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from PyMacAdmin.crankd import checkpoint
+from PyMacAdmin.crankd import coalesce
+from PyMacAdmin.crankd import configcache
+from PyMacAdmin.crankd import dispatch
+from PyMacAdmin.crankd import executor
+from PyMacAdmin.crankd import launcher
+from PyMacAdmin.crankd import metrics
+
+# Events which have a "class" handler use an instantiated object; we want to
+# load only one copy
+HANDLER_OBJECTS = dict()
+HANDLER_OBJECTS_LOCK = threading.RLock()
+# LazyCallable instances for "function" and "method" handlers
+LAZY_HANDLERS = list()
+# Seconds taken to import and resolve each handler, indexed by name
+HANDLER_IMPORT_TIMES = dict()
+# Callbacks indexed by SystemConfiguration keys
+SC_HANDLERS = dict()
+# SC_HANDLERS compiled into a dispatch.SCDispatchIndex by add_sc_handlers
+SC_DISPATCH = dispatch.SCDispatchIndex(SC_HANDLERS)
+# SCDispatchIndex built by load_config, used by add_sc_handlers if it matches
+PREBUILT_SC_DISPATCH = None
+# Callbacks indexed by filesystem path
+FS_WATCHED_FILES = dict()
+# (watched directory, callback) for each path in the FSEvents configuration
+FS_HANDLERS = dict()
+# The same callback lists in a dispatch.PathTrie for dispatch_fs_event
+FS_WATCHED_TRIE = dispatch.PathTrie()
+# Callbacks for NSWorkspace notifications which don't use a "class" handler
+WORKSPACE_HANDLERS = dict()
+# coalesce.Coalescer instances for handlers with debounce or max_latency set
+COALESCERS = list()
+# executor.HandlerExecutor if the configuration has an Executor section
+CRANKD_EXECUTOR = None
+
+# launcher.Launcher if the configuration has a Launcher section
+LAUNCHER = None
+
+# Handler, event loop and FSEvents metrics
+METRICS = metrics.Metrics()
+# metrics.MetricsFile if the configuration has a Metrics section
+METRICS_FILE = None
+
+# replay.EventRecorder when crankd was started with --record
+RECORDER = None
+# checkpoint.Checkpoint if the configuration has a Checkpoint section
+CHECKPOINT = None
+
+# How long shutdown_handlers() waits for queued handlers
+EXECUTOR_DRAIN_TIMEOUT = 10.0
+
+EXAMPLE_CONFIG = {
+    "SystemConfiguration": {
+        "State:/Network/Global/IPv4": {
+            "command": '/bin/echo "Global IPv4 config changed"'
+        }
+    },
+    "NSWorkspace": {
+        "NSWorkspaceDidMountNotification": {
+            "command": '/bin/echo "A new volume was mounted!"'
+        },
+        "NSWorkspaceDidWakeNotification": {
+            "command": '/bin/echo "The system woke from sleep!"'
+        },
+        "NSWorkspaceWillSleepNotification": {
+            "command": '/bin/echo "The system is about to go to sleep!"'
+        }
+    }
+}
+
+
+class BaseHandler(object):
+  # pylint: disable=C0111,R0903
+  pass
+
+
+class LazyCallable(object):
+  """Imports a "function" or "method" handler the first time it's called.
+
+  Importing every handler module when crankd starts makes startup, and every
+  restart, pay for handlers whose events may never happen. The callable is
+  cached once resolved and the time taken is stored in HANDLER_IMPORT_TIMES.
+  """
+
+  def __init__(self, f_name, method=None):
+    """Creates a LazyCallable.
+
+    Args:
+      f_name: str, a function name or, if method is set, a class name
+      method: optional str, a method of the single instance of f_name
+
+    Raises:
+      AttributeError: if f_name can't be a module or function name
+    """
+    mod_name, func_name = get_mod_func(f_name)
+    if not mod_name and not func_name:
+      raise AttributeError(
+          "%s couldn't be converted to a module or function name" % f_name)
+
+    self.f_name = f_name
+    self.method = method
+    self.name = f_name if method is None else "%s.%s" % (f_name, method)
+    self.func = None
+    self.import_seconds = None
+    self.lock = threading.Lock()
+
+  def __call__(self, *args, **kwargs):
+    func = self.func
+    if func is None:
+      func = self.resolve()
+    return func(*args, **kwargs)
+
+  def resolve(self):
+    """Imports and returns the handler, which is cached.
+
+    Raises:
+      RuntimeError: if the handler can't be imported
+    """
+    with self.lock:
+      if self.func is None:
+        start = time.monotonic()
+        if self.method is None:
+          func = get_callable_from_string(self.f_name)
+        else:
+          try:
+            func = getattr(get_handler_object(self.f_name), self.method)
+          except AttributeError as exc:
+            raise RuntimeError("Unable to create a callable object for '%s': "
+                               "%s" % (self.name, exc))
+        self.import_seconds = time.monotonic() - start
+        HANDLER_IMPORT_TIMES[self.name] = self.import_seconds
+        logging.debug("Loaded handler %s in %0.1fms", self.name,
+                      self.import_seconds * 1000)
+        self.func = func
+    return self.func
+
+
+def log_list(msg, items, level=logging.INFO):
+  """Record a a list of values with a message.
+
+  This would ordinarily be a simple logging call but we want to keep the
+  length below the 1024-byte syslog() limitation and we'll format things
+  nicely by repeating our message with as many of the values as will fit.
+
+  Individual items longer than the maximum length will be truncated.
+
+  Args:
+    msg: str, message to be logged
+    items: list, items to log
+    level: optional logger level
+  """
+  max_len = 1024 - len(msg % "")
+  cur_len = 0
+  cur_items = list()
+
+  while [i[:max_len] for i in items]:
+    i = items.pop()
+    if cur_len + len(i) + 2 > max_len:
+      logging.info(msg, ", ".join(cur_items))
+      cur_len = 0
+      cur_items = list()
+
+    cur_items.append(i)
+    cur_len += len(i) + 2
+
+  logging.log(level, msg, ", ".join(cur_items))
+
+
+def get_callable_for_event(name, event_config, context=None):
+  """Returns a callable object which can be used as a callback for any event.
+
+  The returned function has context information, logging, etc.
+  included so they do not need to be passed when the actual event
+  occurs.
+
+  When an executor has been configured, handlers are queued to it rather than
+  called from the run loop. Handlers which set "debounce" or "max_latency"
+  are wrapped in a coalesce.Coalescer so bursts of events result in a single
+  call.
+
+  Function and method handlers are not imported until they are first called
+  (see LazyCallable) or prewarm_handlers() runs.
+
+  NOTE: This function does not process "class" handlers - by design they
+  are passed to the system libraries which expect a delegate object with
+  various event handling methods
+
+  Args:
+    name: str
+    event_config: str, type of event
+    context: optional context
+
+  Returns:
+    A callable object for use as a callback
+  Raises:
+    AttributeError: if name is missing a required attribute
+  """
+
+  kwargs = {
+      "context": context,
+      "key": name,
+      "config": event_config,
+  }
+
+  if "command" in event_config:
+    f = functools.partial(do_shell, event_config["command"], **kwargs)
+  elif "function" in event_config:
+    lazy = LazyCallable(event_config["function"])
+    LAZY_HANDLERS.append(lazy)
+    f = functools.partial(lazy, **kwargs)
+  elif "method" in event_config:
+    lazy = LazyCallable(event_config["method"][0], event_config["method"][1])
+    LAZY_HANDLERS.append(lazy)
+    f = functools.partial(lazy, **kwargs)
+  else:
+    raise AttributeError("%s must have a class, method, function or command" %
+                         name)
+
+  kind = "command" if "command" in event_config else "python"
+  f = METRICS.instrument(context or name, f, kind=kind)
+
+  if CRANKD_EXECUTOR is not None and event_config.get("async", True):
+    try:
+      f = CRANKD_EXECUTOR.wrap(
+          context or name,
+          f,
+          kind=kind,
+          concurrency=event_config.get("concurrency", 1),
+          timeout=event_config.get("timeout"),
+          max_pending=event_config.get("max_pending"))
+    except (TypeError, ValueError) as exc:
+      raise AttributeError("%s has invalid executor settings: %s" % (name, exc))
+
+  if "debounce" in event_config or "max_latency" in event_config:
+    try:
+      f = coalesce.Coalescer(
+          f,
+          name=context or name,
+          debounce=event_config.get("debounce", 0),
+          max_latency=event_config.get("max_latency"))
+    except (TypeError, ValueError) as exc:
+      raise AttributeError("%s has an invalid debounce or max_latency: %s" %
+                           (name, exc))
+    COALESCERS.append(f)
+
+  return f
+
+
+def get_mod_func(callback):
+  """Convert a fully-qualified module.function name to (module, function)."""
+  try:
+    dot = callback.rindex(".")
+  except ValueError:
+    return (callback, "")
+  return (callback[:dot], callback[dot + 1:])
+
+
+def get_callable_from_string(f_name):
+  """Takes a function name and returns a callable object."""
+  try:
+    mod_name, func_name = get_mod_func(f_name)
+    if not mod_name and not func_name:
+      raise AttributeError(
+          "%s couldn't be converted to a module or function name" % f_name)
+
+    module = importlib.import_module(mod_name)
+
+    if not func_name:
+      func_name = mod_name  # The common case is an eponymous class
+
+    return getattr(module, func_name)
+
+  except (ImportError, AttributeError) as exc:
+    raise RuntimeError("Unable to create a callable object for '%s': %s" %
+                       (f_name, exc))
+
+
+def get_handler_object(class_name):
+  """Return a single instance of class_name, instantiating it if necessary."""
+
+  # Lazy handlers may be resolved concurrently by executor threads:
+  with HANDLER_OBJECTS_LOCK:
+    if class_name not in HANDLER_OBJECTS:
+      h_obj = get_callable_from_string(class_name)()
+      if isinstance(h_obj, BaseHandler):
+        pass  # TODO(anyone): Do we even need BaseHandler any more?
+      HANDLER_OBJECTS[class_name] = h_obj
+
+    return HANDLER_OBJECTS[class_name]
+
+
+def prewarm_handlers(background=True):
+  """Imports every lazy handler which hasn't been called yet.
+
+  Args:
+    background: bool, use a daemon thread so the run loop isn't blocked
+
+  Returns:
+    the threading.Thread if background is True
+  """
+
+  def prewarm():
+    start = time.monotonic()
+    count = 0
+    for handler in list(LAZY_HANDLERS):
+      if handler.func is not None:
+        continue
+      try:
+        handler.resolve()
+        count += 1
+      except RuntimeError as exc:
+        logging.error("Unable to prewarm handler: %s", exc)
+    logging.info("Prewarmed %d handler(s) in %0.1fms", count,
+                 (time.monotonic() - start) * 1000)
+
+  if not background:
+    prewarm()
+    return None
+
+  thread = threading.Thread(target=prewarm, name="crankd-prewarm")
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+def load_config(options, cache_path=None):
+  """Load our configuration from plist or create if none exists.
+
+  Args:
+    options: the command-line options; options.config_file is loaded
+    cache_path: optional str, see PyMacAdmin.crankd.configcache
+
+  Returns:
+    dict
+  """
+  global PREBUILT_SC_DISPATCH
+
+  if not os.path.exists(options.config_file):
+    logging.info(
+        "%s does not exist - initializing with an example configuration",
+        options.config_file)
+    print(
+        "Creating %s with default options for you to customize" %
+        options.config_file,
+        file=sys.stderr)
+    print(
+        "%s --list-events will list the events you can monitor on this system" %
+        sys.argv[0],
+        file=sys.stderr)
+    try:
+      with open(options.config_file, "wb") as f:
+        plistlib.dump(EXAMPLE_CONFIG, f)
+    except (TypeError, OSError) as e:
+      logging.error("Could not write %s: %s", options.config_file, str(e))
+      sys.exit(1)
+
+  logging.info("Loading configuration from %s", options.config_file)
+
+  try:
+    compiled = configcache.load(options.config_file, cache_path,
+                                version=configcache.source_version())
+  except (TypeError, OSError, ValueError, plistlib.InvalidFileException) as e:
+    logging.error("Could not read %s: %s", options.config_file, str(e))
+    sys.exit(1)
+  plist = compiled.config
+  PREBUILT_SC_DISPATCH = compiled.sc_index
+
+  if "imports" in plist:
+    for module in plist["imports"]:
+      try:
+        __import__(module)
+      except ImportError as exc:
+        print("Unable to import %s: %s" % (module, exc), file=sys.stderr)
+        sys.exit(1)
+  return plist
+
+
+def reset_handlers():
+  """Forgets every configured handler, e.g. before loading a new config."""
+  global SC_DISPATCH, FS_WATCHED_TRIE, CRANKD_EXECUTOR, CHECKPOINT, LAUNCHER
+  global METRICS, METRICS_FILE, PREBUILT_SC_DISPATCH
+
+  HANDLER_OBJECTS.clear()
+  del LAZY_HANDLERS[:]
+  HANDLER_IMPORT_TIMES.clear()
+  SC_HANDLERS.clear()
+  SC_DISPATCH = dispatch.SCDispatchIndex(SC_HANDLERS)
+  PREBUILT_SC_DISPATCH = None
+  FS_WATCHED_FILES.clear()
+  FS_HANDLERS.clear()
+  FS_WATCHED_TRIE = dispatch.PathTrie()
+  WORKSPACE_HANDLERS.clear()
+  del COALESCERS[:]
+  CRANKD_EXECUTOR = None
+  CHECKPOINT = None
+  LAUNCHER = None
+  METRICS = metrics.Metrics()
+  METRICS_FILE = None
+
+
+def configure_executor(config):
+  """Creates CRANKD_EXECUTOR if config has an Executor section."""
+  global CRANKD_EXECUTOR
+
+  if "Executor" in config:
+    executor_config = config["Executor"]
+    CRANKD_EXECUTOR = executor.HandlerExecutor(
+        threads=executor_config.get("threads", executor.DEFAULT_THREADS),
+        processes=executor_config.get("processes", executor.DEFAULT_PROCESSES))
+
+
+def configure_launcher(config):
+  """Creates LAUNCHER if config has a Launcher section."""
+  global LAUNCHER
+
+  if "Launcher" in config:
+    LAUNCHER = launcher.Launcher(
+        shell=config["Launcher"].get("shell", launcher.DEFAULT_SHELL))
+
+
+def configure_metrics(config):
+  """Creates METRICS_FILE if config has a Metrics section.
+
+  Raises:
+    ValueError: if the section is invalid
+  """
+  global METRICS_FILE
+
+  if "Metrics" in config:
+    metrics_config = config["Metrics"]
+    if "path" not in metrics_config:
+      raise ValueError("The Metrics section must have a path")
+    METRICS_FILE = metrics.MetricsFile(
+        metrics_config["path"],
+        fmt=metrics_config.get("format", "json"),
+        interval=metrics_config.get("interval", metrics.DEFAULT_INTERVAL))
+
+
+def configure_checkpoint(config, default_path):
+  """Creates CHECKPOINT if config has a Checkpoint section.
+
+  Args:
+    config: dict, the crankd configuration
+    default_path: str, used if the section doesn't specify a path
+  """
+  global CHECKPOINT
+
+  if "Checkpoint" in config:
+    checkpoint_config = config["Checkpoint"]
+    CHECKPOINT = checkpoint.Checkpoint(
+        checkpoint_config.get("path", default_path),
+        interval=checkpoint_config.get("interval",
+                                       checkpoint.DEFAULT_INTERVAL),
+        max_catchup=checkpoint_config.get("max_catchup",
+                                          checkpoint.DEFAULT_MAX_CATCHUP))
+
+
+def add_workspace_handlers(nsw_config):
+  """Creates callables for NSWorkspace notifications without a class handler.
+
+  Args:
+    nsw_config: dict, the NSWorkspace section of the configuration
+
+  Returns:
+    list of the notification names which were added
+  """
+  added = list()
+  for event in nsw_config:
+    if "class" in nsw_config[event]:
+      continue
+    WORKSPACE_HANDLERS[event] = get_callable_for_event(
+        event,
+        nsw_config[event],
+        context="NSWorkspace Notification %s" % event)
+    added.append(event)
+  return added
+
+
+def remove_workspace_handler(event):
+  """Removes the callable for an NSWorkspace notification, if it has one."""
+  handler = WORKSPACE_HANDLERS.pop(event, None)
+  if handler is not None:
+    retire_handler(handler)
+
+
+def add_sc_handlers(sc_config, order=None):
+  """Creates callables for SystemConfiguration keys and rebuilds SC_DISPATCH.
+
+  Args:
+    sc_config: dict, the SystemConfiguration section of the configuration
+    order: optional list of every configured key and pattern; SC_HANDLERS
+      is put in this order, which overlapping patterns fire in, before
+      SC_DISPATCH is rebuilt. Otherwise new keys go at the end.
+
+  Returns:
+    list of the keys and patterns which were added
+
+  Raises:
+    AttributeError: if a handler is invalid
+    re.error: if a pattern is not a valid regular expression
+  """
+  global SC_DISPATCH
+
+  keys = list(sc_config.keys())
+  for key in keys:
+    SC_HANDLERS[key] = get_callable_for_event(
+        key, sc_config[key], context="SystemConfiguration: %s" % key)
+  if order is not None:
+    handlers = list(SC_HANDLERS.items())
+    position = dict((key, i) for i, key in enumerate(order))
+    handlers.sort(key=lambda item: position.get(item[0], len(position)))
+    SC_HANDLERS.clear()
+    SC_HANDLERS.update(handlers)
+  if (PREBUILT_SC_DISPATCH is not None and
+      PREBUILT_SC_DISPATCH.patterns == list(SC_HANDLERS)):
+    SC_DISPATCH = PREBUILT_SC_DISPATCH.bind(SC_HANDLERS)
+  else:
+    SC_DISPATCH = dispatch.SCDispatchIndex(SC_HANDLERS)
+  return keys
+
+
+def remove_sc_handlers(keys):
+  """Removes the callables for SystemConfiguration keys and patterns."""
+  global SC_DISPATCH
+
+  for key in keys:
+    retire_handler(SC_HANDLERS.pop(key))
+  SC_DISPATCH = dispatch.SCDispatchIndex(SC_HANDLERS)
+
+
+def add_fs_handlers(fs_config):
+  for path in fs_config:
+    callback = get_callable_for_event(
+        path, fs_config[path], context="FSEvent: %s" % path)
+    FS_HANDLERS[path] = (add_fs_notification(path, callback), callback)
+
+
+def remove_fs_handler(path):
+  """Removes the handler for a path in the FSEvents configuration."""
+  watched, callback = FS_HANDLERS.pop(path)
+  remove_fs_notification(watched, callback)
+  retire_handler(callback)
+
+
+def retire_handler(handler):
+  """Delivers any events pending for a handler which is being removed."""
+  if handler in COALESCERS:
+    handler.flush(force=True)
+    COALESCERS.remove(handler)
+    handler = handler.callback
+
+  if CRANKD_EXECUTOR is not None and handler in CRANKD_EXECUTOR.queues:
+    CRANKD_EXECUTOR.discard(handler)
+    handler = handler.func
+
+  if isinstance(handler, metrics.InstrumentedHandler):
+    handler = handler.func
+
+  if isinstance(handler, functools.partial) and handler.func in LAZY_HANDLERS:
+    LAZY_HANDLERS.remove(handler.func)
+
+
+def add_fs_notification(f_path, callback):
+  """Adds an FSEvent notification for the specified path.
+
+  Returns:
+    str, the directory which will be watched
+  """
+  path = os.path.realpath(os.path.expanduser(f_path))
+  if not os.path.exists(path):
+    raise AttributeError(
+        "Cannot add an FSEvent notification: %s does not exist!" % path)
+
+  if not os.path.isdir(path):
+    path = os.path.dirname(path)
+
+  # add_conditional_restart passes bytes but FSEvents reports str paths:
+  path = os.fsdecode(path)
+
+  FS_WATCHED_FILES[path] = FS_WATCHED_TRIE.add(path, callback)
+  return path
+
+
+def remove_fs_notification(watched, callback):
+  """Removes a notification added by add_fs_notification.
+
+  Args:
+    watched: str, the directory add_fs_notification returned
+    callback: the callable passed to add_fs_notification
+  """
+  FS_WATCHED_TRIE.remove(watched, callback)
+  if watched not in FS_WATCHED_TRIE:
+    del FS_WATCHED_FILES[watched]
+
+
+def dispatch_sc_event(changed_keys, info=None):
+  """Fire every event handler for one or more events.
+
+  Keys with an exact entry in the configuration fire that handler; any other
+  key fires every configured regex which matches it. See SCDispatchIndex.
+  """
+  if RECORDER is not None:
+    RECORDER.record("SystemConfiguration", keys=list(changed_keys), info=info)
+
+  for key in changed_keys:
+    for handler in SC_DISPATCH.lookup(key):
+      handler(key=key, info=info)
+
+
+def dispatch_fs_event(path, recursive=False, flags=None):
+  """Call each handler for a changed directory or any of its parents.
+
+  Args:
+    path: str, the directory which changed
+    recursive: bool, whether subdirectories must also be rescanned
+    flags: optional int, the FSEventStreamEventFlags, which are only recorded
+  """
+  if RECORDER is not None:
+    RECORDER.record("FSEvents", path=path, flags=flags, recursive=recursive)
+
+  for j, callbacks in FS_WATCHED_TRIE.ancestors(path):
+    logging.debug("FSEvent: %s: processing %d callback(s) for path %s", j,
+                  len(callbacks), path)
+    for l in callbacks:
+      l(j, path=path, recursive=recursive)
+
+
+def dispatch_fsevents(paths, masks, ids):
+  """Process a batch of FSEvents and call each handler for a path or parent.
+
+  Args:
+    paths: list of the changed directories
+    masks: list of FSEventStreamEventFlags for each path
+    ids: list of FSEventStreamEventIds for each path
+  """
+  for path, mask, event_id in zip(paths, masks, ids):
+    if CHECKPOINT is not None:
+      action = CHECKPOINT.observe(event_id, mask)
+      if action == checkpoint.SKIP:
+        continue
+      elif action == checkpoint.RESCAN:
+        METRICS.increment("fsevents_catchup_overflows")
+        for watched in list(FS_WATCHED_FILES):
+          dispatch_fs_event(watched, recursive=True, flags=mask)
+        continue
+
+    recursive = bool(mask & checkpoint.FLAG_MUST_SCAN_SUBDIRS)
+
+    if mask & checkpoint.FLAG_USER_DROPPED:
+      logging.error(
+          "We were too slow processing FSEvents and some events were dropped")
+      METRICS.increment("fsevents_user_dropped")
+      recursive = True
+
+    if mask & checkpoint.FLAG_KERNEL_DROPPED:
+      logging.error("The kernel was too slow processing FSEvents "
+                    "and some events were dropped!")
+      METRICS.increment("fsevents_kernel_dropped")
+      recursive = True
+
+    if recursive:
+      METRICS.increment("fsevents_rescans")
+
+    dispatch_fs_event(os.path.dirname(path), recursive=recursive, flags=mask)
+
+  if CHECKPOINT is not None:
+    CHECKPOINT.maybe_save()
+
+
+def dispatch_workspace_event(name, user_info=None):
+  """Call the handler for an NSWorkspace notification."""
+  if RECORDER is not None:
+    RECORDER.record("NSWorkspace", name=name, user_info=user_info)
+
+  WORKSPACE_HANDLERS[name](user_info=user_info)
+
+
+def flush_coalescers(force=False):
+  """Invokes any coalesced handlers whose events are due."""
+  for coalescer in COALESCERS:
+    coalescer.flush(force=force)
+
+
+def collect_metrics():
+  """Returns METRICS.snapshot() with the executor, coalescer and import stats.
+  """
+  snapshot = METRICS.snapshot()
+  snapshot["handler_import_seconds"] = dict(HANDLER_IMPORT_TIMES)
+  snapshot["coalescers"] = dict((c.name, c.stats()) for c in COALESCERS)
+  if CRANKD_EXECUTOR is not None:
+    snapshot["executor"] = CRANKD_EXECUTOR.stats()
+  if LAUNCHER is not None:
+    snapshot["launcher"] = LAUNCHER.stats()
+  return snapshot
+
+
+def write_metrics():
+  """Writes the current metrics to METRICS_FILE, if configured."""
+  if METRICS_FILE is not None:
+    METRICS_FILE.write(collect_metrics())
+
+
+def shutdown_handlers(timeout=EXECUTOR_DRAIN_TIMEOUT):
+  """Delivers pending coalesced events and waits for queued handlers.
+
+  Returns:
+    bool, False if queued handlers were still running after timeout
+  """
+  flush_coalescers(force=True)
+  if RECORDER is not None:
+    RECORDER.flush()
+  if CHECKPOINT is not None:
+    CHECKPOINT.save()
+  finished = True
+  if CRANKD_EXECUTOR is not None:
+    if not CRANKD_EXECUTOR.shutdown(timeout=timeout):
+      logging.warning("%d handler(s) still queued after %ss",
+                      CRANKD_EXECUTOR.queue_depth(), timeout)
+      finished = False
+  if LAUNCHER is not None and finished:
+    LAUNCHER.close()
+  write_metrics()
+  return finished
+
+
+ENV_NAME_CAMEL_CASE_RE = re.compile(r"""(?<=[a-z])([A-Z])""")
+ENV_NAME_INVALID_RE = re.compile(r"\W+")
+ENV_NAME_UNDERSCORES_RE = re.compile(r"_{2,}")
+
+
+@functools.lru_cache(maxsize=1024)
+def create_env_name(name):
+  """Converts input names into more traditional shell environment name style.
+
+  >>> create_env_name("NSApplicationBundleIdentifier")
+  'NSAPPLICATION_BUNDLE_IDENTIFIER'
+  >>> create_env_name("NSApplicationBundleIdentifier-1234$foobar!")
+  'NSAPPLICATION_BUNDLE_IDENTIFIER_1234_FOOBAR'
+
+  Args:
+    name: str, name to convert
+
+  Returns:
+    str, converted name
+  """
+  new_name = ENV_NAME_CAMEL_CASE_RE.sub("_\\1", name)
+  new_name = ENV_NAME_INVALID_RE.sub("_", new_name)
+  new_name = ENV_NAME_UNDERSCORES_RE.sub("_", new_name)
+  return new_name.upper().strip("_")
+
+
+def get_shell_env(context=None, **kwargs):
+  """Returns the environment for a shell command handler.
+
+  >>> sorted(get_shell_env("ctx", key="k", user_info={"NSDevicePath": "/"}))
+  ['CRANKD_CONTEXT', 'CRANKD_KEY', 'NSDEVICE_PATH']
+
+  Args:
+    context: str, passed as CRANKD_CONTEXT
+    **kwargs: the event arguments passed to do_shell
+
+  Returns:
+    dict
+  """
+  child_env = {"CRANKD_CONTEXT": context}
+
+  # We'll pull a subset of the available information in for shell scripts.
+  # Anyone who needs more will probably want to write a Python handler
+  # instead so they can reuse things like our logger & config info and avoid
+  # ordeals like associative arrays in Bash
+  for k in ["info", "key"]:
+    if k in kwargs and kwargs[k]:
+      child_env["CRANKD_%s" % k.upper()] = str(kwargs[k])
+
+  # Coalesced handlers receive every path and key from the burst of events:
+  for k in ["paths", "keys"]:
+    if kwargs.get(k):
+      child_env["CRANKD_%s" % k.upper()] = "\n".join(map(str, kwargs[k]))
+
+  if kwargs.get("user_info"):
+    for k, v in kwargs["user_info"].items():
+      child_env[create_env_name(k)] = str(v)
+
+  return child_env
+
+
+def do_shell(command, context=None, **kwargs):
+  """Executes a shell command with logging.
+
+  Returns:
+    int, the exit status, or None if the command didn't finish
+  """
+  logging.info("%s: executing %s", context, command)
+
+  child_env = get_shell_env(context, **kwargs)
+  timeout = (kwargs.get("config") or {}).get("timeout")
+
+  try:
+    if LAUNCHER is not None:
+      rc = LAUNCHER.call(command, env=child_env, timeout=timeout)
+    else:
+      rc = subprocess.call(command, shell=True, env=child_env, timeout=timeout)
+    if rc == 0:
+      logging.debug("`%s` returned %d", command, rc)
+    elif rc < 0:
+      logging.error("`%s` was terminated by signal %d", command, -rc)
+    else:
+      logging.error("`%s` returned %d", command, rc)
+    return rc
+  except subprocess.TimeoutExpired:
+    logging.error("`%s` was killed after exceeding its %ss timeout", command,
+                  timeout)
+  except OSError as exc:
+    logging.error("Got an exception when executing %s: %s", command, exc)
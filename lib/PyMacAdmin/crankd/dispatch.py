@@ -0,0 +1,313 @@
+# encoding: utf-8
+"""Dispatch indexes used by crankd to route events to their handlers.
+
+FSEvents are delivered for a directory and must fire the handlers of every
+watched directory which contains it; crankd keeps its watched paths in a
+PathTrie so this costs one step per path component.
+
+crankd's SystemConfiguration section is keyed by either exact SCDynamicStore
+keys ("State:/Network/Global/IPv4") or regular expressions which are applied
+with re.match ("State:/Network/Interface/en[0-9]+/Link"). Testing every
+pattern against every changed key does not scale to large configurations so
+the patterns are compiled once into an SCDispatchIndex when the configuration
+is loaded.
+"""
+
+import copy
+import os
+import re
+
+# Characters which give a pattern regular expression semantics. Anything
+# without them is a literal and re.match(pattern, key) is simply
+# key.startswith(pattern):
+REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+
+# Quantifiers make the preceding character optional or repeatable so it cannot
+# be part of a pattern's literal prefix:
+REGEX_QUANTIFIERS = frozenset("*?{")
+
+# Group references cannot be renumbered safely when patterns are combined:
+BACKREFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def literal_prefix(pattern):
+  """Returns the literal text which every key matching pattern must start with.
+
+  >>> literal_prefix("State:/Network/Interface/en[0-9]+/Link")
+  'State:/Network/Interface/en'
+  >>> literal_prefix(r"Setup:/Network/Service/.*/DNS")
+  'Setup:/Network/Service/'
+  >>> literal_prefix(r"State:/Network/Global/IPv4s?")
+  'State:/Network/Global/IPv4'
+  >>> literal_prefix("State:/Foo|State:/Bar")
+  ''
+
+  Args:
+    pattern: str, a regular expression which will be used with re.match
+
+  Returns:
+    str, possibly empty
+  """
+  if "|" in pattern:
+    return ""
+
+  prefix = []
+  i = 0
+  if pattern.startswith("^"):
+    i = 1
+
+  while i < len(pattern):
+    c = pattern[i]
+    if c == "\\":
+      if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+        prefix.append(pattern[i + 1])
+        i += 2
+        continue
+      break
+    if c in REGEX_METACHARACTERS:
+      if c in REGEX_QUANTIFIERS and prefix:
+        prefix.pop()
+      break
+    prefix.append(c)
+    i += 1
+
+  return "".join(prefix)
+
+
+class PrefixTrie(object):
+  """A character trie returning every stored prefix of a string.
+
+  Each node is a dict mapping a character to the next node; values stored for
+  the prefix ending at a node are kept in a list under the None key.
+  """
+
+  def __init__(self):
+    self.root = dict()
+
+  def add(self, prefix, value):
+    node = self.root
+    for c in prefix:
+      node = node.setdefault(c, dict())
+    node.setdefault(None, list()).append(value)
+
+  def prefixes_of(self, key):
+    """Returns the values of every stored prefix of key, shortest first."""
+    node = self.root
+    found = list(node.get(None, ()))
+    for c in key:
+      node = node.get(c)
+      if node is None:
+        break
+      if None in node:
+        found.extend(node[None])
+    return found
+
+
+class SCDispatchIndex(object):
+  """Maps changed SystemConfiguration keys to the handlers which should fire.
+
+  A key which has an exact entry in the configuration fires only that
+  handler. Otherwise every configured pattern which re.match()es the key fires,
+  in configuration order. Literal patterns are found with a prefix trie,
+  regular expressions are pre-filtered by their literal prefix and a single
+  combined expression, and the result for each key is memoized.
+
+  The index itself only refers to handlers by their position so it can be
+  pickled with placeholder handlers and bound to the real ones later. Its
+  tries are pickled as they are, but pickle stores compiled regular
+  expressions as their pattern strings, so unpickling compiles them again.
+  """
+
+  # Keys such as State:/Network/Interface/utun3/IPv6 are not unbounded but
+  # we'll still cap the memo so a misbehaving system can't grow it forever:
+  MAX_CACHED_KEYS = 4096
+
+  def __init__(self, handlers):
+    """Builds the index.
+
+    Args:
+      handlers: dict mapping patterns to callables, in configuration order
+    """
+    self.patterns = list(handlers.keys())
+    self.values = list(handlers.values())
+    self.exact = dict((p, i) for i, p in enumerate(self.patterns))
+
+    self.literals = PrefixTrie()
+    self.regex_prefixes = PrefixTrie()
+    regexes = list()
+
+    for order, pattern in enumerate(self.patterns):
+      if REGEX_METACHARACTERS.isdisjoint(pattern):
+        self.literals.add(pattern, order)
+      else:
+        compiled = re.compile(pattern)
+        self.regex_prefixes.add(literal_prefix(pattern), (order, compiled))
+        regexes.append(pattern)
+
+    self.combined = None
+    if regexes and not any(BACKREFERENCE_RE.search(p) for p in regexes):
+      try:
+        self.combined = re.compile("|".join("(?:%s)" % p for p in regexes))
+      except re.error:
+        self.combined = None
+
+    self.cache = dict()
+
+  def __len__(self):
+    return len(self.patterns)
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["values"] = None
+    state["cache"] = dict()
+    return state
+
+  def bind(self, handlers):
+    """Returns a copy of this index which calls handlers instead.
+
+    Args:
+      handlers: dict with the same patterns, in the same order, as the dict
+        this index was built from
+
+    Raises:
+      ValueError: if the patterns differ
+    """
+    if list(handlers.keys()) != self.patterns:
+      raise ValueError("The handlers don't match the index's patterns")
+    index = copy.copy(self)
+    index.values = list(handlers.values())
+    index.cache = dict()
+    return index
+
+  def lookup(self, key):
+    """Returns a tuple of the handlers which should be called for key."""
+    try:
+      return self.cache[key]
+    except KeyError:
+      pass
+
+    if key in self.exact:
+      result = (self.values[self.exact[key]],)
+    else:
+      matches = self.literals.prefixes_of(key)
+
+      if self.combined is None or self.combined.match(key):
+        for order, compiled in self.regex_prefixes.prefixes_of(key):
+          if compiled.match(key):
+            matches.append(order)
+
+      matches.sort()
+      result = tuple(self.values[order] for order in matches)
+
+    if len(self.cache) >= self.MAX_CACHED_KEYS:
+      self.cache.clear()
+    self.cache[key] = result
+
+    return result
+
+
+class PathTrie(object):
+  """Maps filesystem paths to values, split on path components.
+
+  Unlike str.startswith, /tmp/foo is an ancestor of /tmp/foo/bar but not of
+  /tmp/foobar. Each node is a dict mapping a path component to the next node;
+  a watched path stores (path, values) under the None key.
+  """
+
+  def __init__(self):
+    self.root = dict()
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, path):
+    node = self._find(path)
+    return node is not None and None in node
+
+  @staticmethod
+  def split(path):
+    return [i for i in os.fsdecode(path).split("/") if i]
+
+  def _find(self, path):
+    node = self.root
+    for component in self.split(path):
+      node = node.get(component)
+      if node is None:
+        return None
+    return node
+
+  def add(self, path, value):
+    """Appends value to the list stored for path and returns that list."""
+    node = self.root
+    for component in self.split(path):
+      node = node.setdefault(component, dict())
+    if None not in node:
+      node[None] = (os.fsdecode(path), list())
+      self.count += 1
+    node[None][1].append(value)
+    return node[None][1]
+
+  def remove(self, path, value):
+    """Removes value from the list for path, forgetting path if it's empty.
+
+    Raises:
+      KeyError: if path isn't in the trie
+      ValueError: if value isn't stored for path
+    """
+    nodes = [self.root]
+    for component in self.split(path):
+      node = nodes[-1].get(component)
+      if node is None:
+        raise KeyError(path)
+      nodes.append(node)
+    if None not in nodes[-1]:
+      raise KeyError(path)
+
+    values = nodes[-1][None][1]
+    values.remove(value)
+    if values:
+      return
+
+    del nodes[-1][None]
+    self.count -= 1
+    # Prune nodes which no longer lead to a watched path:
+    for parent, component in reversed(list(zip(nodes, self.split(path)))):
+      if parent[component]:
+        break
+      del parent[component]
+
+  def get(self, path, default=None):
+    node = self._find(path)
+    if node is None or None not in node:
+      return default
+    return node[None][1]
+
+  def ancestors(self, path):
+    """Returns (watched path, values) for path and every watched parent.
+
+    >>> t = PathTrie()
+    >>> _ = t.add("/tmp/foo", 1)
+    >>> _ = t.add("/", 2)
+    >>> t.ancestors("/tmp/foo/bar")
+    [('/', [2]), ('/tmp/foo', [1])]
+    >>> t.ancestors("/tmp/foobar")
+    [('/', [2])]
+
+    Args:
+      path: str, a directory reported by FSEvents
+
+    Returns:
+      list of (str, list) tuples, shortest path first
+    """
+    node = self.root
+    found = list()
+    if None in node:
+      found.append(node[None])
+    for component in self.split(path):
+      node = node.get(component)
+      if node is None:
+        break
+      if None in node:
+        found.append(node[None])
+    return found
@@ -0,0 +1,218 @@
+# encoding: utf-8
+"""Optional asynchronous execution of crankd handlers.
+
+By default crankd calls every handler synchronously from the run loop, so a
+single slow handler delays every other event source. When the configuration
+has an "Executor" section, handlers are instead queued to worker threads:
+
+  <key>Executor</key>
+  <dict>
+    <key>threads</key>
+    <integer>4</integer>
+    <key>processes</key>
+    <integer>2</integer>
+  </dict>
+
+"threads" bounds the number of Python handlers running at once and
+"processes" the number of shell commands. Each handler has its own queue,
+configured with these optional event properties:
+
+concurrency:  how many invocations may run at once (default 1, which also
+              guarantees that events are handled in the order received)
+timeout:      seconds after which a command is killed; Python handlers can't
+              be interrupted but are logged and counted when they overrun
+max_pending:  discard the oldest queued events beyond this many
+async:        false to keep calling this handler from the run loop
+
+Python handlers which use Cocoa APIs must either be thread-safe or set
+async to false.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+DEFAULT_THREADS = 4
+DEFAULT_PROCESSES = 2
+
+
+class HandlerQueue(object):
+  """Callable which queues each call of a handler to a HandlerExecutor pool."""
+
+  def __init__(self, executor, name, func, kind="python", concurrency=1,
+               timeout=None, max_pending=None):
+    if concurrency < 1:
+      raise ValueError("%s: concurrency must be at least 1" % name)
+
+    self.executor = executor
+    self.name = name
+    self.func = func
+    self.kind = kind
+    self.concurrency = int(concurrency)
+    self.timeout = timeout
+    self.max_pending = max_pending
+
+    self.pending = collections.deque()
+    self.running = 0
+    # Set when a configuration reload removes the handler
+    self.retired = False
+
+    self.submitted = 0
+    self.completed = 0
+    self.errors = 0
+    self.timeouts = 0
+    self.dropped = 0
+    self.max_depth = 0
+
+  def __call__(self, *args, **kwargs):
+    with self.executor.lock:
+      self.submitted += 1
+      self.pending.append((args, kwargs))
+      if self.max_pending is not None and len(self.pending) > self.max_pending:
+        self.pending.popleft()
+        self.dropped += 1
+        logging.warning("%s: queue full, discarded the oldest event", self.name)
+      self.max_depth = max(self.max_depth, self.depth())
+      self._schedule()
+
+  def depth(self):
+    """Returns the number of queued and running invocations."""
+    return len(self.pending) + self.running
+
+  def stats(self):
+    return {
+        "submitted": self.submitted,
+        "completed": self.completed,
+        "errors": self.errors,
+        "timeouts": self.timeouts,
+        "dropped": self.dropped,
+        "pending": len(self.pending),
+        "running": self.running,
+        "max_depth": self.max_depth,
+    }
+
+  def _schedule(self):
+    # Called with executor.lock held
+    while self.running < self.concurrency and self.pending:
+      if self.executor.closed:
+        self._drop_pending()
+        return
+      args, kwargs = self.pending.popleft()
+      self.running += 1
+      try:
+        self.executor.pools[self.kind].submit(self._run, args, kwargs)
+      except RuntimeError:
+        # The pool has been shut down, e.g. at interpreter exit:
+        self.running -= 1
+        self.pending.appendleft((args, kwargs))
+        self._drop_pending()
+        return
+
+  def _drop_pending(self):
+    # Called with executor.lock held
+    self.dropped += len(self.pending)
+    logging.warning("%s: executor shut down, discarded %d event(s)",
+                    self.name, len(self.pending))
+    self.pending.clear()
+
+  def _run(self, args, kwargs):
+    start = time.monotonic()
+    failed = False
+    try:
+      self.func(*args, **kwargs)
+    except Exception:  # pylint: disable=W0703
+      failed = True
+      logging.exception("%s: handler raised an exception", self.name)
+
+    elapsed = time.monotonic() - start
+    timed_out = self.timeout is not None and elapsed >= self.timeout
+    if timed_out and self.kind == "python":
+      logging.error("%s: handler took %0.1fs, exceeding its %ss timeout",
+                    self.name, elapsed, self.timeout)
+
+    with self.executor.lock:
+      self.running -= 1
+      self.completed += 1
+      self.errors += failed
+      self.timeouts += timed_out
+      self._schedule()
+      if self.retired and not self.depth() and self in self.executor.queues:
+        self.executor.queues.remove(self)
+      self.executor.idle.notify_all()
+
+
+class HandlerExecutor(object):
+  """Thread pools for Python handlers and shell commands."""
+
+  def __init__(self, threads=DEFAULT_THREADS, processes=DEFAULT_PROCESSES):
+    self.pools = {
+        "python":
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix="crankd-handler"),
+        "command":
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=processes, thread_name_prefix="crankd-command"),
+    }
+    self.lock = threading.Lock()
+    self.idle = threading.Condition(self.lock)
+    self.queues = list()
+    # Set by shutdown; later invocations are dropped rather than submitted
+    self.closed = False
+
+  def wrap(self, name, func, kind="python", **kwargs):
+    """Returns a HandlerQueue which will run func on this executor.
+
+    Args:
+      name: str used for logging
+      func: the handler callable
+      kind: "python" or "command", selecting the pool
+      **kwargs: passed to HandlerQueue (concurrency, timeout, max_pending)
+
+    Returns:
+      HandlerQueue
+    """
+    queue = HandlerQueue(self, name, func, kind=kind, **kwargs)
+    self.queues.append(queue)
+    return queue
+
+  def discard(self, queue):
+    """Forgets queue once any invocations already queued have finished."""
+    with self.lock:
+      queue.retired = True
+      if not queue.depth() and queue in self.queues:
+        self.queues.remove(queue)
+
+  def queue_depth(self):
+    """Returns the number of queued and running handler invocations."""
+    with self.lock:
+      return sum(q.depth() for q in self.queues)
+
+  def stats(self):
+    with self.lock:
+      return dict((q.name, q.stats()) for q in self.queues)
+
+  def join(self, timeout=None):
+    """Waits for every queued invocation to finish.
+
+    Returns:
+      bool, False if timeout expired first
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self.lock:
+      while any(q.depth() for q in self.queues):
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return False
+        self.idle.wait(remaining)
+    return True
+
+  def shutdown(self, timeout=None):
+    """Waits up to timeout seconds for queued work and stops the pools."""
+    finished = self.join(timeout)
+    with self.lock:
+      self.closed = True
+    for pool in self.pools.values():
+      pool.shutdown(wait=finished)
+    return finished
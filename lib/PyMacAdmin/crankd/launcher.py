@@ -0,0 +1,222 @@
+# encoding: utf-8
+"""A small helper process which runs crankd's shell command handlers.
+
+By default crankd starts each command with subprocess, forking itself. With
+a "Launcher" section in the configuration, commands are instead started by
+a separate Python process which imports nothing but the standard library,
+so they are never forked from a process which has PyObjC and the
+Objective-C runtime loaded:
+
+  <key>Launcher</key>
+  <dict>
+    <key>shell</key>
+    <string>/bin/sh</string>
+  </dict>
+
+The helper is started by the first command and restarted if it exits.
+Requests and replies are JSON lines over a socketpair so commands still
+inherit crankd's stdout and stderr.
+
+This is not a performance feature: subprocess already avoids copying
+crankd's memory (it uses vfork or posix_spawn where it can), and the extra
+round trip to the helper makes each command slower to start.
+utilities/benchmarks/crankd_spawn.py measures the difference; on Linux
+with Python 3.11, about 1300 spawns/sec with subprocess against 800 with
+the launcher, with or without a large heap.
+
+This file is also the helper's main program and must not import anything
+from crankd.
+"""
+
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+DEFAULT_SHELL = "/bin/sh"
+
+
+class Launcher(object):
+  """Runs shell commands using a helper process."""
+
+  def __init__(self, shell=DEFAULT_SHELL, python=None):
+    """Creates a Launcher; the helper is started by the first call.
+
+    Args:
+      shell: str, the shell used to run commands
+      python: optional str, the interpreter used for the helper
+    """
+    self.shell = shell
+    self.python = python or sys.executable
+    self.lock = threading.Lock()
+    self.ids = itertools.count(1)
+    # (sock, [threading.Event, reply]) for each request, indexed by its ID
+    self.waiting = dict()
+    self.process = None
+    self.sock = None
+    self.starts = 0
+    self.spawned = 0
+
+  def start(self):
+    """Starts the helper process. Called with self.lock held."""
+    ours, theirs = socket.socketpair()
+    try:
+      self.process = subprocess.Popen(
+          # -I keeps crankd's modules off the helper's sys.path:
+          [self.python, "-I", os.path.abspath(__file__),
+           str(theirs.fileno())],
+          pass_fds=[theirs.fileno()],
+          stdin=subprocess.DEVNULL)
+    finally:
+      theirs.close()
+
+    self.sock = ours
+    self.starts += 1
+    reader = threading.Thread(
+        target=self.read_replies,
+        args=(ours, ours.makefile("r")),
+        name="crankd-launcher")
+    reader.daemon = True
+    reader.start()
+    logging.debug("Started command launcher %d", self.process.pid)
+
+  def read_replies(self, sock, replies):
+    for line in replies:
+      reply = json.loads(line)
+      with self.lock:
+        unused_sock, waiter = self.waiting.pop(reply["id"], (None, None))
+      if waiter is not None:
+        waiter[1] = reply
+        waiter[0].set()
+
+    # The helper exited: fail any requests it won't answer.
+    with self.lock:
+      if self.sock is sock:
+        self.sock = None
+      for request_id, (request_sock, waiter) in list(self.waiting.items()):
+        if request_sock is sock:
+          del self.waiting[request_id]
+          waiter[0].set()
+
+  def call(self, command, env=None, timeout=None):
+    """Runs command with the shell and returns its exit status.
+
+    Args:
+      command: str
+      env: dict, the command's environment
+      timeout: optional float, seconds after which the command is killed
+
+    Returns:
+      int, negative if the command was killed by a signal
+
+    Raises:
+      OSError: if the command or the helper couldn't be started
+      subprocess.TimeoutExpired: if the command was killed after timeout
+    """
+    request_id = next(self.ids)
+    waiter = [threading.Event(), None]
+    request = json.dumps({
+        "id": request_id,
+        "args": [self.shell, "-c", command],
+        "env": env or {},
+        "timeout": timeout,
+    })
+
+    with self.lock:
+      if self.sock is None or self.process.poll() is not None:
+        self.start()
+      self.waiting[request_id] = (self.sock, waiter)
+      try:
+        self.sock.sendall(request.encode() + b"\n")
+      except OSError:
+        del self.waiting[request_id]
+        self.sock = None
+        raise
+      self.spawned += 1
+
+    waiter[0].wait()
+    reply = waiter[1]
+    if reply is None:
+      raise OSError("The command launcher exited while running %s" % command)
+    if "error" in reply:
+      raise OSError(reply.get("errno"), reply["error"])
+    if reply.get("timed_out"):
+      raise subprocess.TimeoutExpired(command, timeout)
+    return reply["returncode"]
+
+  def stats(self):
+    return {"starts": self.starts, "spawned": self.spawned}
+
+  def close(self, timeout=30):
+    """Stops the helper once its running commands have finished.
+
+    Args:
+      timeout: float, seconds to wait for the running commands, after which
+        the helper is killed. Commands it was still running aren't killed;
+        their calls raise OSError.
+    """
+    with self.lock:
+      sock, self.sock = self.sock, None
+      process, self.process = self.process, None
+    if sock is not None:
+      sock.shutdown(socket.SHUT_WR)
+      sock.close()
+    if process is not None:
+      try:
+        process.wait(timeout=timeout)
+      except subprocess.TimeoutExpired:
+        logging.warning("Killing command launcher %d after %ss",
+                        process.pid, timeout)
+        process.kill()
+        process.wait()
+
+
+def serve(sock):
+  """Runs requests received on sock until it is closed."""
+  write_lock = threading.Lock()
+  replies = sock.makefile("w")
+  threads = list()
+
+  def run(request):
+    reply = {"id": request["id"]}
+    try:
+      proc = subprocess.Popen(
+          request["args"], env=request["env"], stdin=subprocess.DEVNULL)
+      try:
+        reply["returncode"] = proc.wait(timeout=request["timeout"])
+      except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        reply["timed_out"] = True
+    except OSError as exc:
+      reply["error"] = str(exc)
+      reply["errno"] = exc.errno
+    with write_lock:
+      replies.write(json.dumps(reply) + "\n")
+      replies.flush()
+
+  requests = sock.makefile("r")
+  while True:
+    try:
+      line = requests.readline()
+    except KeyboardInterrupt:
+      # Control-C reaches our whole process group; crankd decides when to
+      # stop and will close the socket:
+      continue
+    if not line:
+      break
+    thread = threading.Thread(target=run, args=(json.loads(line),))
+    thread.start()
+    threads.append(thread)
+    threads = [t for t in threads if t.is_alive()]
+
+  for thread in threads:
+    thread.join()
+
+
+if __name__ == "__main__":
+  serve(socket.socket(fileno=int(sys.argv[1])))
@@ -0,0 +1,123 @@
+# encoding: utf-8
+"""Non-blocking and structured logging for crankd.
+
+By default every logging call writes to stderr and syslog before returning,
+so a slow disk or syslogd stalls the run loop. crankd --log-queue=N instead
+puts each record on a queue of at most N records which a background thread
+writes to the real handlers. When the queue is full new records are dropped,
+counted, and reported with a warning once there is space again.
+
+crankd --log-format=json writes one JSON object per line, e.g.
+
+  {"ts": 1288025012.51, "level": "INFO", "logger": "root",
+   "message": "Listening for these NSWorkspace notifications: ...",
+   "process": 213, "thread": "MainThread"}
+"""
+
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+
+DEFAULT_QUEUE_SIZE = 10000
+
+
+class JSONFormatter(logging.Formatter):
+  """Formats each record as a single line of JSON."""
+
+  def format(self, record):
+    entry = {
+        "ts": round(record.created, 6),
+        "level": record.levelname,
+        "logger": record.name,
+        "message": record.getMessage(),
+        "process": record.process,
+        "thread": record.threadName,
+    }
+    if record.exc_info:
+      entry["exception"] = self.formatException(record.exc_info)
+    if record.stack_info:
+      entry["stack"] = self.formatStack(record.stack_info)
+    return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+  """QueueHandler which drops and counts records when its queue is full."""
+
+  def __init__(self, log_queue, on_drop=None):
+    """Creates a DroppingQueueHandler.
+
+    Args:
+      log_queue: a bounded queue.Queue
+      on_drop: optional callable called whenever a record is dropped
+    """
+    super(DroppingQueueHandler, self).__init__(log_queue)
+    self.on_drop = on_drop
+    self.dropped = 0
+    self.unreported = 0
+
+  def prepare(self, record):
+    """Merges the message and arguments but, unlike QueueHandler, keeps
+    exc_info and stack_info so the writer's formatters still see them."""
+    record = copy.copy(record)
+    record.message = record.getMessage()
+    record.msg = record.message
+    record.args = None
+    return record
+
+  def enqueue(self, record):
+    # Called with self.lock held by Handler.handle()
+    try:
+      if self.unreported:
+        self.queue.put_nowait(self.drop_report(self.unreported))
+        self.unreported = 0
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+      self.unreported += 1
+      if self.on_drop is not None:
+        self.on_drop()
+
+  @staticmethod
+  def drop_report(count):
+    return logging.LogRecord(
+        "crankd", logging.WARNING, __file__, 0,
+        "%d log messages were dropped because the log queue was full",
+        (count,), None)
+
+
+class LogWriter(logging.handlers.QueueListener):
+  """Background thread which writes queued records to the real handlers."""
+
+  def enqueue_sentinel(self):
+    # Unlike QueueListener, wait for space rather than failing when full:
+    self.queue.put(self._sentinel)
+
+
+def start_queue_logging(logger=None, max_records=DEFAULT_QUEUE_SIZE,
+                        on_drop=None):
+  """Moves a logger's handlers behind a bounded queue and writer thread.
+
+  Args:
+    logger: optional logging.Logger, defaulting to the root logger
+    max_records: int, the most records which may be waiting
+    on_drop: optional callable called whenever a record is dropped
+
+  Returns:
+    the started LogWriter; call its stop() method to write any queued
+    records before exiting
+  """
+  if logger is None:
+    logger = logging.getLogger()
+
+  log_queue = queue.Queue(max_records)
+  handlers = list(logger.handlers)
+  writer = LogWriter(log_queue, *handlers, respect_handler_level=True)
+
+  for handler in handlers:
+    logger.removeHandler(handler)
+  logger.addHandler(DroppingQueueHandler(log_queue, on_drop=on_drop))
+
+  writer.start()
+  return writer
@@ -0,0 +1,340 @@
+# encoding: utf-8
+"""Handler latency, throughput and event loop metrics for crankd.
+
+crankd counts every handler invocation, its latency and its errors, how far
+the run loop's timer fires behind schedule and how many FSEvents were
+dropped. Sending SIGUSR1 logs the current values at the run loop's next
+timer tick; with a "Metrics" section in the configuration they are also
+written to a file periodically:
+
+  <key>Metrics</key>
+  <dict>
+    <key>path</key>
+    <string>/var/run/crankd.prom</string>
+    <key>format</key>
+    <string>prometheus</string>
+    <key>interval</key>
+    <real>60</real>
+  </dict>
+
+format is "json" (the default) or "prometheus", the text exposition format
+read by the node_exporter textfile collector.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets:
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+DEFAULT_INTERVAL = 60.0
+FORMATS = ("json", "prometheus")
+
+
+class Histogram(object):
+  """Counts observations in cumulative buckets, like a Prometheus histogram.
+
+  >>> h = Histogram(buckets=(0.1, 1.0))
+  >>> for value in (0.05, 0.5, 2.0):
+  ...   h.observe(value)
+  >>> h.cumulative()
+  [(0.1, 1), (1.0, 2), (inf, 3)]
+  """
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets) + (float("inf"),)
+    self.counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+
+  def merge(self, other):
+    """Adds the observations of a histogram with the same buckets."""
+    if other.buckets != self.buckets:
+      raise ValueError("Cannot merge histograms with different buckets")
+    self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+    self.count += other.count
+    self.sum += other.sum
+    self.max = max(self.max, other.max)
+
+  def percentile(self, pct):
+    """Returns an upper bound for the pct-th percentile, or None if empty.
+
+    This is the upper bound of the bucket holding the nearest-rank
+    observation, or the largest observation if that is smaller.
+
+    >>> h = Histogram(buckets=(0.1, 1.0))
+    >>> for value in (0.05, 0.06, 0.5, 2.0):
+    ...   h.observe(value)
+    >>> h.percentile(50), h.percentile(75), h.percentile(100)
+    (0.1, 1.0, 2.0)
+    """
+    if not self.count:
+      return None
+    rank = max(1, int(round(pct / 100.0 * self.count + 0.4999)))
+    for bound, total in self.cumulative():
+      if total >= rank:
+        return min(bound, self.max)
+    return self.max
+
+  def cumulative(self):
+    """Returns a list of (upper bound, observations <= bound)."""
+    total = 0
+    result = list()
+    for bound, count in zip(self.buckets, self.counts):
+      total += count
+      result.append((bound, total))
+    return result
+
+  def stats(self):
+    return {
+        "count": self.count,
+        "sum": self.sum,
+        "max": self.max,
+        "buckets": dict(("+Inf" if b == float("inf") else repr(b), c)
+                        for b, c in self.cumulative()),
+    }
+
+
+class HandlerMetrics(object):
+  """Invocation, error and latency metrics for one handler."""
+
+  def __init__(self, name):
+    self.name = name
+    self.invocations = 0
+    self.errors = 0
+    self.latency = Histogram()
+
+  def stats(self):
+    return {
+        "invocations": self.invocations,
+        "errors": self.errors,
+        "latency": self.latency.stats(),
+    }
+
+
+class InstrumentedHandler(object):
+  """Callable which times a handler and counts its invocations and errors."""
+
+  def __init__(self, registry, handler_metrics, func, kind="python"):
+    self.registry = registry
+    self.metrics = handler_metrics
+    self.func = func
+    self.kind = kind
+
+  def __call__(self, *args, **kwargs):
+    start = time.monotonic()
+    failed = True
+    try:
+      result = self.func(*args, **kwargs)
+      # do_shell returns the command's exit status, or None if it didn't run
+      failed = self.kind == "command" and result != 0
+      return result
+    finally:
+      self.registry.observe(self.metrics, time.monotonic() - start, failed)
+
+
+class Metrics(object):
+  """The metrics for a crankd process."""
+
+  def __init__(self, clock=time.time):
+    self.clock = clock
+    self.started = clock()
+    self.lock = threading.Lock()
+    self.handlers = dict()
+    self.counters = dict()
+    self.loop_lag = Histogram()
+
+  def instrument(self, name, func, kind="python"):
+    """Returns a callable which calls func and records its metrics.
+
+    Args:
+      name: str, the handler's name in the metrics
+      func: the handler
+      kind: "python" or "command"; commands with a non-zero exit status are
+        counted as errors
+    """
+    with self.lock:
+      if name not in self.handlers:
+        self.handlers[name] = HandlerMetrics(name)
+      return InstrumentedHandler(self, self.handlers[name], func, kind=kind)
+
+  def observe(self, handler_metrics, seconds, failed):
+    with self.lock:
+      handler_metrics.invocations += 1
+      handler_metrics.errors += failed
+      handler_metrics.latency.observe(seconds)
+
+  def increment(self, name, count=1):
+    """Adds count to the counter name, e.g. "fsevents_kernel_dropped"."""
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + count
+
+  def record_loop_lag(self, seconds):
+    """Records how late a run loop timer fired."""
+    with self.lock:
+      self.loop_lag.observe(max(0.0, seconds))
+
+  def snapshot(self):
+    """Returns every metric as a dict which can be serialized as JSON."""
+    with self.lock:
+      return {
+          "timestamp": self.clock(),
+          "uptime": self.clock() - self.started,
+          "handlers": dict((k, v.stats()) for k, v in self.handlers.items()),
+          "counters": dict(self.counters),
+          "loop_lag": self.loop_lag.stats(),
+      }
+
+
+class LagMeter(object):
+  """Measures how late a periodic timer fires compared with its schedule.
+
+  Like a CFRunLoopTimer, the schedule is fixed by the first call: each fire
+  is expected one interval after the previous expected one, so a timer which
+  is late several times in a row reports each lateness against the schedule
+  rather than against its previous fire. When whole intervals are missed,
+  the timer skips them, and so does the schedule.
+  """
+
+  def __init__(self, interval, clock=time.monotonic):
+    self.interval = interval
+    self.clock = clock
+    self.expected = None
+
+  def tick(self):
+    """Called by the timer; returns seconds late, or None on the first call.
+
+    >>> now = [100.0]
+    >>> meter = LagMeter(2.0, clock=lambda: now[0])
+    >>> meter.tick()
+    >>> now[0] = 102.5
+    >>> meter.tick()
+    0.5
+    >>> now[0] = 104.25
+    >>> meter.tick()
+    0.25
+    >>> now[0] = 109.0  # 106 was missed, 108 is skipped
+    >>> meter.tick()
+    3.0
+    >>> now[0] = 110.0
+    >>> meter.tick()
+    0.0
+    """
+    now = self.clock()
+    if self.expected is None:
+      self.expected = now + self.interval
+      return None
+    lag = now - self.expected
+    missed = int(max(lag, 0) // self.interval)
+    self.expected += self.interval * (missed + 1)
+    return lag
+
+
+def escape_label(value):
+  return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+          .replace('"', '\\"'))
+
+
+def format_prometheus(snapshot):
+  """Returns a snapshot in the Prometheus text exposition format."""
+  lines = list()
+
+  def histogram(name, help_text, series):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s histogram" % name)
+    for labels, stats in series:
+      prefix = "".join('%s="%s",' % (k, escape_label(v)) for k, v in labels)
+      for bound, count in stats["buckets"].items():
+        lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+      labels = "{%s}" % prefix.rstrip(",") if prefix else ""
+      lines.append("%s_sum%s %r" % (name, labels, stats["sum"]))
+      lines.append("%s_count%s %d" % (name, labels, stats["count"]))
+
+  handlers = sorted(snapshot["handlers"].items())
+  for metric, help_text in (("invocations", "Handler invocations"),
+                            ("errors", "Handler exceptions or failed commands")):
+    name = "crankd_handler_%s_total" % metric
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s counter" % name)
+    for handler, stats in handlers:
+      lines.append('%s{handler="%s"} %d' %
+                   (name, escape_label(handler), stats[metric]))
+
+  histogram("crankd_handler_latency_seconds", "Handler run time",
+            [((("handler", h),), s["latency"]) for h, s in handlers])
+  histogram("crankd_event_loop_lag_seconds",
+            "How late the run loop timer fired", [((), snapshot["loop_lag"])])
+
+  for counter, value in sorted(snapshot["counters"].items()):
+    name = "crankd_%s_total" % counter
+    lines.append("# TYPE %s counter" % name)
+    lines.append("%s %d" % (name, value))
+
+  lines.append("# TYPE crankd_uptime_seconds gauge")
+  lines.append("crankd_uptime_seconds %r" % snapshot["uptime"])
+  return "\n".join(lines) + "\n"
+
+
+def format_summary(snapshot):
+  """Returns a list of log lines summarizing a snapshot."""
+  lines = list()
+  for name, stats in sorted(snapshot["handlers"].items()):
+    latency = stats["latency"]
+    mean = latency["sum"] / latency["count"] if latency["count"] else 0
+    lines.append("%s: %d invocations, %d errors, latency mean %0.1fms "
+                 "max %0.1fms" % (name, stats["invocations"], stats["errors"],
+                                  mean * 1000, latency["max"] * 1000))
+
+  lag = snapshot["loop_lag"]
+  if lag["count"]:
+    lines.append("event loop lag: mean %0.1fms max %0.1fms" %
+                 (lag["sum"] / lag["count"] * 1000, lag["max"] * 1000))
+  for name, value in sorted(snapshot["counters"].items()):
+    lines.append("%s: %d" % (name, value))
+  return lines
+
+
+class MetricsFile(object):
+  """Periodically and atomically writes metrics to a file."""
+
+  def __init__(self, path, fmt="json", interval=DEFAULT_INTERVAL):
+    if fmt not in FORMATS:
+      raise ValueError("Unknown metrics format %r: use %s" %
+                       (fmt, " or ".join(FORMATS)))
+    self.path = path
+    self.format = fmt
+    self.interval = interval
+
+  def write(self, snapshot):
+    if self.format == "prometheus":
+      text = format_prometheus(snapshot)
+    else:
+      text = json.dumps(snapshot, indent=2, sort_keys=True)
+
+    directory = os.path.dirname(self.path) or "."
+    tmp_name = None
+    try:
+      fd, tmp_name = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+      with os.fdopen(fd, "w") as f:
+        f.write(text)
+      # The textfile collector and others read the file by name:
+      os.chmod(tmp_name, 0o644)
+      os.replace(tmp_name, self.path)
+    except (OSError, IOError) as exc:
+      logging.error("Unable to write metrics to %s: %s", self.path, exc)
+      if tmp_name is not None and os.path.exists(tmp_name):
+        os.unlink(tmp_name)
@@ -0,0 +1,230 @@
+# encoding: utf-8
+"""Incremental reloading of the crankd configuration.
+
+crankd watches its configuration file and every loaded module. Restarting
+with exec() whenever one changes means importing PyObjC again, rebuilding
+every subscription and losing any events which were queued or coalesced.
+Instead, the old and new configurations are compared and only the handlers
+which were added, removed or changed are updated:
+
+  diff = reload.reload_config(old_config, new_config)
+
+A changed handler module is reloaded in place with importlib.reload() and
+every handler which uses it is treated as changed. RestartRequired is raised,
+and crankd falls back to a full restart, when something can't be updated
+incrementally: a top-level section other than NSWorkspace,
+SystemConfiguration and FSEvents changed (e.g. imports or Executor) or a
+module can't be reloaded safely.
+"""
+
+import importlib
+import logging
+import plistlib
+import sys
+import time
+
+from PyMacAdmin.crankd import core
+
+SECTIONS = ("NSWorkspace", "SystemConfiguration", "FSEvents")
+
+
+class RestartRequired(RuntimeError):
+  """The change can only be applied by restarting crankd."""
+  pass
+
+
+def read_config(path):
+  """Returns the configuration in path.
+
+  Unlike core.load_config this never creates a file or exits.
+
+  Raises:
+    RestartRequired: if the file can't be read
+  """
+  try:
+    with open(path, "rb") as f:
+      return plistlib.load(f)
+  except (OSError, ValueError, plistlib.InvalidFileException) as exc:
+    raise RestartRequired("Unable to read %s: %s" % (path, exc))
+
+
+def handler_modules(event_config):
+  """Returns the names of the modules which an event's handler comes from.
+
+  >>> sorted(handler_modules({"method": ["handlers.Mounts", "on_mount"]}))
+  ['handlers']
+  >>> handler_modules({"command": "/usr/bin/true"})
+  set()
+  """
+  names = list()
+  if "function" in event_config:
+    names.append(event_config["function"])
+  if "class" in event_config:
+    names.append(event_config["class"])
+  if "method" in event_config:
+    names.append(event_config["method"][0])
+  return set(core.get_mod_func(name)[0] for name in names)
+
+
+def config_modules(config):
+  """Returns the names of every handler module used by config."""
+  names = set()
+  for section in SECTIONS:
+    for event_config in config.get(section, {}).values():
+      names.update(handler_modules(event_config))
+  return names
+
+
+def reloadable(name):
+  """Returns True if module name can safely be reloaded in place.
+
+  crankd's own modules hold its state and PyObjC can't redefine an
+  Objective-C class, so neither is ever reloaded.
+  """
+  if name == "__main__" or name.split(".")[0] == "PyMacAdmin":
+    return False
+
+  module = sys.modules.get(name)
+  if module is None:
+    return True  # Lazy handlers will import the current version
+
+  for value in vars(module).values():
+    if isinstance(value, type) and type(value).__module__ == "objc":
+      return False
+  return True
+
+
+class ConfigDiff(object):
+  """The events added, removed or changed in each section of a configuration.
+
+  added, removed and changed are dicts mapping each section name to a list of
+  event names. restart_reasons lists the changes which can't be applied
+  incrementally.
+  """
+
+  def __init__(self, old, new, changed_modules=()):
+    changed_modules = set(changed_modules)
+
+    self.added = dict()
+    self.removed = dict()
+    self.changed = dict()
+    self.elapsed = None
+
+    for section in SECTIONS:
+      old_section = old.get(section, {})
+      new_section = new.get(section, {})
+      self.added[section] = [i for i in new_section if i not in old_section]
+      self.removed[section] = [i for i in old_section if i not in new_section]
+      self.changed[section] = [
+          i for i in new_section
+          if i in old_section and (
+              old_section[i] != new_section[i] or
+              handler_modules(new_section[i]) & changed_modules)
+      ]
+
+    self.restart_reasons = [
+        "%s changed" % key
+        for key in sorted(set(old) | set(new))
+        if key not in SECTIONS and old.get(key) != new.get(key)
+    ]
+
+  def __bool__(self):
+    return any(self.added[s] or self.removed[s] or self.changed[s]
+               for s in SECTIONS)
+
+  def summary(self):
+    """Returns a one-line description of the changes."""
+    parts = list()
+    for section in SECTIONS:
+      counts = [(len(self.added[section]), "added"),
+                (len(self.removed[section]), "removed"),
+                (len(self.changed[section]), "changed")]
+      counts = ["%d %s" % i for i in counts if i[0]]
+      if counts:
+        parts.append("%s: %s" % (section, ", ".join(counts)))
+    return "; ".join(parts) or "no handlers changed"
+
+
+def reload_modules(names):
+  """Reloads handler modules in place and forgets their handler objects."""
+  for name in names:
+    if name not in sys.modules:
+      continue
+    logging.info("Reloading module %s", name)
+    importlib.reload(sys.modules[name])
+    for class_name in list(core.HANDLER_OBJECTS):
+      if core.get_mod_func(class_name)[0] == name:
+        del core.HANDLER_OBJECTS[class_name]
+
+
+def apply_diff(diff, config):
+  """Updates the crankd core's handlers to match config.
+
+  NSWorkspace "class" handlers are not managed by the core; the caller must
+  update their observers.
+
+  Args:
+    diff: ConfigDiff between the current configuration and config
+    config: dict, the new configuration
+  """
+  nsw_config = config.get("NSWorkspace", {})
+  for event in diff.removed["NSWorkspace"] + diff.changed["NSWorkspace"]:
+    core.remove_workspace_handler(event)
+  core.add_workspace_handlers(
+      dict((i, nsw_config[i])
+           for i in diff.added["NSWorkspace"] + diff.changed["NSWorkspace"]))
+
+  sc_config = config.get("SystemConfiguration", {})
+  core.remove_sc_handlers(diff.removed["SystemConfiguration"] +
+                          diff.changed["SystemConfiguration"])
+  # Changed handlers keep their place, so overlapping patterns still fire
+  # in configuration order:
+  core.add_sc_handlers(
+      dict((i, sc_config[i]) for i in diff.added["SystemConfiguration"] +
+           diff.changed["SystemConfiguration"]),
+      order=list(sc_config))
+
+  fs_config = config.get("FSEvents", {})
+  for path in diff.removed["FSEvents"] + diff.changed["FSEvents"]:
+    core.remove_fs_handler(path)
+  core.add_fs_handlers(
+      dict((i, fs_config[i])
+           for i in diff.added["FSEvents"] + diff.changed["FSEvents"]))
+
+
+def reload_config(old, new, changed_modules=(), clock=time.monotonic):
+  """Applies a new configuration and changed modules without restarting.
+
+  Args:
+    old: dict, the configuration currently in use
+    new: dict, the configuration to switch to
+    changed_modules: names of modules whose files have changed
+    clock: optional callable returning the current time in seconds
+
+  Returns:
+    ConfigDiff, with elapsed set to the seconds taken
+
+  Raises:
+    RestartRequired: if the changes can't be applied incrementally. Nothing
+      has been changed when this is raised.
+  """
+  start = clock()
+  diff = ConfigDiff(old, new, changed_modules)
+
+  used = config_modules(new)
+  for name in changed_modules:
+    if name not in used:
+      diff.restart_reasons.append("Module %s is not a handler module" % name)
+    elif not reloadable(name):
+      diff.restart_reasons.append("Module %s can't be reloaded" % name)
+
+  if diff.restart_reasons:
+    raise RestartRequired("; ".join(diff.restart_reasons))
+
+  reload_modules(changed_modules)
+  apply_diff(diff, new)
+
+  diff.elapsed = clock() - start
+  logging.info("Reloaded configuration in %0.1fms: %s", diff.elapsed * 1000,
+               diff.summary())
+  return diff
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Recording and replaying crankd events.
+
+crankd --record=FILE appends every event it dispatches to FILE as one
+compact JSON object per line, in the format read by sources.ReplaySource:
+
+  {"ts":1288025012.51,"source":"FSEvents","path":"/Library/Preferences",
+   "flags":0,"recursive":false}
+
+This module replays such a log against a configuration and reports
+throughput, handler latency, how long dispatching took and how many events
+were coalesced or dropped by the executor's queues:
+
+  python3 -m PyMacAdmin.crankd.replay --config=crankd.plist events.jsonl
+  python3 -m PyMacAdmin.crankd.replay --config=crankd.plist --speed=10 ...
+
+Without a recording, --synthesize=N writes N events covering every key, path
+and notification in the configuration (e.g. the output of
+examples/crankd/sample-of-events/generate-event-plist.py).
+"""
+
+import json
+import logging
+import optparse
+import os
+import random
+import sys
+import time
+
+from PyMacAdmin.crankd import core
+from PyMacAdmin.crankd import metrics
+from PyMacAdmin.crankd import sources
+
+
+class EventRecorder(object):
+  """Appends dispatched events to a JSON-lines file."""
+
+  def __init__(self, path, flush_interval=1.0, clock=time.time):
+    """Opens path for appending.
+
+    Args:
+      path: str, the log file
+      flush_interval: float, seconds between flushes of the log
+      clock: optional callable returning the current time in seconds
+    """
+    self.path = path
+    self.file = open(path, "a")
+    self.flush_interval = flush_interval
+    self.clock = clock
+    self.last_flush = clock()
+    self.count = 0
+
+  def record(self, source, **fields):
+    """Writes one event.
+
+    Args:
+      source: str, "FSEvents", "SystemConfiguration" or "NSWorkspace"
+      **fields: the event's arguments, e.g. path or keys
+    """
+    now = self.clock()
+    record = {"ts": round(now, 6), "source": source}
+    for k, v in fields.items():
+      if v is None:
+        continue
+      if k == "user_info" and not isinstance(v, dict):
+        v = dict(v)  # e.g. an NSDictionary
+      record[k] = v
+
+    self.file.write(json.dumps(record, separators=(",", ":"), default=str))
+    self.file.write("\n")
+    self.count += 1
+
+    if now - self.last_flush >= self.flush_interval:
+      self.flush()
+
+  def flush(self):
+    self.file.flush()
+    self.last_flush = self.clock()
+
+  def close(self):
+    if not self.file.closed:
+      self.file.close()
+
+
+def percentile(values, pct):
+  """Returns the pct-th percentile of a sorted list using the nearest rank.
+
+  >>> percentile([1, 2, 3, 4], 50)
+  2
+  >>> percentile([1, 2, 3, 4], 99)
+  4
+  """
+  if not values:
+    return None
+  rank = max(1, int(round(pct / 100.0 * len(values) + 0.4999)))
+  return values[min(rank, len(values)) - 1]
+
+
+def synthesize(config, count, seed=0, interval=0.01):
+  """Returns count events for the handlers configured in config.
+
+  Args:
+    config: dict, a crankd configuration
+    count: int, the number of events
+    seed: int, seeds the random choice of events
+    interval: float, seconds between the events' timestamps
+
+  Returns:
+    list of dicts in the ReplaySource format
+  """
+  rng = random.Random(seed)
+  choices = list()
+  for key in config.get("SystemConfiguration", {}):
+    choices.append({"source": "SystemConfiguration", "keys": [key]})
+  for path in config.get("FSEvents", {}):
+    choices.append({"source": "FSEvents", "path": path})
+  for name in config.get("NSWorkspace", {}):
+    choices.append({"source": "NSWorkspace", "name": name})
+
+  if not choices:
+    raise ValueError("The configuration has no events to synthesize")
+
+  events = list()
+  for i in range(count):
+    event = dict(rng.choice(choices))
+    event["ts"] = round(i * interval, 6)
+    events.append(event)
+  return events
+
+
+def add_handlers(config):
+  """Configures the crankd core for everything in config except class handlers.
+
+  FSEvents paths which don't exist on this system are logged and skipped.
+  """
+  core.configure_executor(config)
+  core.configure_launcher(config)
+
+  if "NSWorkspace" in config:
+    core.add_workspace_handlers(config["NSWorkspace"])
+
+  if "SystemConfiguration" in config:
+    core.add_sc_handlers(config["SystemConfiguration"])
+
+  fs_config = config.get("FSEvents", {})
+  for path in fs_config:
+    try:
+      core.add_fs_notification(
+          path,
+          core.get_callable_for_event(
+              path, fs_config[path], context="FSEvent: %s" % path))
+    except AttributeError as exc:
+      logging.warning("Skipping FSEvents handler: %s", exc)
+
+
+def replay(events, speed=None):
+  """Replays events through the crankd core and returns statistics.
+
+  Args:
+    events: a filename or an iterable accepted by ReplaySource
+    speed: None to replay as fast as possible, otherwise a multiple of the
+      recorded rate
+
+  Returns:
+    dict; latency_pN are upper bounds of the handlers' run time percentiles
+    from the METRICS histograms, whether they ran in the dispatcher or the
+    executor, and dispatch_pN the time taken to dispatch each event, which
+    with the executor is only the time taken to queue it. errors counts
+    handler exceptions and failed commands, dispatch_errors the events
+    whose dispatch, or coalesced delivery, raised. executor_dropped counts
+    the handler calls dropped because an executor queue's max_pending was
+    reached; replay itself drops no events.
+  """
+  source = sources.ReplaySource(events, speed=speed, measure=True)
+
+  start = time.monotonic()
+  sources.run([source], until_done=True)
+  dispatched = time.monotonic() - start
+  dispatch_errors = source.errors
+  # Deliver the coalesced events here, so a handler exception is counted
+  # rather than ending the replay:
+  for coalescer in core.COALESCERS:
+    try:
+      coalescer.flush(force=True)
+    except Exception:  # pylint: disable=W0703
+      dispatch_errors += 1
+      logging.exception("Delivering coalesced events to %s failed",
+                        coalescer.name)
+  core.shutdown_handlers(timeout=None)
+  elapsed = time.monotonic() - start
+
+  dispatch_latencies = sorted(source.latencies)
+  latency = metrics.Histogram()
+  errors = 0
+  with core.METRICS.lock:
+    for handler_metrics in core.METRICS.handlers.values():
+      latency.merge(handler_metrics.latency)
+      errors += handler_metrics.errors
+
+  stats = {
+      "events": source.delivered,
+      "seconds": elapsed,
+      "events_per_second": source.delivered / elapsed if elapsed else None,
+      "dispatch_seconds": dispatched,
+      "max_lag": source.max_lag,
+      "executor_dropped": 0,
+      "coalesced": sum(c.collapsed for c in core.COALESCERS),
+      "errors": errors,
+      "dispatch_errors": dispatch_errors,
+      "handler_import_seconds": sum(core.HANDLER_IMPORT_TIMES.values()),
+  }
+
+  for pct in (50, 90, 99, 100):
+    stats["latency_p%d" % pct] = latency.percentile(pct)
+    stats["dispatch_p%d" % pct] = percentile(dispatch_latencies, pct)
+
+  if core.CRANKD_EXECUTOR is not None:
+    for queue_stats in core.CRANKD_EXECUTOR.stats().values():
+      stats["executor_dropped"] += queue_stats["dropped"]
+
+  return stats
+
+
+def format_stats(stats):
+  lines = ["%d events in %0.3fs: %0.0f events/sec" %
+           (stats["events"], stats["seconds"], stats["events_per_second"] or 0)]
+  lines.append("handler latency (upper bounds): " + ", ".join(
+      "p%d<=%0.3fms" % (pct, (stats["latency_p%d" % pct] or 0) * 1000)
+      for pct in (50, 90, 99, 100)))
+  lines.append("dispatch time: " + ", ".join(
+      "p%d=%0.3fms" % (pct, (stats["dispatch_p%d" % pct] or 0) * 1000)
+      for pct in (50, 90, 99, 100)))
+  if stats["max_lag"] is not None:
+    lines.append("max lag behind recorded schedule: %0.3fs" % stats["max_lag"])
+  lines.append("dropped by executor queues: %(executor_dropped)d, "
+               "coalesced: %(coalesced)d, "
+               "handler errors: %(errors)d, dispatch errors: "
+               "%(dispatch_errors)d" % stats)
+  lines.append("handler imports: %0.3fms" %
+               (stats["handler_import_seconds"] * 1000))
+  return "\n".join(lines)
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(
+      "Usage: %prog --config=FILE [--speed=N] [--json] EVENT_LOG\n"
+      "       %prog --config=FILE --synthesize=N EVENT_LOG")
+  parser.add_option("-f", "--config", dest="config_file",
+                    help="crankd configuration file")
+  parser.add_option("--speed", type="float", default=0,
+                    help="Replay at N times the recorded rate (default: as "
+                    "fast as possible)")
+  parser.add_option("--synthesize", type="int", default=0, metavar="N",
+                    help="Write N synthetic events to EVENT_LOG and exit")
+  parser.add_option("--json", action="store_true", default=False,
+                    help="Print statistics as JSON")
+  parser.add_option("-d", "--debug", action="store_true", default=False)
+  (options, args) = parser.parse_args(argv)
+
+  if len(args) != 1 or not options.config_file:
+    parser.error("A configuration file and event log are required")
+  # core.load_config would write an example configuration:
+  if not os.path.exists(options.config_file):
+    parser.error("%s does not exist" % options.config_file)
+
+  logging.basicConfig(level=logging.DEBUG if options.debug else logging.WARNING,
+                      format="%(levelname)s: %(message)s")
+
+  config = core.load_config(options)
+
+  if options.synthesize:
+    with open(args[0], "w") as f:
+      for event in synthesize(config, options.synthesize):
+        f.write(json.dumps(event, separators=(",", ":")))
+        f.write("\n")
+    return
+
+  add_handlers(config)
+  stats = replay(args[0], speed=options.speed or None)
+
+  if options.json:
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    print()
+  else:
+    print(format_stats(stats))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,365 @@
+# encoding: utf-8
+"""Event sources which feed the crankd core without PyObjC.
+
+On Mac OS X, bin/crankd.py receives events from the Cocoa run loop. The
+sources here allow the same configuration, dispatch and handler code to run
+elsewhere: InotifySource watches FSEvents paths using Linux inotify and
+ReplaySource reads recorded events from a JSON-lines file, one per line:
+
+  {"source": "FSEvents", "path": "/Library/Preferences", "recursive": false}
+  {"source": "SystemConfiguration", "keys": ["State:/Network/Global/IPv4"]}
+  {"source": "NSWorkspace", "name": "NSWorkspaceDidWakeNotification",
+   "user_info": {}}
+
+run() drives any combination of sources with a select()-based loop.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import selectors
+import struct
+import time
+
+from PyMacAdmin.crankd import core
+
+
+class EventSource(object):
+  """Base class for anything which delivers events to the crankd core.
+
+  Sources deliver events using the dispatch_sc_event, dispatch_fs_event and
+  dispatch_workspace_event functions of their dispatcher, which is normally
+  the PyMacAdmin.crankd.core module.
+  """
+
+  # Set once a source will never deliver further events:
+  done = False
+
+  def __init__(self, dispatcher=None):
+    self.dispatcher = dispatcher or core
+
+  def start(self):
+    """Begins watching for events."""
+    pass
+
+  def stop(self):
+    """Releases any resources held by the source."""
+    pass
+
+  def fileno(self):
+    """Returns a file descriptor which is readable when events are waiting.
+
+    Sources which return None are processed when timeout() expires instead.
+    """
+    return None
+
+  def timeout(self):
+    """Returns seconds until process() should be called, or None to wait."""
+    return None
+
+  def process(self):
+    """Delivers any events which are waiting."""
+    raise NotImplementedError
+
+
+# From <sys/inotify.h>:
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifySource(EventSource):
+  """Delivers FSEvents-style directory change events using Linux inotify.
+
+  FSEvents streams are recursive, so every directory below a watched path is
+  also watched, including directories created after the source starts.
+  """
+
+  MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+          IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+          IN_ONLYDIR)
+
+  def __init__(self, paths=None, dispatcher=None):
+    """Creates an InotifySource.
+
+    Args:
+      paths: list of directories, defaulting to the dispatcher's
+        FS_WATCHED_FILES when the source is started
+      dispatcher: optional, see EventSource
+    """
+    super(InotifySource, self).__init__(dispatcher)
+    self.paths = paths
+    self.fd = None
+    self.watches = dict()
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+  def start(self):
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, "inotify_init1: %s" % os.strerror(err))
+
+    paths = self.paths
+    if paths is None:
+      paths = list(self.dispatcher.FS_WATCHED_FILES)
+    for path in paths:
+      self.add_tree(path)
+
+  def stop(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+    self.watches.clear()
+
+  def fileno(self):
+    return self.fd
+
+  def add_watch(self, path):
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      # Directories can vanish between the event and our watch:
+      if err not in (errno.ENOENT, errno.ENOTDIR):
+        logging.warning("Unable to watch %s: %s", path, os.strerror(err))
+      return
+    self.watches[wd] = os.fsdecode(path)
+
+  def add_tree(self, path):
+    self.add_watch(path)
+    for dirpath, dirnames, unused_filenames in os.walk(path):
+      for dirname in dirnames:
+        self.add_watch(os.path.join(dirpath, dirname))
+
+  def read_events(self):
+    """Returns a list of (directory, mask, name) for every pending event."""
+    events = list()
+    while True:
+      try:
+        buf = os.read(self.fd, 65536)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset < len(buf):
+        wd, mask, unused_cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+        offset += INOTIFY_EVENT.size
+        name = buf[offset:offset + length].rstrip(b"\0")
+        offset += length
+        events.append((self.watches.get(wd), mask, os.fsdecode(name)))
+        if mask & IN_IGNORED:
+          self.watches.pop(wd, None)
+    return events
+
+  def process(self):
+    changed = list()
+    recursive = False
+
+    for directory, mask, name in self.read_events():
+      if mask & IN_Q_OVERFLOW:
+        logging.error("The kernel was too slow processing inotify events "
+                      "and some events were dropped!")
+        recursive = True
+        continue
+      if directory is None:
+        continue
+      if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+        self.add_tree(os.path.join(directory, name))
+      # Like FSEvents, we report each changed directory once per batch:
+      if directory not in changed:
+        changed.append(directory)
+
+    if recursive:
+      changed = list(self.dispatcher.FS_WATCHED_FILES) or changed
+
+    for directory in changed:
+      self.dispatcher.dispatch_fs_event(directory, recursive=recursive)
+
+
+class ReplaySource(EventSource):
+  """Delivers events recorded in a JSON-lines file.
+
+  Events are delivered as quickly as possible unless a speed is given, in
+  which case their "ts" timestamps are honoured: speed=1 replays at the
+  recorded rate and speed=10 ten times faster.
+  """
+
+  # Events delivered per call to process() so timers and other sources
+  # still run during a long replay:
+  BATCH_SIZE = 1000
+
+  def __init__(self, events, dispatcher=None, speed=None, measure=False,
+               clock=time.monotonic):
+    """Creates a ReplaySource.
+
+    Args:
+      events: a filename, or an iterable of JSON strings or dicts
+      dispatcher: optional, see EventSource
+      speed: optional float, multiple of the recorded event rate
+      measure: bool, record the time taken to dispatch each event in
+        self.latencies
+      clock: optional callable returning the current time in seconds
+    """
+    super(ReplaySource, self).__init__(dispatcher)
+    self.events = events
+    self.speed = speed
+    self.measure = measure
+    self.clock = clock
+    self.records = None
+    self.file = None
+    self.next = None
+    self.first_ts = None
+    self.started = None
+    self.delivered = 0
+    # Events whose dispatch raised, e.g. from a synchronous handler:
+    self.errors = 0
+    self.latencies = list()
+    # How far, in seconds, delivery fell behind the recorded schedule:
+    self.max_lag = None
+
+  def start(self):
+    events = self.events
+    if isinstance(events, str):
+      events = self.file = open(events)
+    self.records = iter(events)
+    self.started = self.clock()
+
+  def stop(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  def next_record(self):
+    """Returns the next event as a dict, or None at the end of the input."""
+    if self.next is None:
+      for record in self.records:
+        if not isinstance(record, dict):
+          record = record.strip()
+          if not record:
+            continue
+          record = json.loads(record)
+        self.next = record
+        break
+    return self.next
+
+  def due(self, record):
+    """Returns the clock time at which record should be delivered or None."""
+    if self.speed is None or "ts" not in record:
+      return None
+    if self.first_ts is None:
+      self.first_ts = record["ts"]
+    return self.started + (record["ts"] - self.first_ts) / self.speed
+
+  def timeout(self):
+    if self.done:
+      return None
+    record = self.next_record()
+    due = None if record is None else self.due(record)
+    if due is None:
+      return 0
+    return max(0, due - self.clock())
+
+  def process(self):
+    for unused_i in range(self.BATCH_SIZE):
+      record = self.next_record()
+      if record is None:
+        self.done = True
+        return
+
+      due = self.due(record)
+      if due is not None:
+        lag = self.clock() - due
+        if lag < 0:
+          return
+        self.max_lag = max(self.max_lag or 0, lag)
+
+      self.next = None
+      start = self.clock()
+      try:
+        dispatch_record(record, self.dispatcher)
+      except Exception:  # pylint: disable=W0703
+        self.errors += 1
+        logging.exception("Replaying %r failed", record)
+      if self.measure:
+        self.latencies.append(self.clock() - start)
+      self.delivered += 1
+
+
+def dispatch_record(record, dispatcher=None):
+  """Delivers one event in the ReplaySource format.
+
+  Raises:
+    ValueError: if the record has an unknown source
+  """
+  dispatcher = dispatcher or core
+  source = record.get("source")
+
+  if source == "FSEvents":
+    dispatcher.dispatch_fs_event(
+        record["path"], recursive=record.get("recursive", False))
+  elif source == "SystemConfiguration":
+    dispatcher.dispatch_sc_event(record["keys"], record.get("info"))
+  elif source == "NSWorkspace":
+    dispatcher.dispatch_workspace_event(record["name"],
+                                        record.get("user_info"))
+  else:
+    raise ValueError("Unknown event source %r" % source)
+
+
+def run(sources, timers=(), until_done=False, clock=time.monotonic):
+  """Runs an event loop for sources until interrupted.
+
+  Args:
+    sources: list of EventSource instances
+    timers: list of (interval, callable) tuples called every interval seconds
+    until_done: bool, return once every source is done
+    clock: optional callable returning the current time in seconds
+  """
+  selector = selectors.DefaultSelector()
+  for source in sources:
+    source.start()
+    if source.fileno() is not None:
+      selector.register(source.fileno(), selectors.EVENT_READ, source)
+
+  now = clock()
+  deadlines = [now + interval for interval, unused_callback in timers]
+
+  try:
+    while not (until_done and all(s.done for s in sources)):
+      waits = [d - now for d in deadlines]
+      waits.extend(
+          s.timeout() for s in sources if s.timeout() is not None)
+      wait = max(0, min(waits)) if waits else None
+
+      for key, unused_events in selector.select(wait):
+        key.data.process()
+
+      for source in sources:
+        if source.fileno() is None and source.timeout() is not None:
+          if source.timeout() <= 0:
+            source.process()
+
+      now = clock()
+      for i, (interval, callback) in enumerate(timers):
+        if now >= deadlines[i]:
+          callback()
+          deadlines[i] = now + interval
+  finally:
+    for source in sources:
+      source.stop()
+    selector.close()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import io
+import json
+import os
+import plistlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import check
+
+LIB_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(check.__file__), "..", ".."))
+CRANKD = os.path.join(os.path.dirname(LIB_DIR), "bin", "crankd.py")
+
+
+def messages(report, level=None):
+  return [(p["section"], p["key"], p["message"]) for p in report.problems
+          if level is None or p["level"] == level]
+
+
+class CheckTests(unittest.TestCase):
+  """Unit tests for crankd configuration checks"""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_valid(self):
+    report = check.check_config({
+        "SystemConfiguration": {
+            "State:/Network/Global/IPv4": {"command": "true", "debounce": 1},
+            "State:/Network/Global/IPv6": {"command": "true",
+                                           "max_latency": 0},
+            "State:/Network/Interface/en[0-9]+/Link": {
+                "function": "os.path.exists"
+            },
+        },
+        "FSEvents": {self.tmp_dir: {"command": "true"}},
+        "Executor": {"threads": 2},
+    })
+    self.assertEqual(report.problems, [])
+    cost = report.costs["SystemConfiguration"]
+    self.assertEqual((cost["exact"], cost["regexes"]), (2, 1))
+    self.assertEqual(report.costs["FSEvents"]["directories"], 1)
+
+  def test_errors(self):
+    report = check.check_config({
+        "SystemConfiguration": {
+            "State:/[": {"command": "true"},
+            "State:/Users/ConsoleUser": {"command": "a", "function": "b"},
+            "State:/Network/Global/IPv4": {"function": "os.no_such_function"},
+            "State:/Network/Global/IPv6": {"command": "true", "debounce": -1},
+        },
+        "FSEvents": {os.path.join(self.tmp_dir, "missing"): {"command": "x"}},
+        "Metrics": {"format": "xml"},
+        "Bogus": {},
+    })
+    errors = messages(report, check.ERROR)
+    self.assertEqual(len(errors), 7, errors)
+    self.assertIn(("Bogus", None, "unknown section"),
+                  messages(report, check.WARNING))
+    self.assertIn("7 error(s)", report.format())
+
+  def test_bool_options(self):
+    report = check.check_config({
+        "SystemConfiguration": {
+            "State:/Network/Global/IPv4": {"command": "true", "debounce": True},
+            "State:/Network/Global/IPv6": {"command": "true",
+                                           "concurrency": True},
+        },
+        "Executor": {"threads": True},
+        "Metrics": {"path": "metrics.json", "interval": True},
+    })
+    self.assertEqual(len(messages(report, check.ERROR)), 4)
+
+  def test_no_import(self):
+    report = check.check_config(
+        {"NSWorkspace": {"NSWorkspaceDidWakeNotification": {
+            "class": "macos_only.Handler"}}},
+        resolve=False)
+    self.assertEqual(report.problems, [])
+
+  def test_redundant_sc_patterns(self):
+    handler = {"command": "true"}
+    report = check.check_config({
+        "SystemConfiguration": {
+            "State:/Network/Global/.*": handler,
+            "^State:/Network/Global/": {"command": "other"},
+            "State:/Network/Interface/en0/Link": handler,
+            "State:/Network/Interface/en0/Link/.*": handler,
+            "State:/Users/.*": {"command": "users"},
+            "State:/Users/ConsoleUser": {"command": "console"},
+        }
+    })
+    warnings = messages(report, check.WARNING)
+    keys = sorted(key for unused_section, key, unused_message in warnings)
+    self.assertEqual(keys, [
+        "State:/Network/Interface/en0/Link/.*", "State:/Users/.*",
+        "^State:/Network/Global/"
+    ])
+
+  def test_overlapping_fs_paths(self):
+    child = os.path.join(self.tmp_dir, "child")
+    os.mkdir(child)
+    file_name = os.path.join(self.tmp_dir, "file")
+    open(file_name, "w").close()
+
+    report = check.check_config({
+        "FSEvents": {
+            self.tmp_dir: {"command": "true"},
+            child: {"command": "true"},
+            file_name: {"command": "true"},
+        }
+    })
+    warnings = [(key, message.split(":")[0].split(" %s" % self.tmp_dir)[0])
+                for unused_section, key, message in messages(report)]
+    self.assertEqual(sorted(warnings), [
+        (child, "is inside"),
+        (file_name, "is a file"),
+        (file_name, "watches the same directory as"),
+    ])
+    self.assertEqual(report.costs["FSEvents"]["directories"], 2)
+
+  def test_main(self):
+    config_file = os.path.join(self.tmp_dir, "crankd.plist")
+    with open(config_file, "wb") as f:
+      plistlib.dump({"FSEvents": {self.tmp_dir: {"command": "true"}}}, f)
+
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+      status = check.main(["--json", config_file])
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+
+    self.assertEqual(status, 0)
+    self.assertEqual(json.loads(output)["problems"], [])
+
+  @unittest.skipUnless(os.path.exists(CRANKD), "crankd.py is not installed")
+  def test_crankd_check(self):
+    config_file = os.path.join(self.tmp_dir, "crankd.plist")
+    with open(config_file, "wb") as f:
+      plistlib.dump({"FSEvents": {self.tmp_dir: {"command": "true"}}}, f)
+
+    # crankd --check must not need PyObjC, which isn't installed off macOS:
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    status = subprocess.call([sys.executable, CRANKD, "--check", "-f",
+                              config_file], env=env,
+                             stdout=subprocess.DEVNULL)
+    self.assertEqual(status, 0)
+
+
+def load_tests(loader, tests, unused_pattern):
+  tests.addTests(doctest.DocTestSuite(check))
+  return tests
+
+
+if __name__ == "__main__":
+  unittest.main()
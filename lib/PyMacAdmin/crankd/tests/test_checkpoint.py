@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import checkpoint
+from PyMacAdmin.crankd import core
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class FakeStream(object):
+  """Emulates an FSEvents stream which can start from an event ID."""
+
+  def __init__(self, history):
+    self.history = history  # list of (event_id, path)
+
+  def batches(self, since, batch_size=3):
+    """Yields (paths, masks, ids) batches as FSEvents would deliver them."""
+    events = [(i, p, 0) for i, p in self.history if since and i > since]
+    if since:
+      events.append((0, "", checkpoint.FLAG_HISTORY_DONE))
+    for start in range(0, len(events), batch_size):
+      batch = events[start:start + batch_size]
+      yield ([p + "/" for unused_i, p, unused_f in batch],
+             [f for unused_i, unused_p, f in batch],
+             [i for i, unused_p, unused_f in batch])
+
+
+class CheckpointTests(unittest.TestCase):
+  """Unit tests for Checkpoint and core.dispatch_fsevents"""
+
+  def setUp(self):
+    core.reset_handlers()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.watched = os.path.join(self.tmp_dir, "watched")
+    os.mkdir(self.watched)
+    self.calls = list()
+    core.add_fs_notification(self.watched,
+                             lambda j, **kwargs: self.calls.append(kwargs))
+    self.clock = FakeClock()
+    self.path = os.path.join(self.tmp_dir, "checkpoint")
+
+  def tearDown(self):
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+
+  def run_stream(self, stream, max_catchup=None):
+    core.CHECKPOINT = checkpoint.Checkpoint(
+        self.path, interval=10, max_catchup=max_catchup, clock=self.clock)
+    for paths, masks, ids in stream.batches(core.CHECKPOINT.resume_id()):
+      core.dispatch_fsevents(paths, masks, ids)
+      self.clock.now += 1
+    core.CHECKPOINT.save()
+
+  def test_resume(self):
+    history = [(i, os.path.join(self.watched, "d%d" % i)) for i in range(1, 6)]
+    stream = FakeStream(history)
+
+    # The first run starts "now" and sees nothing
+    self.run_stream(stream)
+    self.assertEqual(self.calls, [])
+    self.assertFalse(os.path.exists(self.path))
+
+    with open(self.path, "w") as f:
+      f.write('{"event_id": 2}')
+    self.run_stream(stream)
+    self.assertEqual([c["path"] for c in self.calls],
+                     [p for i, p in history if i > 2])
+    self.assertEqual(checkpoint.Checkpoint(self.path).load(), 5)
+    self.assertFalse(core.CHECKPOINT.catching_up)
+
+    # Nothing has happened since event 5:
+    del self.calls[:]
+    self.run_stream(stream)
+    self.assertEqual(self.calls, [])
+
+  def test_catchup_cap(self):
+    history = [(i, self.watched) for i in range(1, 101)]
+    with open(self.path, "w") as f:
+      f.write('{"event_id": 1}')
+    self.run_stream(FakeStream(history), max_catchup=10)
+    self.assertEqual(len(self.calls), 11)
+    self.assertTrue(self.calls[-1]["recursive"])
+    self.assertEqual(checkpoint.Checkpoint(self.path).load(), 100)
+
+  def test_periodic_save(self):
+    cp = checkpoint.Checkpoint(self.path, interval=10, clock=self.clock)
+    cp.observe(7, 0)
+    cp.maybe_save()
+    self.assertEqual(cp.load(), None)
+    self.clock.now = 10
+    cp.maybe_save()
+    self.assertEqual(cp.load(), 7)
+    self.assertEqual(os.listdir(self.tmp_dir).count("checkpoint"), 1)
+
+  def test_unreadable_checkpoint(self):
+    with open(self.path, "w") as f:
+      f.write("garbage")
+    self.assertEqual(checkpoint.Checkpoint(self.path).resume_id(), None)
+
+  def test_dropped_events_are_recursive(self):
+    core.dispatch_fsevents([self.watched + "/"],
+                           [checkpoint.FLAG_KERNEL_DROPPED], [1])
+    core.dispatch_fsevents([self.watched + "/"], [0], [2])
+    self.assertEqual([c["recursive"] for c in self.calls], [True, False])
+
+
+if __name__ == "__main__":
+  unittest.main()
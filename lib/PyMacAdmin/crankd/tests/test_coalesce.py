@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import unittest
+
+from PyMacAdmin.crankd import coalesce
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class CoalescerTests(unittest.TestCase):
+  """Unit tests for Coalescer"""
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.calls = list()
+    self.coalescer = coalesce.Coalescer(
+        lambda *args, **kwargs: self.calls.append((args, kwargs)),
+        debounce=1.0,
+        max_latency=5.0,
+        clock=self.clock)
+
+  def test_debounce(self):
+    for path in ["/tmp/a", "/tmp/b", "/tmp/a"]:
+      self.coalescer("/tmp", path=path, recursive=False)
+      self.clock.now += 0.5
+    self.assertFalse(self.coalescer.flush())
+
+    self.clock.now += 0.5
+    self.assertTrue(self.coalescer.flush())
+    self.assertEqual(len(self.calls), 1)
+
+    args, kwargs = self.calls[0]
+    self.assertEqual(args, ("/tmp",))
+    self.assertEqual(kwargs["path"], "/tmp/a")
+    self.assertEqual(kwargs["paths"], ["/tmp/a", "/tmp/b"])
+    self.assertEqual(kwargs["keys"], [])
+    self.assertEqual(kwargs["coalesced"], 3)
+    self.assertEqual(self.coalescer.stats(), {
+        "events": 3, "invocations": 1, "collapsed": 2, "pending": 0})
+
+  def test_recursive(self):
+    self.coalescer("/tmp", path="/tmp/a", recursive=True)
+    self.coalescer("/tmp", path="/tmp/b", recursive=False)
+    self.coalescer.flush(force=True)
+    self.coalescer("/tmp", path="/tmp/c", recursive=False)
+    self.coalescer.flush(force=True)
+    self.assertEqual([kwargs["recursive"] for unused_args, kwargs in self.calls],
+                     [True, False])
+
+  def test_max_latency(self):
+    for i in range(20):
+      self.coalescer(key="State:/Network/Interface/en%d/Link" % (i % 2))
+      self.clock.now += 0.5
+      self.coalescer.flush()
+    self.assertEqual(len(self.calls), 2)
+    self.assertEqual(self.calls[0][1]["keys"],
+                     ["State:/Network/Interface/en0/Link",
+                      "State:/Network/Interface/en1/Link"])
+
+  def test_force(self):
+    self.coalescer(key="State:/Network/Global/IPv4")
+    self.assertTrue(self.coalescer.flush(force=True))
+    self.assertFalse(self.coalescer.flush(force=True))
+
+  def test_invalid_window(self):
+    self.assertRaises(ValueError, coalesce.Coalescer, None, debounce=-1)
+
+  def test_poll_interval(self):
+    self.assertEqual(coalesce.poll_interval([self.coalescer]), 0.25)
+    self.assertEqual(coalesce.poll_interval([]), coalesce.MIN_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import configcache
+from PyMacAdmin.crankd import core
+
+CONFIG = {
+    "SystemConfiguration": {
+        "State:/Network/Global/IPv4": {"command": "true"},
+        "State:/Network/Interface/en[0-9]+/Link": {"command": "true"},
+    }
+}
+
+
+class ConfigCacheTests(unittest.TestCase):
+  """Unit tests for the configuration cache"""
+
+  def setUp(self):
+    core.reset_handlers()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.config_file = os.path.join(self.tmp_dir, "crankd.plist")
+    self.cache_path = os.path.join(self.tmp_dir, "config.cache")
+    with open(self.config_file, "wb") as f:
+      plistlib.dump(CONFIG, f)
+
+  def tearDown(self):
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_cold_then_warm(self):
+    cold = configcache.load(self.config_file, self.cache_path)
+    warm = configcache.load(self.config_file, self.cache_path)
+    self.assertEqual((cold.warm, warm.warm), (False, True))
+    self.assertEqual(warm.config, CONFIG)
+    self.assertEqual(warm.sc_index.patterns, list(CONFIG["SystemConfiguration"]))
+
+  def test_changed_config_is_recompiled(self):
+    configcache.load(self.config_file, self.cache_path)
+    with open(self.config_file, "wb") as f:
+      plistlib.dump({"SystemConfiguration": {}}, f)
+    compiled = configcache.load(self.config_file, self.cache_path)
+    self.assertFalse(compiled.warm)
+    self.assertEqual(compiled.config, {"SystemConfiguration": {}})
+
+  def test_changed_version_is_recompiled(self):
+    configcache.load(self.config_file, self.cache_path, version="1")
+    self.assertFalse(configcache.load(self.config_file, self.cache_path,
+                                      version="2").warm)
+    self.assertTrue(configcache.load(self.config_file, self.cache_path,
+                                     version="2").warm)
+
+  def test_source_version(self):
+    package = os.path.join(self.tmp_dir, "package")
+    os.mkdir(package)
+    module = os.path.join(package, "core.py")
+    with open(module, "w") as f:
+      f.write("pass\n")
+    before = configcache.source_version(package)
+    with open(module, "w") as f:
+      f.write("pass  # changed\n")
+    self.assertNotEqual(configcache.source_version(package), before)
+
+  def test_corrupt_cache_is_ignored(self):
+    with open(self.cache_path, "wb") as f:
+      f.write(b"not a pickle")
+    self.assertFalse(configcache.load(self.config_file, self.cache_path).warm)
+    self.assertTrue(configcache.load(self.config_file, self.cache_path).warm)
+
+  def test_prebuilt_index_is_bound(self):
+    class Options(object):
+      config_file = self.config_file
+
+    configcache.load(self.config_file, self.cache_path)
+    config = core.load_config(Options, self.cache_path)
+    prebuilt = core.PREBUILT_SC_DISPATCH
+    core.add_sc_handlers(config["SystemConfiguration"])
+    self.assertTrue(core.SC_DISPATCH.regex_prefixes is prebuilt.regex_prefixes)
+    self.assertEqual(core.SC_DISPATCH.lookup("State:/Network/Interface/en1/Link"),
+                     (core.SC_HANDLERS["State:/Network/Interface/en[0-9]+/Link"],))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import core
+
+CALLS = list()
+
+
+def record_call(*args, **kwargs):
+  CALLS.append((args, kwargs))
+
+
+class CoreTests(unittest.TestCase):
+  """Unit tests for the platform-independent crankd core"""
+
+  def setUp(self):
+    core.reset_handlers()
+    del CALLS[:]
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    core.shutdown_handlers()
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_function_handlers(self):
+    handler = {"function": "%s.record_call" % __name__}
+    core.add_sc_handlers({
+        "State:/Network/Global/IPv4": handler,
+        "State:/Network/Interface/en[0-9]+/Link": handler,
+    })
+    core.dispatch_sc_event(["State:/Network/Interface/en0/Link",
+                            "State:/Network/Global/IPv4"], info="info")
+    self.assertEqual([kwargs["key"] for args, kwargs in CALLS],
+                     ["State:/Network/Interface/en0/Link",
+                      "State:/Network/Global/IPv4"])
+    self.assertEqual(CALLS[0][1]["context"],
+                     "SystemConfiguration: State:/Network/Interface/en[0-9]+/Link")
+
+  def test_fs_handlers(self):
+    watched = os.path.join(self.tmp_dir, "watched")
+    os.mkdir(watched)
+    core.add_fs_handlers({watched: {"function": "%s.record_call" % __name__}})
+    core.dispatch_fs_event(os.path.join(watched, "sub"))
+    core.dispatch_fs_event(watched + "-not")
+    self.assertEqual(len(CALLS), 1)
+    self.assertEqual(CALLS[0][0], (watched,))
+
+  def test_remove_fs_notification(self):
+    other_calls = list()
+
+    def other_call(*args, **kwargs):
+      other_calls.append(args)
+
+    watched = core.add_fs_notification(self.tmp_dir, record_call)
+    core.add_fs_notification(self.tmp_dir, other_call)
+    core.remove_fs_notification(watched, record_call)
+    core.dispatch_fs_event(self.tmp_dir)
+    self.assertEqual((CALLS, other_calls), ([], [(watched,)]))
+    core.remove_fs_notification(watched, other_call)
+    self.assertNotIn(watched, core.FS_WATCHED_FILES)
+
+  def test_workspace_handlers(self):
+    added = core.add_workspace_handlers({
+        "NSWorkspaceDidWakeNotification": {
+            "function": "%s.record_call" % __name__
+        },
+        "NSWorkspaceWillSleepNotification": {"class": "Unused"},
+    })
+    self.assertEqual(added, ["NSWorkspaceDidWakeNotification"])
+    core.dispatch_workspace_event("NSWorkspaceDidWakeNotification", {"a": 1})
+    self.assertEqual(CALLS[0][1]["user_info"], {"a": 1})
+
+  def test_invalid_handler(self):
+    self.assertRaises(AttributeError, core.get_callable_for_event, "x", {})
+    handler = core.get_callable_for_event(
+        "x", {"function": "no_such_module.function"})
+    self.assertRaises(RuntimeError, handler)
+
+  def test_lazy_handlers(self):
+    handler = core.get_callable_for_event(
+        "x", {"function": "os.path.join"}, context="ctx")
+    self.assertEqual(core.HANDLER_IMPORT_TIMES, {})
+    core.prewarm_handlers(background=True).join()
+    self.assertEqual(list(core.HANDLER_IMPORT_TIMES), ["os.path.join"])
+    self.assertTrue(core.LAZY_HANDLERS[0].func is os.path.join)
+    self.assertRaises(TypeError, handler)  # os.path.join(context=...)
+
+  def test_do_shell(self):
+    output = os.path.join(self.tmp_dir, "output")
+    core.add_sc_handlers({
+        "State:/Network/Global/IPv4": {
+            "command": 'echo "$CRANKD_KEY $CRANKD_CONTEXT" > %s' % output
+        }
+    })
+    core.dispatch_sc_event(["State:/Network/Global/IPv4"])
+    with open(output) as f:
+      self.assertEqual(f.read().strip(), "State:/Network/Global/IPv4 "
+                       "SystemConfiguration: State:/Network/Global/IPv4")
+
+  def test_shell_env(self):
+    env = core.get_shell_env("ctx", key="k", paths=["/a", "/b"],
+                             user_info={"NSApplicationName": "Mail"})
+    self.assertEqual(env, {"CRANKD_CONTEXT": "ctx", "CRANKD_KEY": "k",
+                           "CRANKD_PATHS": "/a\n/b",
+                           "NSAPPLICATION_NAME": "Mail"})
+
+
+def load_tests(loader, tests, unused_pattern):
+  tests.addTests(doctest.DocTestSuite(core))
+  return tests
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import re
+import unittest
+
+from PyMacAdmin.crankd import dispatch
+
+
+def legacy_matches(handlers, key):
+  """The pre-index behaviour of handle_sc_event for a single key."""
+  if key in handlers:
+    return [handlers[key]]
+  return [handlers[p] for p in handlers if re.match(p, key)]
+
+
+class SCDispatchIndexTests(unittest.TestCase):
+  """Unit tests for SCDispatchIndex"""
+
+  def setUp(self):
+    self.handlers = dict((p, p) for p in [
+        "State:/Network/Global/IPv4",
+        "State:/Network/Interface/en[0-9]+/Link",
+        "State:/Network/Global/IPv",
+        r"State:/Network/Service/.*/DNS",
+        "Setup:/Network/Service/",
+        "State:/Network/Global/IPv[46]",
+        "State:/Foo|State:/Network/Interface",
+        r"State:/Network/Global/IPv4s?",
+    ])
+    self.index = dispatch.SCDispatchIndex(self.handlers)
+
+  def test_matches_legacy_behaviour(self):
+    for key in [
+        "State:/Network/Global/IPv4",
+        "State:/Network/Global/IPv6",
+        "State:/Network/Global/DNS",
+        "State:/Network/Interface/en0/Link",
+        "State:/Network/Interface/en1/AirPort",
+        "State:/Network/Service/ABC-123/DNS",
+        "Setup:/Network/Service/ABC-123/IPv4",
+        "State:/Network/Global/IPv4s",
+        "Unrelated",
+        "",
+    ]:
+      self.assertEqual(list(self.index.lookup(key)),
+                       legacy_matches(self.handlers, key), key)
+
+  def test_configuration_order(self):
+    self.assertEqual(self.index.lookup("State:/Network/Global/IPv6"),
+                     ("State:/Network/Global/IPv",
+                      "State:/Network/Global/IPv[46]"))
+
+  def test_exact_match_wins(self):
+    self.assertEqual(self.index.lookup("State:/Network/Global/IPv4"),
+                     ("State:/Network/Global/IPv4",))
+
+  def test_backreferences_are_not_combined(self):
+    index = dispatch.SCDispatchIndex({r"State:/(a)\1": 1, "State:/(b)": 2})
+    self.assertEqual(index.combined, None)
+    self.assertEqual(index.lookup("State:/aa"), (1,))
+
+  def test_cache_is_bounded(self):
+    self.index.MAX_CACHED_KEYS = 2
+    for key in ["a", "b", "c"]:
+      self.index.lookup(key)
+    self.assertTrue(len(self.index.cache) <= 2)
+
+
+class PathTrieTests(unittest.TestCase):
+  """Unit tests for PathTrie"""
+
+  def setUp(self):
+    self.trie = dispatch.PathTrie()
+    for path in ["/tmp/foo", "/tmp", "/Library/Preferences", b"/usr/lib"]:
+      self.trie.add(path, path)
+
+  def test_ancestors(self):
+    self.assertEqual([p for p, unused_v in self.trie.ancestors("/tmp/foo/a/b")],
+                     ["/tmp", "/tmp/foo"])
+
+  def test_no_partial_component_match(self):
+    self.assertEqual([p for p, unused_v in self.trie.ancestors("/tmp/foobar")],
+                     ["/tmp"])
+    self.assertEqual(self.trie.ancestors("/Library/PreferencePanes"), [])
+
+  def test_bytes_and_str_are_equivalent(self):
+    self.assertTrue("/usr/lib" in self.trie)
+    self.assertEqual(self.trie.ancestors("/usr/lib/python3"),
+                     [("/usr/lib", [b"/usr/lib"])])
+
+  def test_values_are_shared(self):
+    values = self.trie.add("/tmp/foo/", "second")
+    self.assertEqual(len(self.trie), 4)
+    self.assertTrue(self.trie.get("/tmp/foo") is values)
+    self.assertEqual(values, ["/tmp/foo", "second"])
+
+  def test_remove(self):
+    self.trie.add("/tmp/foo", "second")
+    self.trie.remove("/tmp/foo", "/tmp/foo")
+    self.assertEqual(self.trie.get("/tmp/foo"), ["second"])
+    self.trie.remove("/tmp/foo", "second")
+    self.assertFalse("/tmp/foo" in self.trie)
+    self.assertEqual(len(self.trie), 3)
+    self.assertEqual(self.trie.root["tmp"], {None: ("/tmp", ["/tmp"])})
+    self.assertRaises(KeyError, self.trie.remove, "/tmp/foo", "second")
+
+
+def load_tests(loader, tests, unused_pattern):
+  tests.addTests(doctest.DocTestSuite(dispatch))
+  return tests
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import threading
+import time
+import unittest
+
+from PyMacAdmin.crankd import executor
+
+
+class FakeEventSource(object):
+  """Delivers a list of SystemConfiguration-style events to a handler."""
+
+  def __init__(self, keys):
+    self.keys = keys
+
+  def run(self, handler):
+    for key in self.keys:
+      handler(key=key, info=None)
+
+
+class Recorder(object):
+  """Handler which records calls and tracks how many run at once."""
+
+  def __init__(self, delay=0.0):
+    self.delay = delay
+    self.lock = threading.Lock()
+    self.keys = list()
+    self.active = 0
+    self.max_active = 0
+
+  def __call__(self, key=None, **unused_kwargs):
+    with self.lock:
+      self.active += 1
+      self.max_active = max(self.max_active, self.active)
+    time.sleep(self.delay)
+    with self.lock:
+      self.active -= 1
+      self.keys.append(key)
+
+
+class HandlerExecutorTests(unittest.TestCase):
+  """Unit tests for HandlerExecutor and HandlerQueue"""
+
+  def setUp(self):
+    self.executor = executor.HandlerExecutor(threads=4, processes=2)
+    self.keys = ["State:/Network/Interface/en%d/Link" % i for i in range(20)]
+
+  def tearDown(self):
+    self.executor.shutdown(timeout=5)
+
+  def test_ordered_by_default(self):
+    recorder = Recorder(delay=0.001)
+    handler = self.executor.wrap("ordered", recorder)
+    FakeEventSource(self.keys).run(handler)
+    self.assertTrue(self.executor.join(timeout=5))
+    self.assertEqual(recorder.keys, self.keys)
+    self.assertEqual(recorder.max_active, 1)
+
+  def test_concurrency_limit(self):
+    recorder = Recorder(delay=0.01)
+    handler = self.executor.wrap("parallel", recorder, concurrency=3)
+    FakeEventSource(self.keys).run(handler)
+    self.assertTrue(self.executor.join(timeout=5))
+    self.assertEqual(sorted(recorder.keys), sorted(self.keys))
+    self.assertTrue(1 < recorder.max_active <= 3, recorder.max_active)
+
+  def test_command_pool_is_bounded(self):
+    recorder = Recorder(delay=0.01)
+    handlers = [self.executor.wrap("cmd%d" % i, recorder, kind="command",
+                                   concurrency=4) for i in range(3)]
+    for handler in handlers:
+      FakeEventSource(self.keys[:5]).run(handler)
+    self.assertTrue(self.executor.join(timeout=5))
+    self.assertEqual(len(recorder.keys), 15)
+    self.assertTrue(recorder.max_active <= 2, recorder.max_active)
+
+  def test_queue_depth_and_drops(self):
+    gate = threading.Event()
+    handler = self.executor.wrap("blocked", lambda **kwargs: gate.wait(5),
+                                 max_pending=5)
+    FakeEventSource(self.keys).run(handler)
+    self.assertEqual(self.executor.queue_depth(), 6)
+    gate.set()
+    self.assertTrue(self.executor.join(timeout=5))
+    stats = self.executor.stats()["blocked"]
+    self.assertEqual(stats["dropped"], 14)
+    self.assertEqual(stats["completed"], 6)
+    self.assertEqual(stats["max_depth"], 6)
+    self.assertEqual(self.executor.queue_depth(), 0)
+
+  def test_errors_and_timeouts(self):
+    def fail(**unused_kwargs):
+      raise RuntimeError("handler failure")
+
+    failing = self.executor.wrap("failing", fail)
+    slow = self.executor.wrap("slow", Recorder(delay=0.05), timeout=0.01)
+    failing(key="a")
+    slow(key="b")
+    self.assertTrue(self.executor.join(timeout=5))
+    self.assertEqual(self.executor.stats()["failing"]["errors"], 1)
+    self.assertEqual(self.executor.stats()["slow"]["timeouts"], 1)
+
+  def test_calls_after_shutdown_are_dropped(self):
+    recorder = Recorder()
+    handler = self.executor.wrap("late", recorder)
+    self.executor.shutdown(timeout=5)
+    handler(key="a")
+    self.assertEqual(handler.stats()["dropped"], 1)
+    self.assertEqual(self.executor.queue_depth(), 0)
+
+  def test_pool_shut_down_elsewhere(self):
+    handler = self.executor.wrap("orphan", Recorder())
+    self.executor.pools["python"].shutdown(wait=True)
+    handler(key="a")
+    handler(key="b")
+    self.assertEqual((handler.running, handler.stats()["dropped"]), (0, 2))
+
+  def test_invalid_concurrency(self):
+    self.assertRaises(ValueError, self.executor.wrap, "bad", None,
+                      concurrency=0)
+
+
+if __name__ == "__main__":
+  unittest.main()
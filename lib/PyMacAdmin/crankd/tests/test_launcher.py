@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from PyMacAdmin.crankd import core
+from PyMacAdmin.crankd import launcher
+
+
+class LauncherTests(unittest.TestCase):
+  """Unit tests for the command launcher"""
+
+  def setUp(self):
+    self.launcher = launcher.Launcher()
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.launcher.close()
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_exit_status_and_environment(self):
+    output = os.path.join(self.tmp_dir, "output")
+    self.assertEqual(
+        self.launcher.call('echo "$CRANKD_KEY" > %s; exit 3' % output,
+                           env={"CRANKD_KEY": "k"}), 3)
+    with open(output) as f:
+      self.assertEqual(f.read(), "k\n")
+    self.assertEqual(self.launcher.call("kill -9 $$"), -9)
+
+  def test_timeout(self):
+    self.assertRaises(subprocess.TimeoutExpired, self.launcher.call,
+                      "sleep 10", timeout=0.1)
+
+  def test_restart(self):
+    self.launcher.call("true")
+    self.launcher.process.kill()
+    self.launcher.process.wait()
+    self.launcher.call("true")
+    self.assertEqual(self.launcher.stats(), {"starts": 2, "spawned": 2})
+
+  def test_close_timeout(self):
+    errors = []
+
+    def call():
+      try:
+        self.launcher.call("sleep 3")
+      except OSError as exc:
+        errors.append(exc)
+
+    caller = threading.Thread(target=call)
+    caller.start()
+    while self.launcher.stats()["spawned"] == 0:
+      time.sleep(0.01)
+    start = time.monotonic()
+    self.launcher.close(timeout=0.2)
+    caller.join()
+    self.assertLess(time.monotonic() - start, 2)
+    self.assertEqual(len(errors), 1)
+
+  def test_do_shell(self):
+    output = os.path.join(self.tmp_dir, "output")
+    core.configure_launcher({"Launcher": {}})
+    core.do_shell('echo "$NSDEVICE_PATH" > %s' % output, context="ctx",
+                  user_info={"NSDevicePath": "/Volumes/x"})
+    self.assertEqual(core.LAUNCHER.stats()["spawned"], 1)
+    core.shutdown_handlers()
+    with open(output) as f:
+      self.assertEqual(f.read(), "/Volumes/x\n")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import logging
+import threading
+import unittest
+
+from PyMacAdmin.crankd import logs
+
+
+class BlockingHandler(logging.Handler):
+  """Records messages once released, like a handler writing to a stuck disk"""
+
+  def __init__(self):
+    super(BlockingHandler, self).__init__()
+    self.unblocked = threading.Event()
+    self.messages = list()
+
+  def emit(self, record):
+    self.unblocked.wait()
+    self.messages.append(self.format(record))
+
+
+class LogsTests(unittest.TestCase):
+  """Unit tests for crankd's logging pipeline"""
+
+  def setUp(self):
+    self.logger = logging.getLogger("crankd-test-%s" % self.id())
+    self.logger.propagate = False
+    self.logger.setLevel(logging.INFO)
+    self.handler = BlockingHandler()
+    self.logger.addHandler(self.handler)
+
+  def test_json_formatter(self):
+    self.handler.setFormatter(logs.JSONFormatter())
+    self.handler.unblocked.set()
+    try:
+      raise ValueError("oops")
+    except ValueError:
+      self.logger.exception("handler %s failed", "x")
+
+    entry = json.loads(self.handler.messages[0])
+    self.assertEqual(entry["message"], "handler x failed")
+    self.assertEqual(entry["level"], "ERROR")
+    self.assertTrue("ValueError: oops" in entry["exception"])
+
+  def test_queue_keeps_exceptions(self):
+    self.handler.setFormatter(logs.JSONFormatter())
+    self.handler.unblocked.set()
+    writer = logs.start_queue_logging(self.logger)
+    try:
+      raise ValueError("oops")
+    except ValueError:
+      self.logger.exception("handler %s failed", "x")
+    writer.stop()
+
+    entry = json.loads(self.handler.messages[0])
+    self.assertEqual(entry["message"], "handler x failed")
+    self.assertTrue("ValueError: oops" in entry["exception"])
+
+  def test_queue_drops_when_full(self):
+    drops = list()
+    writer = logs.start_queue_logging(self.logger, max_records=3,
+                                      on_drop=lambda: drops.append(1))
+    # The writer takes the first record and blocks, so three more fit:
+    for i in range(10):
+      self.logger.info("message %d", i)
+    self.handler.unblocked.set()
+    writer.stop()
+
+    queue_handler = self.logger.handlers[0]
+    self.assertTrue(queue_handler.dropped >= 6)
+    self.assertEqual(len(drops), queue_handler.dropped)
+    self.assertEqual(self.handler.messages[0], "message 0")
+
+    self.logger.info("after")
+    self.assertEqual(queue_handler.queue.get_nowait().getMessage(),
+                     "%d log messages were dropped because the log queue was "
+                     "full" % queue_handler.dropped)
+    self.assertEqual(queue_handler.queue.get_nowait().getMessage(), "after")
+
+
+if __name__ == "__main__":
+  unittest.main()
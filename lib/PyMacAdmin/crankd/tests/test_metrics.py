@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import checkpoint
+from PyMacAdmin.crankd import core
+from PyMacAdmin.crankd import metrics
+
+
+def fail(*unused_args, **unused_kwargs):
+  raise ValueError("handler failed")
+
+
+class MetricsTests(unittest.TestCase):
+  """Unit tests for crankd metrics"""
+
+  def setUp(self):
+    core.reset_handlers()
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_handler_metrics(self):
+    core.add_sc_handlers({
+        "State:/Network/Global/IPv4": {"command": "exit 1"},
+        "State:/Network/Global/DNS": {"function": "%s.fail" % __name__},
+    })
+    core.dispatch_sc_event(["State:/Network/Global/IPv4"])
+    self.assertRaises(ValueError, core.dispatch_sc_event,
+                      ["State:/Network/Global/DNS"])
+
+    handlers = core.collect_metrics()["handlers"]
+    for key in ("State:/Network/Global/IPv4", "State:/Network/Global/DNS"):
+      stats = handlers["SystemConfiguration: %s" % key]
+      self.assertEqual((stats["invocations"], stats["errors"]), (1, 1))
+      self.assertEqual(stats["latency"]["count"], 1)
+      self.assertEqual(stats["latency"]["buckets"]["+Inf"], 1)
+
+  def test_fsevents_drops(self):
+    core.dispatch_fsevents(
+        ["/a/b", "/a/c"],
+        [checkpoint.FLAG_USER_DROPPED,
+         checkpoint.FLAG_KERNEL_DROPPED | checkpoint.FLAG_USER_DROPPED],
+        [1, 2])
+    self.assertEqual(core.METRICS.snapshot()["counters"], {
+        "fsevents_user_dropped": 2,
+        "fsevents_kernel_dropped": 1,
+        "fsevents_rescans": 2,
+    })
+
+  def test_metrics_file(self):
+    path = os.path.join(self.tmp_dir, "crankd.prom")
+    core.configure_metrics({"Metrics": {"path": path, "format": "prometheus"}})
+    core.add_workspace_handlers(
+        {"NSWorkspaceDidWakeNotification": {"command": "true"}})
+    core.dispatch_workspace_event("NSWorkspaceDidWakeNotification")
+    core.METRICS.record_loop_lag(0.002)
+    core.write_metrics()
+
+    with open(path) as f:
+      text = f.read()
+    self.assertTrue('crankd_handler_invocations_total{handler='
+                    '"NSWorkspace Notification NSWorkspaceDidWakeNotification"}'
+                    ' 1\n' in text)
+    self.assertTrue('crankd_event_loop_lag_seconds_bucket{le="0.005"} 1\n'
+                    in text)
+    self.assertTrue("crankd_event_loop_lag_seconds_count 1\n" in text)
+
+    core.configure_metrics({"Metrics": {"path": path}})
+    core.write_metrics()
+    with open(path) as f:
+      self.assertEqual(json.load(f)["loop_lag"]["count"], 1)
+
+  def test_invalid_format(self):
+    self.assertRaises(ValueError, core.configure_metrics,
+                      {"Metrics": {"path": "x", "format": "xml"}})
+
+
+def load_tests(loader, tests, unused_pattern):
+  tests.addTests(doctest.DocTestSuite(metrics))
+  return tests
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import core
+from PyMacAdmin.crankd import reload
+
+CALLS = list()
+
+
+def record_call(*args, **kwargs):
+  CALLS.append((args, kwargs))
+
+
+HANDLER = {"function": "%s.record_call" % __name__}
+
+HANDLER_MODULE = """
+def handler(*args, **kwargs):
+  CALLS.append(%r)
+CALLS = list()
+"""
+
+
+class ReloadTests(unittest.TestCase):
+  """Unit tests for incremental configuration reloading"""
+
+  def setUp(self):
+    core.reset_handlers()
+    del CALLS[:]
+    self.tmp_dir = tempfile.mkdtemp()
+    self.watched = os.path.join(self.tmp_dir, "watched")
+    os.mkdir(self.watched)
+    self.config = {
+        "SystemConfiguration": {
+            "State:/Network/Global/IPv4": HANDLER,
+            "State:/Network/Interface/en[0-9]+/Link": HANDLER,
+        },
+        "FSEvents": {self.watched: HANDLER},
+        "NSWorkspace": {"NSWorkspaceDidWakeNotification": HANDLER},
+    }
+    core.add_sc_handlers(self.config["SystemConfiguration"])
+    core.add_fs_handlers(self.config["FSEvents"])
+    core.add_workspace_handlers(self.config["NSWorkspace"])
+
+  def tearDown(self):
+    core.shutdown_handlers()
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+    sys.modules.pop("crankd_reload_test_handlers", None)
+    if self.tmp_dir in sys.path:
+      sys.path.remove(self.tmp_dir)
+
+  def test_unchanged_handlers_are_kept(self):
+    ipv4 = core.SC_HANDLERS["State:/Network/Global/IPv4"]
+    new = dict(self.config)
+    new["SystemConfiguration"] = {
+        "State:/Network/Global/IPv4": HANDLER,
+        "State:/Network/Global/DNS": {"command": "/usr/bin/true"},
+    }
+    diff = reload.reload_config(self.config, new)
+
+    self.assertEqual(diff.added["SystemConfiguration"],
+                     ["State:/Network/Global/DNS"])
+    self.assertEqual(diff.removed["SystemConfiguration"],
+                     ["State:/Network/Interface/en[0-9]+/Link"])
+    self.assertEqual(diff.summary(), "SystemConfiguration: 1 added, 1 removed")
+    self.assertTrue(diff.elapsed >= 0)
+    self.assertTrue(core.SC_HANDLERS["State:/Network/Global/IPv4"] is ipv4)
+    self.assertEqual(core.SC_DISPATCH.lookup("State:/Network/Interface/en0/Link"),
+                     ())
+
+  def test_changed_handlers_keep_their_order(self):
+    new = dict(self.config)
+    new["SystemConfiguration"] = {
+        "State:/Network/.*": HANDLER,
+        "State:/Network/Global/IPv4": HANDLER,
+        "State:/Network/Interface/en[0-9]+/Link": HANDLER,
+    }
+    reload.reload_config(self.config, new)
+    changed = dict(new)
+    changed["SystemConfiguration"] = dict(new["SystemConfiguration"])
+    changed["SystemConfiguration"]["State:/Network/.*"] = {
+        "command": "/usr/bin/true"}
+    reload.reload_config(new, changed)
+
+    self.assertEqual(list(core.SC_HANDLERS), list(new["SystemConfiguration"]))
+    handlers = core.SC_DISPATCH.lookup("State:/Network/Interface/en0/Link")
+    self.assertEqual(handlers, (
+        core.SC_HANDLERS["State:/Network/.*"],
+        core.SC_HANDLERS["State:/Network/Interface/en[0-9]+/Link"]))
+
+  def test_fs_and_workspace_changes(self):
+    other = os.path.join(self.tmp_dir, "other")
+    os.mkdir(other)
+    new = dict(self.config)
+    new["FSEvents"] = {other: HANDLER}
+    new["NSWorkspace"] = {
+        "NSWorkspaceDidWakeNotification": dict(HANDLER, debounce=5)
+    }
+    diff = reload.reload_config(self.config, new)
+
+    self.assertEqual(diff.changed["NSWorkspace"],
+                     ["NSWorkspaceDidWakeNotification"])
+    self.assertEqual(list(core.FS_WATCHED_FILES), [other])
+    core.dispatch_fs_event(self.watched)
+    self.assertEqual(CALLS, [])
+    core.dispatch_fs_event(other)
+    self.assertEqual(len(CALLS), 1)
+    self.assertEqual(len(core.COALESCERS), 1)
+
+  def test_removed_handlers_are_flushed(self):
+    new = dict(self.config)
+    new["NSWorkspace"] = {
+        "NSWorkspaceDidWakeNotification": dict(HANDLER, debounce=5)
+    }
+    reload.reload_config(self.config, new)
+    core.dispatch_workspace_event("NSWorkspaceDidWakeNotification")
+    self.assertEqual(CALLS, [])
+
+    reload.reload_config(new, self.config)
+    self.assertEqual(len(CALLS), 1)
+    self.assertEqual(core.COALESCERS, [])
+
+  def test_restart_required(self):
+    new = dict(self.config, Executor={"threads": 2})
+    self.assertRaises(reload.RestartRequired, reload.reload_config,
+                      self.config, new)
+    self.assertRaises(reload.RestartRequired, reload.reload_config,
+                      self.config, self.config, ["PyMacAdmin.crankd.core"])
+    self.assertEqual(len(core.SC_HANDLERS), 2)
+
+  def test_module_reload(self):
+    with open(os.path.join(self.tmp_dir, "crankd_reload_test_handlers.py"),
+              "w") as f:
+      f.write(HANDLER_MODULE % "old")
+    sys.path.insert(0, self.tmp_dir)
+
+    config = {"FSEvents": {
+        self.watched: {"function": "crankd_reload_test_handlers.handler"}
+    }}
+    reload.reload_config(self.config, config)
+
+    with open(os.path.join(self.tmp_dir, "crankd_reload_test_handlers.py"),
+              "w") as f:
+      f.write(HANDLER_MODULE % "new")
+    os.utime(f.name, (0, 0))  # Defeat the timestamp check of cached bytecode
+    diff = reload.reload_config(config, config, ["crankd_reload_test_handlers"])
+
+    self.assertEqual(diff.changed["FSEvents"], [self.watched])
+    core.dispatch_fs_event(self.watched)
+    self.assertEqual(sys.modules["crankd_reload_test_handlers"].CALLS, ["new"])
+
+
+def load_tests(loader, tests, unused_pattern):
+  tests.addTests(doctest.DocTestSuite(reload))
+  return tests
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import doctest
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import core
+from PyMacAdmin.crankd import replay
+from PyMacAdmin.crankd import sources
+
+CALLS = list()
+
+
+def record_call(*args, **kwargs):
+  CALLS.append((args, kwargs))
+
+
+def failing_call(*unused_args, **unused_kwargs):
+  raise RuntimeError("handler failed")
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+class RecordReplayTests(unittest.TestCase):
+  """Unit tests for EventRecorder and replay()"""
+
+  def setUp(self):
+    core.reset_handlers()
+    del CALLS[:]
+    self.tmp_dir = tempfile.mkdtemp()
+    self.log = os.path.join(self.tmp_dir, "events.jsonl")
+
+  def tearDown(self):
+    core.RECORDER = None
+    core.reset_handlers()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_record_dispatched_events(self):
+    core.RECORDER = replay.EventRecorder(self.log)
+    core.dispatch_sc_event(["State:/Network/Global/IPv4"])
+    core.dispatch_fs_event(self.tmp_dir, flags=0x10)
+    core.RECORDER.close()
+
+    with open(self.log) as f:
+      records = [json.loads(line) for line in f]
+    self.assertEqual([r["source"] for r in records],
+                     ["SystemConfiguration", "FSEvents"])
+    self.assertEqual(records[1]["flags"], 0x10)
+    self.assertTrue("info" not in records[0])
+    self.assertTrue(all("ts" in r for r in records))
+
+  def test_replay_statistics(self):
+    config = {
+        "SystemConfiguration": {
+            "State:/Network/Global/IPv4": {
+                "function": "%s.record_call" % __name__,
+                "debounce": 60,
+            },
+            "State:/Network/Interface/en[0-9]/Link": {
+                "function": "%s.record_call" % __name__,
+            },
+        },
+        "FSEvents": {
+            "/nonexistent/crankd/path": {"command": "true"},
+        },
+    }
+    events = replay.synthesize(config, 200)
+    events.append({"source": "SystemConfiguration",
+                   "keys": ["State:/Network/Global/IPv4"]})
+    replay.add_handlers(config)
+    stats = replay.replay(events)
+
+    self.assertEqual(stats["events"], 201)
+    self.assertTrue(stats["latency_p50"] <= stats["latency_p100"])
+    ipv4 = sum(1 for e in events
+               if e.get("keys") == ["State:/Network/Global/IPv4"])
+    self.assertEqual(stats["coalesced"], ipv4 - 1)
+    self.assertEqual(stats["executor_dropped"], 0)
+    self.assertTrue(replay.format_stats(stats))
+
+  def test_handler_errors(self):
+    config = {
+        "SystemConfiguration": {
+            "State:/Network/Global/IPv4": {
+                "function": "%s.failing_call" % __name__,
+            },
+            "State:/Network/Global/IPv6": {
+                "function": "%s.failing_call" % __name__,
+                "debounce": 60,
+            },
+            "State:/Network/Global/DNS": {
+                "function": "%s.record_call" % __name__,
+            },
+        },
+    }
+    events = replay.synthesize(config, 50)
+    failing = sum(1 for e in events if e["keys"][0].endswith("IPv4"))
+    replay.add_handlers(config)
+    stats = replay.replay(events)
+
+    self.assertEqual(stats["events"], 50)
+    self.assertEqual(len(CALLS), 50 - failing - sum(
+        1 for e in events if e["keys"][0].endswith("IPv6")))
+    # Every IPv4 event, and the one coalesced IPv6 call, failed:
+    self.assertEqual(stats["errors"], failing + 1)
+    self.assertEqual(stats["dispatch_errors"], failing + 1)
+    handlers = core.METRICS.snapshot()["handlers"]
+    self.assertEqual(sum(h["invocations"] for h in handlers.values()),
+                     50 - stats["coalesced"])
+    self.assertTrue(stats["latency_p100"] is not None)
+
+  def test_paced_replay(self):
+    clock = FakeClock()
+    dispatched = list()
+
+    class Dispatcher(object):
+      def dispatch_sc_event(self, keys, info=None):
+        dispatched.append(keys[0])
+
+    events = [{"ts": 10.0, "source": "SystemConfiguration", "keys": ["a"]},
+              {"ts": 12.0, "source": "SystemConfiguration", "keys": ["b"]}]
+    source = sources.ReplaySource(events, Dispatcher(), speed=2, clock=clock)
+    source.start()
+    source.process()
+    self.assertEqual(dispatched, ["a"])
+    self.assertEqual(source.timeout(), 1.0)
+    clock.now += 1.5
+    source.process()
+    self.assertEqual(dispatched, ["a", "b"])
+    self.assertEqual(source.max_lag, 0.5)
+
+  def test_main_requires_config_file(self):
+    config_file = os.path.join(self.tmp_dir, "crankd.plist")
+    for argv in ([], ["--synthesize=10"]):
+      self.assertRaises(SystemExit, replay.main,
+                        argv + ["--config", config_file, self.log])
+      self.assertFalse(os.path.exists(config_file))
+      self.assertFalse(os.path.exists(self.log))
+
+  def test_synthesize_requires_events(self):
+    self.assertRaises(ValueError, replay.synthesize, {}, 10)
+
+
+def load_tests(loader, tests, unused_pattern):
+  tests.addTests(doctest.DocTestSuite(replay))
+  return tests
+
+
+if __name__ == "__main__":
+  unittest.main()
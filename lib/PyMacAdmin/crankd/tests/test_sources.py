@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from PyMacAdmin.crankd import sources
+
+
+class FakeDispatcher(object):
+  """Records events instead of calling handlers."""
+
+  def __init__(self, watched=()):
+    self.FS_WATCHED_FILES = dict((p, []) for p in watched)
+    self.events = list()
+
+  def dispatch_fs_event(self, path, recursive=False):
+    self.events.append(("FSEvents", path, recursive))
+
+  def dispatch_sc_event(self, changed_keys, info=None):
+    self.events.append(("SystemConfiguration", tuple(changed_keys), info))
+
+  def dispatch_workspace_event(self, name, user_info=None):
+    self.events.append(("NSWorkspace", name, user_info))
+
+
+class ReplaySourceTests(unittest.TestCase):
+  """Unit tests for ReplaySource"""
+
+  def test_replay(self):
+    records = [
+        {"source": "FSEvents", "path": "/tmp"},
+        {"source": "SystemConfiguration", "keys": ["State:/Network/Global/IPv4"]},
+        {"source": "NSWorkspace", "name": "NSWorkspaceDidWakeNotification"},
+    ]
+    dispatcher = FakeDispatcher()
+    source = sources.ReplaySource(
+        [json.dumps(r) for r in records] * 600 + [""], dispatcher)
+    sources.run([source], until_done=True)
+    self.assertEqual(source.delivered, 1800)
+    self.assertEqual(dispatcher.events[:3], [
+        ("FSEvents", "/tmp", False),
+        ("SystemConfiguration", ("State:/Network/Global/IPv4",), None),
+        ("NSWorkspace", "NSWorkspaceDidWakeNotification", None),
+    ])
+
+  def test_unknown_source(self):
+    self.assertRaises(ValueError, sources.dispatch_record, {"source": "x"},
+                      FakeDispatcher())
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "requires inotify")
+class InotifySourceTests(unittest.TestCase):
+  """Unit tests for InotifySource"""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.tmp_dir, "existing"))
+    self.dispatcher = FakeDispatcher([self.tmp_dir])
+    self.source = sources.InotifySource(dispatcher=self.dispatcher)
+    self.source.start()
+
+  def tearDown(self):
+    self.source.stop()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_recursive_watches(self):
+    new_dir = os.path.join(self.tmp_dir, "new")
+    os.mkdir(new_dir)
+    self.source.process()
+    with open(os.path.join(new_dir, "file"), "w") as f:
+      f.write("x")
+    with open(os.path.join(self.tmp_dir, "existing", "file"), "w") as f:
+      f.write("x")
+    self.source.process()
+    self.assertEqual([path for unused_source, path, unused_r in
+                      self.dispatcher.events],
+                     [self.tmp_dir, new_dir,
+                      os.path.join(self.tmp_dir, "existing")])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -21,18 +21,24 @@ __author__ = 'Nigel Kersten (nigelk@google.com)'
 __version__ = '0.2'
 
 
+import collections
+import copy
 import filecmp
 import os
+import re
+import select
 import shutil
 import subprocess
 import syslog
-from Foundation import NSString
+import threading
+import time
 import plistlib
 
 
 _DSCL = '/usr/bin/dscl'
 _DSCACHEUTIL = '/usr/bin/dscacheutil'
 _DSEDITGROUP = '/usr/sbin/dseditgroup'
+_LOCAL_NODE = '/Local/Default'
 
 
 class DSException(Exception):
@@ -40,6 +46,11 @@ class DSException(Exception):
   pass
 
 
+class DsclSessionError(DSException):
+  """The interactive dscl process failed or stopped responding."""
+  pass
+
+
 def RunProcess(cmd, stdinput=None, env=None, cwd=None, sudo=False,
                sudo_password=None):
   """Executes cmd using subprocess.
@@ -69,16 +80,700 @@ def RunProcess(cmd, stdinput=None, env=None, cwd=None, sudo=False,
       sudo_cmd = sudo_cmd + ['-p',
                              "%u's password is required for admin access: "]
     cmd = sudo_cmd + cmd
-  environment = os.environ
-  environment.update(env)
+  if env:
+    # Only copy the environment when there is something to add to it:
+    env = dict(os.environ, **env)
   task = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                          stdin=subprocess.PIPE, env=environment, cwd=cwd)
+                          stdin=subprocess.PIPE, env=env, cwd=cwd)
   (stdout, stderr) = task.communicate(input=stdinput)
   return (stdout, stderr, task.returncode)
 
 
+def _ParsePlist(data):
+  """Parses the XML plist output of dscl -plist."""
+  if hasattr(plistlib, 'loads'):
+    return plistlib.loads(data)
+  return plistlib.readPlistFromString(data)
+
+
+def _FormatPlist(plist):
+  """Returns plist in the XML format dscl -plist prints."""
+  if hasattr(plistlib, 'dumps'):
+    return plistlib.dumps(plist)
+  return plistlib.writePlistToString(plist)
+
+
+def _SelectAttributes(plist, attributes):
+  """Returns the entries of a record plist for the requested attributes.
+
+  Args:
+    plist: a record as returned by dscl -plist -read.
+    attributes: attribute names, with or without the dsAttrTypeStandard:
+      prefix, or None for all of them.
+  Returns:
+    A dictionary of the matching plist entries.
+  """
+  if attributes is None:
+    return plist
+  return dict((key, value) for key, value in plist.items()
+              if key in attributes
+              or key.replace('dsAttrTypeStandard:', '', 1) in attributes)
+
+
+def _AttributeValue(plist, attribute):
+  """Returns the value of attribute in a record plist, or None."""
+  value = None
+  if 'dsAttrTypeStandard:%s' % attribute in plist:
+    value = plist['dsAttrTypeStandard:%s' % attribute]
+  elif attribute in plist:
+    value = plist[attribute]
+  try:
+    # We're copying to a new list so callers can't modify the record
+    return value[:]
+  except TypeError:
+    # ... unless we can't
+    return value
+
+
+class _DsclChanges(object):
+  """Changes DirectoryServices with dscl -create, -append and -delete.
+
+  Subclasses run the commands with _Modify(node, action, ds_path, args).
+  """
+
+  def Create(self, node, ds_path, attribute=None, values=()):
+    """Creates a record, or sets an attribute to values, replacing it.
+
+    Args:
+      node: the DS node to modify, '.' for the local node.
+      ds_path: the path of the record, e.g. /Users/root.
+      attribute: the optional attribute to set.
+      values: the values to set the attribute to.
+    Raises:
+      DSException: Cannot modify DirectoryServices.
+    """
+    self._Modify(node, 'create', ds_path,
+                 [attribute] + list(values) if attribute else [])
+
+  def Append(self, node, ds_path, attribute, values):
+    """Appends values to an attribute, see Create."""
+    self._Modify(node, 'append', ds_path, [attribute] + list(values))
+
+  def Delete(self, node, ds_path, attribute=None, value=None):
+    """Deletes a record, an attribute or a single value, see Create."""
+    args = []
+    if attribute:
+      args.append(attribute)
+      if value:
+        args.append(value)
+    self._Modify(node, 'delete', ds_path, args)
+
+  def ModifyMany(self, changes):
+    """Makes several changes, in order.
+
+    Args:
+      changes: a list of (action, node, ds_path, args) tuples, where action
+        is one of 'create', 'append' or 'delete' and args are the dscl
+        arguments after the record path, e.g.
+        ('append', '/Search', '/', ['CSPSearchPath', '/LDAPv3/ldap']).
+    Returns:
+      A list with the error message of each change which failed, or None
+      for each change which succeeded.
+    """
+    errors = []
+    for action, node, ds_path, args in changes:
+      try:
+        self._Modify(node, action, ds_path, list(args))
+        errors.append(None)
+      except DSException as e:
+        errors.append(str(e).strip())
+    return errors
+
+
+class DsclBackend(_DsclChanges):
+  """Queries DirectoryServices by running dscl.
+
+  Records are named by a DS node and a path within it, e.g. ('.',
+  '/Users/root') for a local user or ('/Search', '/') for the search node
+  configuration.
+  """
+
+  def __init__(self, dscl=_DSCL):
+    self.dscl = dscl
+
+  def Read(self, node, ds_path, attributes=None):
+    """Reads a single record.
+
+    Args:
+      node: the DS node to query, '.' for the local node.
+      ds_path: the path of the record, e.g. /Users/root.
+      attributes: an optional list of attributes to read, default all.
+    Returns:
+      The record as a dictionary of attribute: list of values.
+    Raises:
+      DSException: Cannot query DirectoryServices.
+    """
+    cmd = [self.dscl, '-plist', node, '-read', ds_path]
+    cmd.extend(attributes or [])
+    (stdout, stderr, returncode) = RunProcess(cmd)
+    if returncode:
+      raise DSException('Cannot query %s for %s: %s' % (ds_path,
+                                                        attributes,
+                                                        stderr))
+    return _ParsePlist(stdout)
+
+  def ReadRecords(self, node, type_path, names, attributes=None):
+    """Reads several records of one type.
+
+    More than one record is read with a single dscl -readall, which returns
+    every record of the type, so this is meant for small nodes such as the
+    local one.
+
+    Args:
+      node: the DS node to query, '.' for the local node.
+      type_path: the path of the record type, e.g. /Users.
+      names: the names of the records to read.
+      attributes: an optional list of attributes to read, default all.
+    Returns:
+      A dictionary of name: record for each of names which exists.
+    Raises:
+      DSException: Cannot query DirectoryServices.
+    """
+    names = list(names)
+    if not names:
+      return {}
+    if len(names) == 1:
+      try:
+        return {names[0]: self.Read(node, '%s/%s' % (type_path, names[0]),
+                                    attributes)}
+      except DSException:
+        return {}
+    cmd = [self.dscl, '-plist', node, '-readall', type_path]
+    if attributes:
+      cmd.extend(['RecordName'] + list(attributes))
+    (stdout, stderr, returncode) = RunProcess(cmd)
+    if returncode:
+      raise DSException('Cannot query %s for %s: %s' % (type_path,
+                                                        attributes,
+                                                        stderr))
+    records = {}
+    for record in _ParsePlist(stdout):
+      for name in _AttributeValue(record, 'RecordName') or []:
+        if name in names:
+          records[name] = record
+    return records
+
+  def _Modify(self, node, action, ds_path, args):
+    cmd = [self.dscl, node, '-%s' % action, ds_path] + args
+    (unused_stdout, stderr, returncode) = RunProcess(cmd)
+    if returncode:
+      raise DSException(stderr)
+
+
+def _QuoteDsclArg(arg):
+  """Escapes an argument for dscl's interactive mode."""
+  return re.sub(r'([\s"\'\\])', r'\\\1', arg)
+
+
+class DsclSession(object):
+  """A long-lived interactive dscl process.
+
+  Each command is written to dscl's stdin as a line, and its response is
+  everything dscl prints before its next prompt, which it shows when it is
+  ready for another command. Commands are written in chunks, before their
+  responses are read, to save a round trip per command. The process is
+  started on first use, and after it fails, e.g. exits or stops responding
+  within timeout seconds, the next command starts a new one.
+  """
+
+  # Commands to write before reading their responses, small enough that
+  # neither pipe fills up while the other is being written:
+  CHUNK = 32
+
+  def __init__(self, command=None, timeout=30):
+    self.command = command or [_DSCL, '-plist']
+    self.timeout = timeout
+    self.process = None
+    self.prompt = None
+    self.starts = 0
+    self._buffer = b''
+
+  def Start(self):
+    """Starts a new dscl process, stopping any running one."""
+    self.Close()
+    self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+    self.starts += 1
+    # The prompt is the last line of the greeting, e.g. " > ":
+    while not self._buffer.endswith(b'> '):
+      self._Read()
+    self.prompt = self._buffer.rsplit(b'\n', 1)[-1]
+    self._buffer = b''
+
+  def Close(self):
+    """Stops the dscl process, if it is running."""
+    if self.process is not None:
+      if self.process.poll() is None:
+        self.process.kill()
+      self.process.wait()
+      self.process.stdin.close()
+      self.process.stdout.close()
+    self.process = None
+    self._buffer = b''
+
+  def _Read(self):
+    fd = self.process.stdout.fileno()
+    if not select.select([fd], [], [], self.timeout)[0]:
+      raise DsclSessionError('no response within %ss' % self.timeout)
+    data = os.read(fd, 65536)
+    if not data:
+      raise DsclSessionError('exited with %s' % self.process.wait())
+    self._buffer += data
+
+  def _ReadResponse(self, line):
+    """Returns the output of the command line up to the next prompt."""
+    terminator = b'\n' + self.prompt
+    while True:
+      if self._buffer.startswith(self.prompt):
+        end, output = len(self.prompt), b''
+        break
+      index = self._buffer.find(terminator)
+      if index >= 0:
+        end, output = index + len(terminator), self._buffer[:index + 1]
+        break
+      self._Read()
+    self._buffer = self._buffer[end:]
+    output = output.decode('utf-8')
+    # Drop the command, should dscl echo it:
+    if output.split('\n', 1)[0] == line:
+      output = output.split('\n', 1)[1]
+    return output
+
+  def RunMany(self, commands):
+    """Runs dscl commands.
+
+    Args:
+      commands: a list of commands, each a list of strings such as
+        ['read', '/Local/Default/Users/root', 'RealName'].
+    Returns:
+      A list of the output of each command, errors included.
+    Raises:
+      DsclSessionError: dscl failed, the session will be restarted by the
+        next command.
+    """
+    outputs = []
+    try:
+      if self.process is None or self.process.poll() is not None:
+        self.Start()
+      for i in range(0, len(commands), self.CHUNK):
+        lines = [' '.join(_QuoteDsclArg(arg) for arg in command)
+                 for command in commands[i:i + self.CHUNK]]
+        self.process.stdin.write(''.join(line + '\n' for line in lines)
+                                 .encode('utf-8'))
+        self.process.stdin.flush()
+        for line in lines:
+          outputs.append(self._ReadResponse(line))
+    except (IOError, OSError, DsclSessionError) as e:
+      self.Close()
+      raise DsclSessionError('dscl session failed: %s' % e)
+    return outputs
+
+
+class DsclSessionBackend(_DsclChanges):
+  """Sends DirectoryServices queries and changes to a DsclSession.
+
+  This has the same methods as DsclBackend, but the commands all go to one
+  interactive dscl rather than a new process each. Reads that fail because
+  the session did are retried once on a new session; changes are not, as
+  they may have been made.
+  """
+
+  def __init__(self, session=None):
+    self.session = session or DsclSession()
+
+  @staticmethod
+  def _Path(node, ds_path):
+    if node == '.':
+      node = _LOCAL_NODE
+    return (node + ds_path).rstrip('/') or '/'
+
+  def _ReadPaths(self, paths, attributes):
+    commands = [['read', path] + list(attributes or []) for path in paths]
+    try:
+      return self.session.RunMany(commands)
+    except DsclSessionError:
+      return self.session.RunMany(commands)
+
+  def Read(self, node, ds_path, attributes=None):
+    """Reads a single record, see DsclBackend.Read."""
+    output = self._ReadPaths([self._Path(node, ds_path)], attributes)[0]
+    if '<?xml' not in output:
+      raise DSException('Cannot query %s for %s: %s' % (ds_path, attributes,
+                                                        output.strip()))
+    return _ParsePlist(output[output.index('<?xml'):].encode('utf-8'))
+
+  def ReadRecords(self, node, type_path, names, attributes=None):
+    """Reads several records of one type, see DsclBackend.ReadRecords."""
+    names = list(names)
+    if not names:
+      return {}
+    paths = [self._Path(node, '%s/%s' % (type_path, name)) for name in names]
+    records = {}
+    for name, output in zip(names, self._ReadPaths(paths, attributes)):
+      if '<?xml' in output:
+        records[name] = _ParsePlist(output[output.index('<?xml'):]
+                                    .encode('utf-8'))
+    return records
+
+  def _Modify(self, node, action, ds_path, args):
+    error = self.ModifyMany([(action, node, ds_path, args)])[0]
+    if error:
+      raise DSException(error)
+
+  def ModifyMany(self, changes):
+    """Makes several changes, see DsclBackend.ModifyMany.
+
+    The changes are all written to the session before their responses are
+    read, rather than one at a time.
+    """
+    outputs = self.session.RunMany(
+        [[action, self._Path(node, ds_path)] + list(args)
+         for action, node, ds_path, args in changes])
+    # dscl prints nothing when a change succeeds:
+    return [output.strip() or None for output in outputs]
+
+
+class PlistBackend(object):
+  """Answers DirectoryServices queries from a tree of plist files.
+
+  Each record is a file holding the output of dscl -plist -read for it, at
+  <root>/<node>/<ds_path>.plist, where the local node '.' is the root
+  itself: /Users/root is <root>/Users/root.plist and the /Search node's
+  configuration is <root>/Search.plist. Nothing is cached, so files can be
+  changed between queries, and changes are written straight back. This
+  lets pymacds run without DirectoryServices, e.g. in tests or on other
+  platforms.
+  """
+
+  def __init__(self, root):
+    self.root = root
+
+  def _RecordFile(self, node, ds_path):
+    path = ds_path if node == '.' else node + ds_path
+    return os.path.join(self.root, *path.strip('/').split('/')) + '.plist'
+
+  def _Load(self, node, ds_path):
+    with open(self._RecordFile(node, ds_path), 'rb') as record_file:
+      return _ParsePlist(record_file.read())
+
+  def _Save(self, node, ds_path, plist):
+    record_file = self._RecordFile(node, ds_path)
+    if not os.path.isdir(os.path.dirname(record_file)):
+      os.makedirs(os.path.dirname(record_file))
+    with open(record_file, 'wb') as f:
+      f.write(_FormatPlist(plist))
+
+  @staticmethod
+  def _Key(plist, attribute):
+    """Returns the key attribute has, or would have, in plist."""
+    if attribute not in plist and ':' not in attribute:
+      return 'dsAttrTypeStandard:%s' % attribute
+    return attribute
+
+  def Read(self, node, ds_path, attributes=None):
+    """Reads a single record, see DsclBackend.Read."""
+    try:
+      plist = self._Load(node, ds_path)
+    except (IOError, OSError) as e:
+      raise DSException('Cannot query %s for %s: %s' % (ds_path,
+                                                        attributes, e))
+    return _SelectAttributes(plist, attributes)
+
+  def ReadRecords(self, node, type_path, names, attributes=None):
+    """Reads several records of one type, see DsclBackend.ReadRecords."""
+    records = {}
+    for name in names:
+      try:
+        records[name] = self.Read(node, '%s/%s' % (type_path, name),
+                                  attributes)
+      except DSException:
+        pass
+    return records
+
+  def Create(self, node, ds_path, attribute=None, values=()):
+    """Creates a record or sets an attribute, see DsclBackend.Create."""
+    try:
+      plist = self._Load(node, ds_path)
+    except (IOError, OSError):
+      plist = {'dsAttrTypeStandard:RecordName': [ds_path.split('/')[-1]]}
+    if attribute:
+      plist[self._Key(plist, attribute)] = list(values)
+    self._Save(node, ds_path, plist)
+
+  def Append(self, node, ds_path, attribute, values):
+    """Appends values to an attribute, see DsclBackend.Append."""
+    try:
+      plist = self._Load(node, ds_path)
+    except (IOError, OSError) as e:
+      raise DSException(str(e))
+    key = self._Key(plist, attribute)
+    plist[key] = plist.get(key, []) + list(values)
+    self._Save(node, ds_path, plist)
+
+  def Delete(self, node, ds_path, attribute=None, value=None):
+    """Deletes a record, attribute or value, see DsclBackend.Delete."""
+    try:
+      if not attribute:
+        os.remove(self._RecordFile(node, ds_path))
+        return
+      plist = self._Load(node, ds_path)
+    except (IOError, OSError) as e:
+      raise DSException(str(e))
+    key = self._Key(plist, attribute)
+    if value:
+      if value in plist.get(key, []):
+        plist[key].remove(value)
+    else:
+      plist.pop(key, None)
+    self._Save(node, ds_path, plist)
+
+  def ModifyMany(self, changes):
+    """Makes several changes, see DsclBackend.ModifyMany."""
+    errors = []
+    for action, node, ds_path, args in changes:
+      args = list(args)
+      try:
+        if action == 'create':
+          self.Create(node, ds_path, args[0] if args else None, args[1:])
+        elif action == 'append':
+          self.Append(node, ds_path, args[0], args[1:])
+        elif action == 'delete':
+          self.Delete(node, ds_path, args[0] if args else None,
+                      args[1] if len(args) > 1 else None)
+        else:
+          raise DSException('Unknown action %s' % action)
+        errors.append(None)
+      except DSException as e:
+        errors.append(str(e))
+    return errors
+
+
+class CachingBackend(object):
+  """Caches the reads of another backend, see EnableReadCache.
+
+  Entries are keyed by (node, type, record, attribute), where attribute is
+  None for a whole record read, and hold that part of the record. They
+  expire ttl seconds after they were read, and once there are max_entries
+  the least recently used is evicted. Changes made through this backend
+  invalidate every entry for the records they touch; changes made any other
+  way must call Invalidate. Records which don't exist are not cached.
+  """
+
+  def __init__(self, backend, ttl=60, max_entries=1024, clock=time.time):
+    self.backend = backend
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.clock = clock
+    self.hits = self.misses = self.evictions = self.expirations = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _Key(node, ds_path, attribute):
+    type_path, unused_slash, name = ds_path.rpartition('/')
+    return (node, type_path, name, attribute)
+
+  def _Get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None and entry[0] <= self.clock():
+        self.expirations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self._entries[key] = entry
+      return copy.deepcopy(entry[1])
+
+  def _Put(self, key, plist):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (self.clock() + self.ttl, copy.deepcopy(plist))
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def _Lookup(self, node, ds_path, attributes):
+    """Returns (cached part of the record, attributes to read)."""
+    if attributes is None:
+      plist = self._Get(self._Key(node, ds_path, None))
+      return (plist or {}, None if plist is not None else [None])
+    cached, missing = {}, []
+    for attribute in attributes:
+      plist = self._Get(self._Key(node, ds_path, attribute))
+      if plist is None:
+        missing.append(attribute)
+      else:
+        cached.update(plist)
+    return cached, missing
+
+  def _Store(self, node, ds_path, attributes, plist):
+    for attribute in attributes:
+      self._Put(self._Key(node, ds_path, attribute),
+                plist if attribute is None
+                else _SelectAttributes(plist, [attribute]))
+
+  def Read(self, node, ds_path, attributes=None):
+    """Reads a single record, see DsclBackend.Read."""
+    cached, missing = self._Lookup(node, ds_path, attributes)
+    if missing:
+      plist = self.backend.Read(node, ds_path,
+                                None if missing == [None] else missing)
+      self._Store(node, ds_path, missing, plist)
+      cached.update(plist)
+    return cached
+
+  def ReadRecords(self, node, type_path, names, attributes=None):
+    """Reads several records of one type, see DsclBackend.ReadRecords.
+
+    Only the records and attributes not cached are passed on, in one call.
+    """
+    records, to_read, missing = {}, [], set()
+    for name in names:
+      ds_path = '%s/%s' % (type_path, name)
+      records[name], name_missing = self._Lookup(node, ds_path, attributes)
+      if name_missing:
+        to_read.append(name)
+        missing.update(name_missing)
+    if to_read:
+      missing = list(missing)
+      fetched = self.backend.ReadRecords(
+          node, type_path, to_read, None if missing == [None] else missing)
+      for name in to_read:
+        if name in fetched:
+          self._Store(node, '%s/%s' % (type_path, name), missing,
+                      fetched[name])
+          records[name].update(fetched[name])
+        else:
+          del records[name]
+    return records
+
+  def Create(self, node, ds_path, attribute=None, values=()):
+    """Creates a record or sets an attribute, see DsclBackend.Create."""
+    try:
+      self.backend.Create(node, ds_path, attribute, values)
+    finally:
+      self.Invalidate(node, ds_path)
+
+  def Append(self, node, ds_path, attribute, values):
+    """Appends values to an attribute, see DsclBackend.Append."""
+    try:
+      self.backend.Append(node, ds_path, attribute, values)
+    finally:
+      self.Invalidate(node, ds_path)
+
+  def Delete(self, node, ds_path, attribute=None, value=None):
+    """Deletes a record, attribute or value, see DsclBackend.Delete."""
+    try:
+      self.backend.Delete(node, ds_path, attribute, value)
+    finally:
+      self.Invalidate(node, ds_path)
+
+  def ModifyMany(self, changes):
+    """Makes several changes, see DsclBackend.ModifyMany."""
+    try:
+      return self.backend.ModifyMany(changes)
+    finally:
+      for unused_action, node, ds_path, unused_args in changes:
+        self.Invalidate(node, ds_path)
+
+  def Invalidate(self, node, ds_path):
+    """Drops every cached entry for a record."""
+    record = self._Key(node, ds_path, None)[:3]
+    with self._lock:
+      for key in [key for key in self._entries if key[:3] == record]:
+        del self._entries[key]
+
+  def Clear(self):
+    """Drops every cached entry."""
+    with self._lock:
+      self._entries.clear()
+
+  def Stats(self):
+    """Returns a dictionary of hit, miss and eviction counts."""
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses,
+              'evictions': self.evictions, 'expirations': self.expirations,
+              'entries': len(self._entries)}
+
+
+_backend = DsclBackend()
+
+
+def SetQueryBackend(backend):
+  """Sets the backend DirectoryServices queries and changes are sent to.
+
+  The default is a DsclBackend, which runs dscl for each command. A
+  DsclSessionBackend keeps one dscl process running instead; it is opt-in
+  as it relies on how interactive dscl frames its output.
+
+  Args:
+    backend: a DsclSessionBackend, DsclBackend, PlistBackend or another
+      object with the same Read, ReadRecords, Create, Append, Delete and
+      ModifyMany methods.
+  Returns:
+    The previous backend, so it can be restored.
+  """
+  global _backend
+  previous, _backend = _backend, backend
+  return previous
+
+
+def EnableReadCache(ttl=60, max_entries=1024):
+  """Caches DirectoryServices reads in front of the current backend.
+
+  UserAttribute and friends then only query DirectoryServices for records
+  and attributes which have not been read within ttl seconds, or have been
+  changed by pymacds since. Changes made by other processes are not seen
+  until the entries expire or FlushCache is called.
+
+  Args:
+    ttl: seconds a value is cached for.
+    max_entries: the most (record, attribute) values to keep.
+  Returns:
+    The CachingBackend, e.g. for its Stats.
+  """
+  if isinstance(_backend, CachingBackend):
+    DisableReadCache()
+  SetQueryBackend(CachingBackend(_backend, ttl=ttl, max_entries=max_entries))
+  return _backend
+
+
+def DisableReadCache():
+  """Stops caching DirectoryServices reads, see EnableReadCache."""
+  if isinstance(_backend, CachingBackend):
+    SetQueryBackend(_backend.backend)
+
+
+def ReadCacheStats():
+  """Returns the read cache statistics, or None if it is disabled."""
+  if isinstance(_backend, CachingBackend):
+    return _backend.Stats()
+  return None
+
+
+def _InvalidateReadCache(node, ds_path):
+  """Invalidates a record changed other than through the backend."""
+  if isinstance(_backend, CachingBackend):
+    _backend.Invalidate(node, ds_path)
+
+
 def FlushCache():
-  """Flushes the DirectoryService cache."""
+  """Flushes the DirectoryService cache and pymacds' read cache."""
+  if isinstance(_backend, CachingBackend):
+    _backend.Clear()
   command = [_DSCACHEUTIL, '-flushcache']
   RunProcess(command)
 
@@ -94,14 +789,15 @@ def _GetCSPSearchPathForPath(path):
     DSException: Unable to retrieve search nodes in path.
   """
 
-  command = [_DSCL, '-plist', path, '-read', '/', 'CSPSearchPath']
-  (stdout, stderr, unused_returncode) = RunProcess(command)
-  result = plistlib.readPlistFromString(stdout)
+  try:
+    result = _backend.Read(path, '/', ['CSPSearchPath'])
+  except DSException as e:
+    raise DSException('Unable to retrieve search nodes: %s' % e)
   if 'dsAttrTypeStandard:CSPSearchPath' in result:
     search_nodes = result['dsAttrTypeStandard:CSPSearchPath']
     return search_nodes
   else:
-    raise DSException('Unable to retrieve search nodes: %s' % stderr)
+    raise DSException('Unable to retrieve search nodes for %s' % path)
 
 
 def _ModifyCSPSearchPathForPath(action, node, path):
@@ -117,12 +813,17 @@ def _ModifyCSPSearchPathForPath(action, node, path):
     DSException: Could not modify nodes for path.
   """
 
-  command = [_DSCL, path, '-%s' % action, '/', 'CSPSearchPath', node]
-  (unused_stdout, stderr, returncode) = RunProcess(command)
-  if returncode:
+  try:
+    if action == 'append':
+      _backend.Append(path, '/', 'CSPSearchPath', [node])
+    elif action == 'delete':
+      _backend.Delete(path, '/', 'CSPSearchPath', node)
+    else:
+      raise DSException('unknown action')
+  except DSException as e:
     raise DSException('Unable to perform %s on CSPSearchPath '
                       'for node: %s on path: %s '
-                      'Error: %s '% (action, node, path, stderr))
+                      'Error: %s '% (action, node, path, e))
   FlushCache()
   return True
 
@@ -157,6 +858,79 @@ def DeleteNodeFromContactsPath(node):
   _ModifyCSPSearchPathForPath('delete', node, '/Search/Contacts')
 
 
+def _SearchPathChanges(path, current, desired):
+  """Returns the fewest changes which make a CSPSearchPath desired.
+
+  Nodes can only be appended to the end of the path, so the nodes kept are
+  the longest start of desired which is in current in the same order. The
+  other nodes in current are deleted and the rest of desired appended.
+
+  Args:
+    path: the DS path, '/Search' or '/Search/Contacts'.
+    current: the nodes in the path.
+    desired: the nodes the path should have, in order.
+  Returns:
+    A tuple of a list of nodes to delete, a list of nodes to append and a
+    list of changes for the backend's ModifyMany.
+  """
+  kept, position = [], 0
+  for node in desired:
+    if node not in current[position:]:
+      break
+    position = current.index(node, position) + 1
+    kept.append(node)
+  deleted = []
+  for node in current:
+    if node not in kept and node not in deleted:
+      deleted.append(node)
+  appended = list(desired[len(kept):])
+  changes = [('delete', path, '/', ['CSPSearchPath', node])
+             for node in deleted]
+  if appended:
+    changes.append(('append', path, '/', ['CSPSearchPath'] + appended))
+  return deleted, appended, changes
+
+
+def ReconcileSearchPaths(desired_search=None, desired_contacts=None):
+  """Makes the /Search and /Search/Contacts paths exactly as desired.
+
+  Each path is read once, the fewest deletions and appends which give the
+  desired nodes in the desired order are made in one batch, and the cache
+  is flushed once, if anything changed. Unlike the Ensure* functions, the
+  desired lists are complete: nodes not in them are removed.
+
+  Args:
+    desired_search: the nodes /Search should have, or None to leave it.
+    desired_contacts: the nodes /Search/Contacts should have, or None to
+      leave it.
+  Returns:
+    A dictionary of path: {'delete': nodes, 'append': nodes} for each path
+    reconciled.
+  Raises:
+    DSException: Unable to retrieve or modify search nodes.
+  """
+  report, changes = {}, []
+  for path, desired in (('/Search', desired_search),
+                        ('/Search/Contacts', desired_contacts)):
+    if desired is None:
+      continue
+    (deleted, appended, path_changes) = _SearchPathChanges(
+        path, _GetCSPSearchPathForPath(path), list(desired))
+    report[path] = {'delete': deleted, 'append': appended}
+    changes.extend(path_changes)
+  if not changes:
+    return report
+  errors = _backend.ModifyMany(changes)
+  FlushCache()
+  failures = ['%s %s on %s: %s' % (action, args[1:], path, error)
+              for (action, path, unused_ds_path, args), error
+              in zip(changes, errors) if error]
+  if failures:
+    raise DSException('Unable to modify CSPSearchPath: %s' %
+                      '; '.join(failures))
+  return report
+
+
 def EnsureSearchNodePresent(node):
   """Ensures a given DS node is present in the /Search path."""
   if node not in GetSearchNodes():
@@ -195,31 +969,42 @@ def DSQuery(dstype, objectname, attribute=None):
     DSException: Cannot query DirectoryServices.
   """
   ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '-plist', '.', '-read', ds_path]
+  plist = _backend.Read('.', ds_path, attribute and [attribute])
   if attribute:
-    cmd.append(attribute)
-  (stdout, stderr, returncode) = RunProcess(cmd)
-  if returncode:
-    raise DSException('Cannot query %s for %s: %s' % (ds_path,
-                                                      attribute,
-                                                      stderr))
-  plist = NSString.stringWithString_(stdout).propertyList()
-  if attribute:
-    value = None
-    if 'dsAttrTypeStandard:%s' % attribute in plist:
-      value = plist['dsAttrTypeStandard:%s' % attribute]
-    elif attribute in plist:
-      value = plist[attribute]
-    try:
-      # We're copying to a new list to convert from NSCFArray
-      return value[:]
-    except TypeError:
-      # ... unless we can't
-      return value
+    return _AttributeValue(plist, attribute)
   else:
     return plist
 
 
+def DSQueryMany(dstype, objectnames, attributes):
+  """DirectoryServices query for several objects and attributes at once.
+
+  The query backend reads all the objects in one go where it can, e.g. a
+  single dscl process rather than one per DSQuery.
+
+  Args:
+    dstype: The type of objects to query. user, group.
+    objectnames: the objects to query.
+    attributes: the attributes to query.
+  Returns:
+    A dictionary of objectname: {attribute: value}, with the same values
+    DSQuery returns for each object and attribute.
+  Raises:
+    DSException: Cannot query DirectoryServices or an object doesn't exist.
+  """
+  type_path = '/%ss' % dstype.capitalize()
+  objectnames = list(objectnames)
+  records = _backend.ReadRecords('.', type_path, set(objectnames), attributes)
+  missing = [name for name in objectnames if name not in records]
+  if missing:
+    raise DSException('Cannot query %s for %s: no such record(s) %s' %
+                      (type_path, attributes, ', '.join(missing)))
+  return dict((name, dict((attribute,
+                           _AttributeValue(records[name], attribute))
+                          for attribute in attributes))
+              for name in objectnames)
+
+
 def DSSet(dstype, objectname, attribute=None, value=None):
   """DirectoryServices attribute set.
 
@@ -234,19 +1019,18 @@ def DSSet(dstype, objectname, attribute=None, value=None):
     DSException: Cannot modify DirectoryServices.
   """
   ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '.', '-create', ds_path]
-  if attribute:
-    cmd.append(attribute)
-    if value:
-      if type(value) == type(list()):
-        cmd.extend(value)
-      else:
-        cmd.append(value)
-  (unused_stdout, stderr, returncode) = RunProcess(cmd)
-  if returncode:
+  values = []
+  if value:
+    if type(value) == type(list()):
+      values = value
+    else:
+      values = [value]
+  try:
+    _backend.Create('.', ds_path, attribute, values)
+  except DSException as e:
     raise DSException('Cannot set %s for %s: %s' % (attribute,
                                                     ds_path,
-                                                    stderr))
+                                                    e))
 
 
 def DSDelete(dstype, objectname, attribute=None, value=None):
@@ -261,16 +1045,12 @@ def DSDelete(dstype, objectname, attribute=None, value=None):
     DSException: Cannot modify DirectoryServices.
   """
   ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '.', '-delete', ds_path]
-  if attribute:
-    cmd.append(attribute)
-    if value:
-      cmd.extend([value])
-  (unused_stdout, stderr, returncode) = RunProcess(cmd)
-  if returncode:
+  try:
+    _backend.Delete('.', ds_path, attribute, value)
+  except DSException as e:
     raise DSException('Cannot delete %s for %s: %s' % (attribute,
                                                        ds_path,
-                                                       stderr))
+                                                       e))
 
 
 def UserAttribute(username, attribute):
@@ -297,6 +1077,30 @@ def GroupAttribute(groupname, attribute):
   return DSQuery('group', groupname, attribute)
 
 
+def UserAttributes(usernames, attributes):
+  """Returns the requested DirectoryService attributes for several users.
+
+  Args:
+    usernames: the users to retrieve values for.
+    attributes: the attributes to retrieve.
+  Returns:
+    A dictionary of username: {attribute: value}.
+  """
+  return DSQueryMany('user', usernames, attributes)
+
+
+def GroupAttributes(groupnames, attributes):
+  """Returns the requested DirectoryService attributes for several groups.
+
+  Args:
+    groupnames: the groups to retrieve values for.
+    attributes: the attributes to retrieve.
+  Returns:
+    A dictionary of groupname: {attribute: value}.
+  """
+  return DSQueryMany('group', groupnames, attributes)
+
+
 def AddUserToLocalGroup(username, group):
   """Adds user to a local group, uses dseditgroup to deal with GUIDs.
 
@@ -310,8 +1114,11 @@ def AddUserToLocalGroup(username, group):
   """
   cmd = [_DSEDITGROUP, '-o', 'edit', '-n', '.',
          '-a', username, '-t', 'user', group]
-  (stdout, stderr, rc) = RunProcess(cmd)
-  if rc is not 0:
+  try:
+    (stdout, stderr, rc) = RunProcess(cmd)
+  finally:
+    _InvalidateReadCache('.', '/Groups/%s' % group)
+  if rc != 0:
     raise DSException('Error adding %s to group %s, returned %s\n%s' %
                       (username, group, stdout, stderr))
 
@@ -329,7 +1136,142 @@ def RemoveUserFromLocalGroup(username, group):
   """
   cmd = [_DSEDITGROUP, '-o', 'edit', '-n', '.',
          '-d', username, '-t', 'user', group]
-  (unused_stdout, stderr, rc) = RunProcess(cmd)
-  if rc is not 0:
+  try:
+    (unused_stdout, stderr, rc) = RunProcess(cmd)
+  finally:
+    _InvalidateReadCache('.', '/Groups/%s' % group)
+  if rc != 0:
     raise DSException('Error removing %s from group %s, returned %s' %
                       (username, group, stderr))
+
+
+def _Unique(items):
+  """Returns items without duplicates, in order."""
+  unique = []
+  for item in items:
+    if item not in unique:
+      unique.append(item)
+  return unique
+
+
+def _ChangeLocalGroupMembers(membership, mode):
+  """Changes the members of local groups in one batch.
+
+  Each group's GroupMembership (user names) and GroupMembers (their GUIDs)
+  are changed directly with dscl, as dseditgroup would, so the changes for
+  all groups go to the backend at once: with a DsclSessionBackend, that is
+  one dscl session instead of a dseditgroup process per user and group.
+  The groups, and the users being added or removed, are each read once.
+
+  Args:
+    membership: a dictionary of group: users.
+    mode: 'add' to add the users, 'remove' to remove them, or 'set' to
+      add them and remove everyone else.
+  Returns:
+    A dictionary of group: {user: (action, error)}, for each user given
+    and, with 'set', each user removed. action is 'add', 'remove', or None
+    if the user needed no change; error is None or why the change failed.
+  Raises:
+    DSException: A group doesn't exist, nothing was changed.
+  """
+  membership = dict((group, _Unique(users))
+                    for group, users in membership.items())
+  groups = GroupAttributes(list(membership), ['GroupMembership',
+                                              'GroupMembers'])
+  report, additions, removals = {}, {}, {}
+  for group, users in membership.items():
+    current = groups[group]['GroupMembership'] or []
+    report[group] = dict((user, (None, None)) for user in users)
+    additions[group] = []
+    if mode in ('add', 'set'):
+      additions[group] = [user for user in users if user not in current]
+    removals[group] = []
+    if mode == 'remove':
+      removals[group] = [user for user in users if user in current]
+    elif mode == 'set':
+      removals[group] = [user for user in current if user not in users]
+
+  users = set()
+  for group in membership:
+    users.update(additions[group] + removals[group])
+  guids = {}
+  if users:
+    for user, record in _backend.ReadRecords('.', '/Users', users,
+                                             ['GeneratedUID']).items():
+      guids[user] = (_AttributeValue(record, 'GeneratedUID') or [None])[0]
+
+  # Each change, with the (group, user, action) it is made for:
+  changes, members = [], []
+  for group in sorted(membership):
+    ds_path = '/Groups/%s' % group
+    adding = []
+    for user in additions[group]:
+      if user in guids:
+        adding.append(user)
+      else:
+        report[group][user] = ('add', 'no such user')
+    if adding:
+      added = [(group, user, 'add') for user in adding]
+      changes.append(('append', '.', ds_path, ['GroupMembership'] + adding))
+      members.append(added)
+      added_guids = [guids[user] for user in adding if guids[user]]
+      if added_guids:
+        changes.append(('append', '.', ds_path,
+                        ['GroupMembers'] + added_guids))
+        members.append(added)
+    current_guids = groups[group]['GroupMembers'] or []
+    for user in removals[group]:
+      # Users may have been deleted without being removed from groups:
+      changes.append(('delete', '.', ds_path, ['GroupMembership', user]))
+      members.append([(group, user, 'remove')])
+      if guids.get(user) in current_guids:
+        changes.append(('delete', '.', ds_path, ['GroupMembers',
+                                                 guids[user]]))
+        members.append([(group, user, 'remove')])
+
+  errors = _backend.ModifyMany(changes) if changes else []
+  for change_members, error in zip(members, errors):
+    for group, user, action in change_members:
+      # Keep the first error, e.g. for GroupMembership over GroupMembers:
+      previous_error = report[group].get(user, (None, None))[1]
+      report[group][user] = (action, previous_error or error)
+  return report
+
+
+def ReconcileLocalGroupMembers(membership):
+  """Makes the members of local groups exactly the given users.
+
+  Args:
+    membership: a dictionary of group: users.
+  Returns:
+    A report of each user's change, see _ChangeLocalGroupMembers.
+  Raises:
+    DSException: A group doesn't exist, nothing was changed.
+  """
+  return _ChangeLocalGroupMembers(membership, 'set')
+
+
+def AddUsersToLocalGroups(membership):
+  """Adds users to local groups, leaving their other members.
+
+  Args:
+    membership: a dictionary of group: users to add.
+  Returns:
+    A report of each user's change, see _ChangeLocalGroupMembers.
+  Raises:
+    DSException: A group doesn't exist, nothing was changed.
+  """
+  return _ChangeLocalGroupMembers(membership, 'add')
+
+
+def RemoveUsersFromLocalGroups(membership):
+  """Removes users from local groups.
+
+  Args:
+    membership: a dictionary of group: users to remove.
+  Returns:
+    A report of each user's change, see _ChangeLocalGroupMembers.
+  Raises:
+    DSException: A group doesn't exist, nothing was changed.
+  """
+  return _ChangeLocalGroupMembers(membership, 'remove')
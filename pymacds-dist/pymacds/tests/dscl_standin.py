@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Emulates interactive dscl -plist over a PlistBackend tree, for tests.
+
+Usage: dscl_standin.py ROOT
+
+Paths are absolute, as in a dscl session started without a node, with the
+local node at /Local/Default. Reading a record named "crash" makes it exit
+as if dscl had crashed.
+"""
+
+import os
+import shlex
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+import pymacds  # pylint: disable=C6204
+
+
+def SplitPath(path):
+  """Returns the (node, ds_path) a PlistBackend expects for a dscl path."""
+  if path.startswith('/Local/Default/'):
+    return '.', path[len('/Local/Default'):]
+  return path, '/'
+
+
+def Run(backend, args):
+  """Runs a dscl command, returning its output."""
+  command, (node, ds_path), args = args[0], SplitPath(args[1]), args[2:]
+  if command == 'read':
+    if ds_path.endswith('/crash'):
+      sys.exit(1)
+    plist = backend.Read(node, ds_path, args or None)
+    return pymacds._FormatPlist(plist).decode('utf-8')
+  elif command == 'create':
+    backend.Create(node, ds_path, args[0] if args else None, args[1:])
+  elif command == 'append':
+    backend.Append(node, ds_path, args[0], args[1:])
+  elif command == 'delete':
+    backend.Delete(node, ds_path, args[0] if args else None,
+                   args[1] if len(args) > 1 else None)
+  else:
+    return 'Unrecognized command: %s\n' % command
+  return ''
+
+
+def main(root):
+  backend = pymacds.PlistBackend(root)
+  sys.stdout.write('Entering interactive mode... (type "help" for commands)'
+                   '\n > ')
+  sys.stdout.flush()
+  while True:
+    line = sys.stdin.readline()
+    if not line or line.strip() == 'quit':
+      break
+    try:
+      sys.stdout.write(Run(backend, shlex.split(line)))
+    except pymacds.DSException:
+      sys.stdout.write('%s: DS Error: -14136 (eDSRecordNotFound)\n' %
+                       line.split()[0])
+    sys.stdout.write(' > ')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import plistlib
+import shutil
+import stat
+import tempfile
+import unittest
+
+import pymacds
+
+
+def WritePlist(path, plist):
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'wb') as f:
+    plistlib.dump(plist, f)
+
+
+def UserRecord(name, uid):
+  return {
+      'dsAttrTypeStandard:RecordName': [name],
+      'dsAttrTypeStandard:RealName': [name.capitalize()],
+      'dsAttrTypeStandard:UniqueID': [str(uid)],
+      'dsAttrTypeNative:_writers_passwd': [name],
+  }
+
+
+class PlistBackendTests(unittest.TestCase):
+  """Unit tests for queries answered by PlistBackend"""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    for uid, name in enumerate(['alice', 'bob', 'carol'], 501):
+      WritePlist(os.path.join(self.root, 'Users', name + '.plist'),
+                 UserRecord(name, uid))
+    WritePlist(os.path.join(self.root, 'Search.plist'), {
+        'dsAttrTypeStandard:CSPSearchPath': ['/Local/Default', '/BSD/local']
+    })
+    self.previous = pymacds.SetQueryBackend(pymacds.PlistBackend(self.root))
+
+  def tearDown(self):
+    pymacds.SetQueryBackend(self.previous)
+    shutil.rmtree(self.root)
+
+  def testDSQuery(self):
+    self.assertEqual(pymacds.UserAttribute('bob', 'RealName'), ['Bob'])
+    self.assertEqual(pymacds.UserAttribute('bob', 'dsAttrTypeNative:'
+                                           '_writers_passwd'), ['bob'])
+    self.assertEqual(pymacds.UserAttribute('bob', 'NFSHomeDirectory'), None)
+    self.assertEqual(pymacds.DSQuery('user', 'bob'), UserRecord('bob', 502))
+    self.assertRaises(pymacds.DSException, pymacds.DSQuery, 'user', 'dave')
+
+  def testDSQueryMany(self):
+    result = pymacds.UserAttributes(['alice', 'carol'],
+                                    ['UniqueID', 'Shell'])
+    self.assertEqual(result, {
+        'alice': {'UniqueID': ['501'], 'Shell': None},
+        'carol': {'UniqueID': ['503'], 'Shell': None},
+    })
+    self.assertRaises(pymacds.DSException, pymacds.UserAttributes,
+                      ['alice', 'dave'], ['UniqueID'])
+
+  def testSearchNodes(self):
+    self.assertEqual(pymacds.GetSearchNodes(), ['/Local/Default', '/BSD/local'])
+    self.assertRaises(pymacds.DSException, pymacds.GetContactsNodes)
+
+
+class DsclBackendTests(unittest.TestCase):
+  """Unit tests for DsclBackend, using a script in place of dscl"""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.args_file = os.path.join(self.tmp_dir, 'args')
+    output = os.path.join(self.tmp_dir, 'output.plist')
+    WritePlist(output, [UserRecord('alice', 501), UserRecord('bob', 502)])
+    self.dscl = os.path.join(self.tmp_dir, 'dscl')
+    with open(self.dscl, 'w') as f:
+      f.write('#!/bin/sh\necho "$@" >> %s\ncat %s\n' % (self.args_file,
+                                                         output))
+    os.chmod(self.dscl, stat.S_IRWXU)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testReadRecords(self):
+    backend = pymacds.DsclBackend(dscl=self.dscl)
+    records = backend.ReadRecords('.', '/Users', ['alice', 'bob', 'dave'],
+                                  ['UniqueID'])
+    self.assertEqual(sorted(records), ['alice', 'bob'])
+    self.assertEqual(records['bob'], UserRecord('bob', 502))
+    with open(self.args_file) as f:
+      self.assertEqual(f.read().splitlines(),
+                       ['-plist . -readall /Users RecordName UniqueID'])
+
+  def testReadNoRecords(self):
+    backend = pymacds.DsclBackend(dscl=self.dscl)
+    self.assertEqual(backend.ReadRecords('.', '/Users', []), {})
+    self.assertFalse(os.path.exists(self.args_file))
+
+  def testRunProcessEnvironment(self):
+    environ = dict(os.environ)
+    (stdout, unused_stderr, returncode) = pymacds.RunProcess(
+        ['/bin/sh', '-c', 'echo $PYMACDS_TEST'], env={'PYMACDS_TEST': 'x'})
+    self.assertEqual((stdout, returncode), (b'x\n', 0))
+    self.assertEqual(dict(os.environ), environ)
+
+
+if __name__ == '__main__':
+  unittest.main()
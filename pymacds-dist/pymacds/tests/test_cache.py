@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+import pymacds
+
+
+class ReadCacheTests(unittest.TestCase):
+  """Unit tests for the pymacds read cache, over a PlistBackend"""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.now = 1000.0
+    self.WriteRecord('Users', 'alice', RealName=['Alice'], UserShell=['/bin/sh'])
+    self.WriteRecord('Users', 'bob', RealName=['Bob'])
+    self.WriteRecord('Groups', 'admin', GroupMembership=['root'])
+    self.previous = pymacds.SetQueryBackend(pymacds.PlistBackend(self.root))
+    self.cache = pymacds.EnableReadCache(ttl=60, max_entries=100)
+    self.cache.clock = lambda: self.now
+
+  def tearDown(self):
+    pymacds.SetQueryBackend(self.previous)
+    shutil.rmtree(self.root)
+
+  def WriteRecord(self, record_type, name, **attributes):
+    path = os.path.join(self.root, record_type, name + '.plist')
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    plist = dict(('dsAttrTypeStandard:%s' % k, v)
+                 for k, v in attributes.items())
+    plist['dsAttrTypeStandard:RecordName'] = [name]
+    with open(path, 'wb') as f:
+      plistlib.dump(plist, f)
+
+  def Stats(self, *keys):
+    stats = pymacds.ReadCacheStats()
+    return tuple(stats[key] for key in keys)
+
+  def testTTL(self):
+    self.assertEqual(pymacds.UserAttribute('alice', 'RealName'), ['Alice'])
+    self.WriteRecord('Users', 'alice', RealName=['Alice Smith'])
+    self.assertEqual(pymacds.UserAttribute('alice', 'RealName'), ['Alice'])
+    self.assertEqual(self.Stats('hits', 'misses'), (1, 1))
+    self.now += 61
+    self.assertEqual(pymacds.UserAttribute('alice', 'RealName'),
+                     ['Alice Smith'])
+    self.assertEqual(self.Stats('misses', 'expirations'), (2, 1))
+
+  def testCachedValuesAreCopies(self):
+    pymacds.UserAttribute('alice', 'RealName').append('Mallory')
+    self.assertEqual(pymacds.UserAttribute('alice', 'RealName'), ['Alice'])
+
+  def testLRU(self):
+    self.cache.max_entries = 2
+    pymacds.UserAttribute('alice', 'RealName')
+    pymacds.UserAttribute('bob', 'RealName')
+    pymacds.UserAttribute('alice', 'RealName')
+    pymacds.UserAttribute('alice', 'UserShell')
+    self.assertEqual(self.Stats('evictions', 'entries'), (1, 2))
+    pymacds.UserAttribute('alice', 'RealName')
+    pymacds.UserAttribute('bob', 'RealName')
+    self.assertEqual(self.Stats('hits', 'misses'), (2, 4))
+
+  def testBatch(self):
+    pymacds.UserAttribute('alice', 'RealName')
+    result = pymacds.UserAttributes(['alice', 'bob'], ['RealName', 'UserShell'])
+    self.assertEqual(result['alice'], {'RealName': ['Alice'],
+                                       'UserShell': ['/bin/sh']})
+    self.assertEqual(result['bob'], {'RealName': ['Bob'], 'UserShell': None})
+    self.assertEqual(self.Stats('hits', 'misses'), (1, 4))
+    pymacds.UserAttributes(['alice', 'bob'], ['RealName', 'UserShell'])
+    self.assertEqual(self.Stats('hits', 'misses'), (5, 4))
+
+  def testInvalidation(self):
+    pymacds.UserAttribute('alice', 'RealName')
+    pymacds.DSQuery('user', 'alice')
+    pymacds.DSSet('user', 'alice', 'RealName', 'Alice Smith')
+    self.assertEqual(self.Stats('entries'), (0,))
+    self.assertEqual(pymacds.UserAttribute('alice', 'RealName'),
+                     ['Alice Smith'])
+    pymacds.DSDelete('user', 'alice', 'RealName')
+    self.assertEqual(pymacds.UserAttribute('alice', 'RealName'), None)
+
+  def testGroupChangesInvalidate(self):
+    dseditgroup = pymacds._DSEDITGROUP
+    pymacds._DSEDITGROUP = shutil.which('true')
+    try:
+      pymacds.GroupAttribute('admin', 'GroupMembership')
+      pymacds.UserAttribute('alice', 'RealName')
+      pymacds.AddUserToLocalGroup('alice', 'admin')
+      self.assertEqual(self.Stats('entries'), (1,))
+      pymacds.GroupAttribute('admin', 'GroupMembership')
+      pymacds.RemoveUserFromLocalGroup('alice', 'admin')
+      self.assertEqual(self.Stats('entries'), (1,))
+    finally:
+      pymacds._DSEDITGROUP = dseditgroup
+
+  def testDisable(self):
+    pymacds.DisableReadCache()
+    self.assertEqual(pymacds.ReadCacheStats(), None)
+    self.assertTrue(isinstance(pymacds.SetQueryBackend(self.previous),
+                               pymacds.PlistBackend))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pymacds
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'dscl_standin.py')
+
+
+class ReadLoggingBackend(pymacds.PlistBackend):
+  """A PlistBackend which logs the record types passed to ReadRecords"""
+
+  def __init__(self, root):
+    pymacds.PlistBackend.__init__(self, root)
+    self.reads = []
+
+  def ReadRecords(self, node, type_path, names, attributes=None):
+    self.reads.append(type_path)
+    return pymacds.PlistBackend.ReadRecords(self, node, type_path, names,
+                                            attributes)
+
+
+class GroupMembershipTests(unittest.TestCase):
+  """Unit tests for the bulk group membership functions"""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    for user in ['root', 'alice', 'bob', 'carol']:
+      self.WriteRecord('Users', user, GeneratedUID=['GUID-' + user])
+    self.WriteRecord('Groups', 'admin', GroupMembership=['root', 'alice'],
+                     GroupMembers=['GUID-root', 'GUID-alice'])
+    self.WriteRecord('Groups', 'staff', GroupMembership=['carol', 'zed'],
+                     GroupMembers=['GUID-carol'])
+    self.previous = pymacds.SetQueryBackend(pymacds.PlistBackend(self.root))
+
+  def tearDown(self):
+    pymacds.SetQueryBackend(self.previous)
+    shutil.rmtree(self.root)
+
+  def WriteRecord(self, record_type, name, **attributes):
+    path = os.path.join(self.root, record_type, name + '.plist')
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    plist = dict(('dsAttrTypeStandard:%s' % k, v)
+                 for k, v in attributes.items())
+    with open(path, 'wb') as f:
+      plistlib.dump(plist, f)
+
+  def Members(self, group):
+    return pymacds.GroupAttributes([group], ['GroupMembership',
+                                             'GroupMembers'])[group]
+
+  def testReconcile(self):
+    report = pymacds.ReconcileLocalGroupMembers({
+        'admin': ['alice', 'bob'],
+        'staff': ['alice', 'alice'],
+    })
+    self.assertEqual(report, {
+        'admin': {'alice': (None, None), 'bob': ('add', None),
+                  'root': ('remove', None)},
+        'staff': {'alice': ('add', None), 'carol': ('remove', None),
+                  'zed': ('remove', None)},
+    })
+    self.assertEqual(self.Members('admin'), {
+        'GroupMembership': ['alice', 'bob'],
+        'GroupMembers': ['GUID-alice', 'GUID-bob']})
+    self.assertEqual(self.Members('staff'), {
+        'GroupMembership': ['alice'], 'GroupMembers': ['GUID-alice']})
+
+  def testAddAndRemove(self):
+    report = pymacds.AddUsersToLocalGroups({'admin': ['alice', 'bob', 'dave']})
+    self.assertEqual(report['admin'], {'alice': (None, None),
+                                       'bob': ('add', None),
+                                       'dave': ('add', 'no such user')})
+    report = pymacds.RemoveUsersFromLocalGroups({'admin': ['bob', 'carol']})
+    self.assertEqual(report['admin'], {'bob': ('remove', None),
+                                       'carol': (None, None)})
+    self.assertEqual(self.Members('admin'), {
+        'GroupMembership': ['root', 'alice'],
+        'GroupMembers': ['GUID-root', 'GUID-alice']})
+
+  def testNoChanges(self):
+    backend = ReadLoggingBackend(self.root)
+    pymacds.SetQueryBackend(backend)
+    report = pymacds.AddUsersToLocalGroups({'admin': ['alice']})
+    self.assertEqual(report['admin'], {'alice': (None, None)})
+    self.assertEqual(backend.reads, ['/Groups'])
+
+  def testMissingGroup(self):
+    self.assertRaises(pymacds.DSException, pymacds.AddUsersToLocalGroups,
+                      {'admin': ['bob'], 'wheel': ['bob']})
+    self.assertEqual(self.Members('admin')['GroupMembership'],
+                     ['root', 'alice'])
+
+  def testSession(self):
+    session = pymacds.DsclSession([sys.executable, STANDIN, self.root],
+                                  timeout=10)
+    pymacds.SetQueryBackend(pymacds.DsclSessionBackend(session))
+    try:
+      users = ['alice', 'bob', 'carol']
+      report = pymacds.ReconcileLocalGroupMembers({'admin': users,
+                                                   'staff': users})
+      self.assertEqual(self.Members('staff')['GroupMembership'],
+                       ['carol', 'alice', 'bob'])
+      self.assertEqual(report['staff']['zed'], ('remove', None))
+      self.assertEqual(session.starts, 1)
+    finally:
+      session.Close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import plistlib
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+import pymacds
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'dscl_standin.py')
+
+
+class ReconcileSearchPathsTests(unittest.TestCase):
+  """Unit tests for ReconcileSearchPaths, over a PlistBackend"""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.SetPath('Search', ['/Local/Default', '/BSD/local', '/LDAPv3/old'])
+    self.SetPath('Search/Contacts', ['/Local/Default', '/LDAPv3/old'])
+    # Count the cache flushes:
+    self.flushes = os.path.join(self.root, 'flushes')
+    dscacheutil = os.path.join(self.root, 'dscacheutil')
+    with open(dscacheutil, 'w') as f:
+      f.write('#!/bin/sh\necho "$@" >> %s\n' % self.flushes)
+    os.chmod(dscacheutil, stat.S_IRWXU)
+    self.dscacheutil, pymacds._DSCACHEUTIL = pymacds._DSCACHEUTIL, dscacheutil
+    self.previous = pymacds.SetQueryBackend(pymacds.PlistBackend(self.root))
+
+  def tearDown(self):
+    pymacds._DSCACHEUTIL = self.dscacheutil
+    pymacds.SetQueryBackend(self.previous)
+    shutil.rmtree(self.root)
+
+  def SetPath(self, path, nodes):
+    plist_file = os.path.join(self.root, path + '.plist')
+    if not os.path.isdir(os.path.dirname(plist_file)):
+      os.makedirs(os.path.dirname(plist_file))
+    with open(plist_file, 'wb') as f:
+      plistlib.dump({'dsAttrTypeStandard:CSPSearchPath': nodes}, f)
+
+  def Flushes(self):
+    if not os.path.exists(self.flushes):
+      return 0
+    with open(self.flushes) as f:
+      return len(f.readlines())
+
+  def testReconcile(self):
+    report = pymacds.ReconcileSearchPaths(
+        ['/Local/Default', '/BSD/local', '/LDAPv3/new', '/Active Directory/A'],
+        ['/Local/Default'])
+    self.assertEqual(report, {
+        '/Search': {'delete': ['/LDAPv3/old'],
+                    'append': ['/LDAPv3/new', '/Active Directory/A']},
+        '/Search/Contacts': {'delete': ['/LDAPv3/old'], 'append': []},
+    })
+    self.assertEqual(pymacds.GetSearchNodes(), [
+        '/Local/Default', '/BSD/local', '/LDAPv3/new', '/Active Directory/A'])
+    self.assertEqual(pymacds.GetContactsNodes(), ['/Local/Default'])
+    self.assertEqual(self.Flushes(), 1)
+
+  def testOrder(self):
+    report = pymacds.ReconcileSearchPaths(
+        ['/Local/Default', '/LDAPv3/old', '/BSD/local'])
+    self.assertEqual(report, {'/Search': {'delete': ['/BSD/local'],
+                                          'append': ['/BSD/local']}})
+    self.assertEqual(pymacds.GetSearchNodes(),
+                     ['/Local/Default', '/LDAPv3/old', '/BSD/local'])
+
+  def testNoChanges(self):
+    report = pymacds.ReconcileSearchPaths(
+        desired_contacts=['/Local/Default', '/LDAPv3/old'])
+    self.assertEqual(report, {'/Search/Contacts': {'delete': [],
+                                                   'append': []}})
+    self.assertEqual(self.Flushes(), 0)
+
+  def testFailure(self):
+    os.remove(os.path.join(self.root, 'Search', 'Contacts.plist'))
+    self.assertRaises(pymacds.DSException, pymacds.ReconcileSearchPaths,
+                      desired_contacts=['/Local/Default'])
+
+  def testSession(self):
+    session = pymacds.DsclSession([sys.executable, STANDIN, self.root],
+                                  timeout=10)
+    pymacds.SetQueryBackend(pymacds.DsclSessionBackend(session))
+    try:
+      pymacds.ReconcileSearchPaths(['/Local/Default', '/LDAPv3/new'],
+                                   ['/LDAPv3/new'])
+      self.assertEqual(pymacds.GetSearchNodes(),
+                       ['/Local/Default', '/LDAPv3/new'])
+      self.assertEqual(pymacds.GetContactsNodes(), ['/LDAPv3/new'])
+      self.assertEqual(session.starts, 1)
+    finally:
+      session.Close()
+    self.assertEqual(self.Flushes(), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pymacds
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'dscl_standin.py')
+
+
+class DsclSessionTests(unittest.TestCase):
+  """Unit tests for DsclSessionBackend, using a stand-in for dscl"""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.root, 'Users'))
+    for name in ['alice', 'bob']:
+      with open(os.path.join(self.root, 'Users', name + '.plist'), 'wb') as f:
+        plistlib.dump({'dsAttrTypeStandard:RecordName': [name],
+                       'dsAttrTypeStandard:UserShell': ['/bin/zsh']}, f)
+    self.session = pymacds.DsclSession([sys.executable, STANDIN, self.root],
+                                       timeout=10)
+    self.previous = pymacds.SetQueryBackend(
+        pymacds.DsclSessionBackend(self.session))
+
+  def tearDown(self):
+    pymacds.SetQueryBackend(self.previous)
+    self.session.Close()
+    shutil.rmtree(self.root)
+
+  def testQueries(self):
+    self.assertEqual(pymacds.UserAttribute('alice', 'UserShell'), ['/bin/zsh'])
+    self.assertRaises(pymacds.DSException, pymacds.DSQuery, 'user', 'dave')
+    self.session.CHUNK = 2
+    result = pymacds.UserAttributes(['alice', 'bob', 'alice'], ['RecordName'])
+    self.assertEqual(result['bob'], {'RecordName': ['bob']})
+    self.assertEqual(self.session.starts, 1)
+
+  def testChanges(self):
+    pymacds.DSSet('user', 'bob', 'RealName', 'Bob "Robert" Smith')
+    pymacds.DSSet('user', 'carol', 'MailAddress', ['c@a.b', 'c@d.e'])
+    pymacds.DSDelete('user', 'alice')
+    pymacds.DSDelete('user', 'carol', 'MailAddress', 'c@a.b')
+    self.assertEqual(pymacds.UserAttribute('bob', 'RealName'),
+                     ['Bob "Robert" Smith'])
+    self.assertEqual(pymacds.UserAttribute('carol', 'MailAddress'), ['c@d.e'])
+    self.assertRaises(pymacds.DSException, pymacds.DSQuery, 'user', 'alice')
+    self.assertRaises(pymacds.DSException, pymacds.DSDelete, 'user', 'alice',
+                      'UserShell')
+    self.assertEqual(self.session.starts, 1)
+
+  def testRestart(self):
+    self.assertEqual(pymacds.UserAttribute('alice', 'UserShell'), ['/bin/zsh'])
+    self.session.process.kill()
+    self.assertEqual(pymacds.UserAttribute('bob', 'UserShell'), ['/bin/zsh'])
+    # A read is retried once when the session fails:
+    self.assertRaises(pymacds.DsclSessionError, pymacds.DSQuery, 'user',
+                      'crash')
+    self.assertEqual(self.session.starts, 3)
+    self.assertEqual(pymacds.UserAttribute('bob', 'UserShell'), ['/bin/zsh'])
+    self.assertEqual(self.session.starts, 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
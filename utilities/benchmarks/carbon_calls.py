@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Measures calls/sec through load_carbon_framework with and without prototypes.
+
+Usage: carbon_calls.py [--calls=N]
+
+On Mac OS X this calls SecKeychainGetVersion from Security.framework, which
+has no side effects; elsewhere it calls atoi from the C library, which
+exercises the same ctypes paths. Three call styles are compared:
+
+  lookup:       framework[name](...) on every call, as callers used to do
+  unprototyped: framework.name(...), resolved once but with no argtypes
+  prototyped:   framework.name(...) declared through the prototypes argument
+"""
+
+import ctypes
+import ctypes.util
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+import PyMacAdmin  # pylint: disable=C6204
+from PyMacAdmin import Security  # pylint: disable=C6204
+
+
+def target():
+  """Returns (library path, function name, prototype, argument factory)."""
+  if os.path.exists(Security.SECURITY_FRAMEWORK):
+    version = ctypes.c_uint32()
+    return (Security.SECURITY_FRAMEWORK, "SecKeychainGetVersion",
+            (ctypes.c_int32, [ctypes.POINTER(ctypes.c_uint32)]),
+            lambda: (ctypes.byref(version),))
+  return (ctypes.util.find_library("c"), "atoi",
+          (ctypes.c_int32, [ctypes.c_char_p]), lambda: (b"42",))
+
+
+def calls_per_second(call, args, count):
+  start = time.perf_counter()
+  for unused_i in range(count):
+    call(*args)
+  return count / (time.perf_counter() - start)
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--calls", type="int", default=200000)
+  (options, unused_args) = parser.parse_args()
+
+  path, name, prototype, make_args = target()
+  args = make_args()
+  plain = PyMacAdmin.load_carbon_framework(path)
+  declared = PyMacAdmin.load_carbon_framework(path, {name: prototype})
+
+  results = [
+      ("lookup", calls_per_second(lambda *a: plain[name](*a), args,
+                                  options.calls)),
+      ("unprototyped", calls_per_second(getattr(plain, name), args,
+                                        options.calls)),
+      ("prototyped", calls_per_second(getattr(declared, name), args,
+                                      options.calls)),
+  ]
+
+  print("%s from %s, %d calls" % (name, path, options.calls))
+  print("%-15s %12s %8s" % ("style", "calls/sec", "speedup"))
+  for style, rate in results:
+    print("%-15s %12.0f %7.2fx" % (style, rate, rate / results[0][1]))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Compares crankd startup with and without the configuration cache.
+
+Usage: crankd_config_cache.py [--keys=N] [--rounds=N]
+
+Writes a configuration with N SystemConfiguration keys, similar to the output
+of examples/crankd/sample-of-events/generate-event-plist.py, and times
+core.load_config plus core.add_sc_handlers: "cold" parses the plist and
+builds the dispatch index, "warm" loads both from the cache. The regular
+expressions in the index are compiled again when it is unpickled, so "warm"
+saves the plist parsing and the building of the index's tries, not the
+regular expression compilation.
+"""
+
+import optparse
+import os
+import plistlib
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+from PyMacAdmin.crankd import core  # pylint: disable=C6204
+
+
+class Options(object):
+
+  def __init__(self, config_file):
+    self.config_file = config_file
+
+
+def make_config(keys):
+  handler = {"command": "/usr/bin/true"}
+  sc_config = dict()
+  for i in range(keys):
+    sc_config["State:/Network/Service/%08X/IPv4" % i] = handler
+  for i in range(keys // 100):
+    sc_config["State:/Network/Interface/en%d[0-9]*/Link" % i] = handler
+  return {"SystemConfiguration": sc_config}
+
+
+def startup(options, cache_path):
+  core.reset_handlers()
+  # A new crankd process starts without re's cache of compiled patterns:
+  re.purge()
+  start = time.monotonic()
+  config = core.load_config(options, cache_path)
+  core.add_sc_handlers(config["SystemConfiguration"])
+  return time.monotonic() - start
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--keys", type="int", default=5000)
+  parser.add_option("--rounds", type="int", default=5)
+  (options, unused_args) = parser.parse_args()
+
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    config_file = os.path.join(tmp_dir, "crankd.plist")
+    cache_path = os.path.join(tmp_dir, "config.cache")
+    with open(config_file, "wb") as f:
+      plistlib.dump(make_config(options.keys), f)
+
+    load_options = Options(config_file)
+    cold = min(startup(load_options, None) for _ in range(options.rounds))
+    startup(load_options, cache_path)  # Writes the cache
+    warm = min(startup(load_options, cache_path)
+               for _ in range(options.rounds))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+  print("%d keys: cold %0.1fms, warm %0.1fms (%0.1fx)" %
+        (options.keys, cold * 1000, warm * 1000, cold / warm))
+
+
+if __name__ == "__main__":
+  main()
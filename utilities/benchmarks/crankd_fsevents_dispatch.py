@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Replays a synthetic FSEvents batch through crankd's path matching.
+
+Usage: crankd_fsevents_dispatch.py [--events=N] [--watches=N]
+
+crankd watches every module in sys.modules for conditional restarts, so the
+default configuration has several hundred watched directories before any
+user configuration is added. This compares the str.startswith() scan which
+fsevent_callback used to perform with dispatch.PathTrie. The scan also fires
+more callbacks because it matches .../pkg1 for events under .../pkg10.
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+from PyMacAdmin.crankd import dispatch  # pylint: disable=C6204
+
+
+def make_watches(count):
+  """Returns count directories resembling sys.modules plus a user config."""
+  watches = ["/Library/Preferences", "/Users/Shared", "/Applications"]
+  base = "/System/Library/Frameworks/Python.framework/Versions/3.11/lib"
+  i = 0
+  while len(watches) < count:
+    watches.append("%s/python3.11/pkg%d" % (base, i))
+    watches.append("/Library/Python/3.11/site-packages/mod%d" % i)
+    i += 1
+  return watches[:count]
+
+
+def make_events(count, watches):
+  """Returns count event directories, roughly a quarter of them watched."""
+  rng = random.Random(42)
+  events = list()
+  for i in range(count):
+    if i % 4:
+      events.append("/private/var/folders/xx/%d/T/item%d" % (i % 97, i))
+    else:
+      events.append("%s/sub%d" % (rng.choice(watches), i % 13))
+  return events
+
+
+def legacy_dispatch(watched, events):
+  fired = 0
+  for path in events:
+    for j in [k for k in watched if path.startswith(k)]:
+      fired += len(watched[j])
+  return fired
+
+
+def trie_dispatch(trie, events):
+  fired = 0
+  for path in events:
+    for unused_path, callbacks in trie.ancestors(path):
+      fired += len(callbacks)
+  return fired
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--events", type="int", default=100000)
+  parser.add_option("--watches", type="int", default=500)
+  (options, unused_args) = parser.parse_args()
+
+  watches = make_watches(options.watches)
+  events = make_events(options.events, watches)
+
+  watched = dict((w, [None]) for w in watches)
+  trie = dispatch.PathTrie()
+  for w in watches:
+    trie.add(w, None)
+
+  for name, func, arg in [("startswith scan", legacy_dispatch, watched),
+                          ("PathTrie", trie_dispatch, trie)]:
+    start = time.perf_counter()
+    fired = func(arg, events)
+    elapsed = time.perf_counter() - start
+    print("%-16s %8d events %8d callbacks %8.3fs %12.0f events/sec" %
+          (name, len(events), fired, elapsed, len(events) / elapsed))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Measures crankd handler throughput by replaying a synthetic event storm.
+
+Usage: crankd_replay.py [--events=N] [--keys=N] [EVENT_LOG]
+
+Without EVENT_LOG, the events are synthesized from a configuration similar to
+the output of examples/crankd/sample-of-events/generate-event-plist.py. Each
+scenario replays the same events as fast as possible with no-op Python
+handlers called synchronously, coalesced and through the executor.
+"""
+
+import optparse
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+from PyMacAdmin.crankd import core  # pylint: disable=C6204
+from PyMacAdmin.crankd import replay  # pylint: disable=C6204
+
+
+def noop(*unused_args, **unused_kwargs):
+  pass
+
+
+def make_config(keys, handler_options):
+  handler = dict(handler_options, function="__main__.noop")
+  sc_config = dict()
+  for i in range(keys):
+    sc_config["State:/Network/Service/%08X/IPv4" % i] = handler
+  sc_config["State:/Network/Interface/en[0-9]+/Link"] = handler
+  return {
+      "SystemConfiguration": sc_config,
+      "NSWorkspace": {"NSWorkspaceDidWakeNotification": handler},
+  }
+
+
+SCENARIOS = [
+    ("synchronous", {}, {}),
+    ("coalesced", {"debounce": 1.0}, {}),
+    ("executor", {}, {"Executor": {"threads": 4}}),
+    ("executor+coalesced", {"debounce": 1.0}, {"Executor": {"threads": 4}}),
+]
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--events", type="int", default=100000)
+  parser.add_option("--keys", type="int", default=1000)
+  (options, args) = parser.parse_args()
+
+  for name, handler_options, extra_config in SCENARIOS:
+    config = make_config(options.keys, handler_options)
+    config.update(extra_config)
+
+    events = args[0] if args else replay.synthesize(config, options.events)
+
+    core.reset_handlers()
+    replay.add_handlers(config)
+    stats = replay.replay(events)
+
+    print("== %s" % name)
+    print(replay.format_stats(stats))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Compares crankd's SystemConfiguration dispatch with and without the index.
+
+Usage: crankd_sc_dispatch.py [--keys=N] [--rounds=N]
+
+Each simulated event is a network flap which changes --keys State:/Network
+keys. The configuration has 10, 100 and 1000 patterns, most of which are
+regular expressions for per-interface and per-service keys.
+"""
+
+import optparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+from PyMacAdmin.crankd import dispatch  # pylint: disable=C6204
+
+
+def make_patterns(count):
+  """Returns count patterns in the style of a generated crankd config."""
+  patterns = ["State:/Network/Global/IPv4", "State:/Network/Global/DNS"]
+  i = 0
+  while len(patterns) < count:
+    patterns.append("State:/Network/Interface/en%d/Link" % i)
+    patterns.append(r"State:/Network/Service/[0-9A-F-]+/IPv%d" % (i % 2 + 4))
+    patterns.append("State:/Network/Interface/utun%d/IPv[46]" % i)
+    patterns.append("Setup:/Network/Service/%08X/Proxies" % i)
+    i += 1
+  return dict((p, lambda **kwargs: None) for p in patterns[:count])
+
+
+def make_keys(count):
+  keys = list()
+  i = 0
+  while len(keys) < count:
+    keys.append("State:/Network/Interface/en%d/Link" % (i % 8))
+    keys.append("State:/Network/Service/%08X-1234/IPv4" % i)
+    keys.append("State:/Network/Interface/utun%d/IPv6" % (i % 4))
+    keys.append("State:/Network/Interface/en%d/AirPort" % (i % 8))
+    i += 1
+  return keys[:count]
+
+
+def legacy_handle_sc_event(handlers, changed_keys):
+  """The handle_sc_event implementation which predates SCDispatchIndex."""
+  try:
+    for key in changed_keys:
+      handlers[key](key=key, info=None)
+  except KeyError:
+    for key in changed_keys:
+      for handler in handlers:
+        if re.match(handler, key):
+          handlers[handler](key=key, info=None)
+
+
+def indexed_handle_sc_event(index, changed_keys):
+  for key in changed_keys:
+    for handler in index.lookup(key):
+      handler(key=key, info=None)
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--keys", type="int", default=200)
+  parser.add_option("--rounds", type="int", default=20)
+  (options, unused_args) = parser.parse_args()
+
+  keys = make_keys(options.keys)
+
+  print("%8s %14s %14s %14s %8s" % ("patterns", "legacy ms/evt", "cold ms/evt",
+                                    "warm ms/evt", "speedup"))
+  for count in (10, 100, 1000):
+    handlers = make_patterns(count)
+    rounds = max(1, options.rounds * 10 // count)
+
+    legacy = timeit.timeit(lambda: legacy_handle_sc_event(handlers, keys),
+                           number=rounds) / rounds
+
+    # A fresh index for every event measures the uncached path:
+    indexes = [dispatch.SCDispatchIndex(handlers) for _ in range(rounds)]
+    cold = timeit.timeit(
+        lambda: indexed_handle_sc_event(indexes.pop(), keys),
+        number=rounds) / rounds
+
+    index = dispatch.SCDispatchIndex(handlers)
+    warm = timeit.timeit(lambda: indexed_handle_sc_event(index, keys),
+                         number=rounds) / rounds
+
+    print("%8d %14.3f %14.3f %14.3f %7.1fx" % (count, legacy * 1000,
+                                               cold * 1000, warm * 1000,
+                                               legacy / warm))
+
+
+if __name__ == "__main__":
+  main()
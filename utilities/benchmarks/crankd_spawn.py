@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Compares command handler spawn rates with and without the crankd launcher.
+
+Usage: crankd_spawn.py [--commands=N] [--ballast=MB] [--user-info=N]
+
+Commands are run one at a time through core.do_shell, first by forking this
+process with subprocess and then using a launcher.Launcher helper. --ballast
+allocates and touches memory first to approximate the footprint of crankd
+with PyObjC loaded, to show whether forking a large process costs more.
+The launcher measures slower than subprocess, which uses vfork or
+posix_spawn where it can, so it isn't recommended for its speed.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+from PyMacAdmin.crankd import core  # pylint: disable=C6204
+from PyMacAdmin.crankd import launcher  # pylint: disable=C6204
+
+
+def spawn_rate(count, user_info):
+  start = time.monotonic()
+  for unused_i in range(count):
+    core.do_shell("true", context="benchmark", key="key", user_info=user_info)
+  return count / (time.monotonic() - start)
+
+
+def env_name_rate(user_info, rounds=10000):
+  start = time.monotonic()
+  for unused_i in range(rounds):
+    core.get_shell_env("benchmark", key="key", user_info=user_info)
+  return rounds / (time.monotonic() - start)
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--commands", type="int", default=500)
+  parser.add_option("--ballast", type="int", default=0, metavar="MB")
+  parser.add_option("--user-info", type="int", default=10, metavar="N",
+                    help="Number of user_info keys passed to each command")
+  (options, unused_args) = parser.parse_args()
+
+  ballast = bytearray(options.ballast * 1024 * 1024)
+  for i in range(0, len(ballast), 4096):
+    ballast[i] = 1
+
+  user_info = dict(("NSWorkspaceApplicationKey%d" % i, i)
+                   for i in range(options.user_info))
+
+  core.create_env_name.cache_clear()
+  print("environments/sec: %0.0f" % env_name_rate(user_info))
+
+  core.LAUNCHER = None
+  print("subprocess: %0.1f spawns/sec" %
+        spawn_rate(options.commands, user_info))
+
+  core.LAUNCHER = launcher.Launcher()
+  core.LAUNCHER.call("true")  # Don't count the helper's startup
+  print("launcher:   %0.1f spawns/sec" %
+        spawn_rate(options.commands, user_info))
+  core.LAUNCHER.close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Measures the overhead of PyMacAdmin.Security.Keychain per operation.
+
+Usage: keychain_overhead.py [--backend=standin|framework] [--items=N]
+
+Times each Keychain operation and the bare Security calls it makes, against
+the same backend, and reports both per operation and the wrapper's overhead
+as the difference. The stand-in (the default) runs anywhere; with
+--backend=framework the items are added to and then deleted from the login
+keychain under the service "PyMacAdmin benchmark".
+"""
+
+import ctypes
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "lib"))
+
+from PyMacAdmin import Security  # pylint: disable=C6204
+from PyMacAdmin.Security import Keychain  # pylint: disable=C6204
+from PyMacAdmin.Security.StandIn import StandInSecurity  # pylint: disable=C6204,C0301
+
+SERVICE = b"PyMacAdmin benchmark"
+
+
+def timed(func, count):
+  """Returns the mean seconds per call of func(i) for i in range(count)."""
+  start = time.perf_counter()
+  for i in range(count):
+    func(i)
+  return (time.perf_counter() - start) / count
+
+
+def account(i):
+  return b"account-%06d" % i
+
+
+def raw_add(i):
+  lib = Security.lib
+  item = ctypes.c_void_p()
+  lib.SecKeychainAddGenericPassword(None, len(SERVICE), SERVICE,
+                                    len(account(i)), account(i), 6, b"secret",
+                                    ctypes.pointer(item))
+  lib.CFRelease(item)
+
+
+def raw_find(i, with_password=False):
+  lib = Security.lib
+  item = ctypes.c_void_p()
+  length = ctypes.c_uint32(0)
+  data = ctypes.c_void_p()
+  lib.SecKeychainFindGenericPassword(
+      None, len(SERVICE), SERVICE, len(account(i)), account(i),
+      ctypes.pointer(length) if with_password else None,
+      ctypes.pointer(data) if with_password else None, ctypes.pointer(item))
+  if with_password:
+    ctypes.string_at(data, length.value)
+    lib.SecKeychainItemFreeContent(None, data)
+  return item
+
+
+def raw_delete(i):
+  item = raw_find(i)
+  Security.lib.SecKeychainItemDelete(item)
+  Security.lib.CFRelease(item)
+
+
+def raw_search(unused_i):
+  lib = Security.lib
+  tags = [Keychain.attribute_tag(t)
+          for unused_name, t in Keychain.GenericPassword.ATTRIBUTES]
+  query = Keychain.SecKeychainAttributeList.from_attributes(
+      [(Security.kSecServiceItemAttr.value, SERVICE)])
+  info = Keychain.SecKeychainAttributeInfo.from_tags(tags)
+  search = ctypes.c_void_p()
+  lib.SecKeychainSearchCreateFromAttributes(
+      None, ctypes.c_uint32(Security.kSecGenericPasswordItemClass.value),
+      ctypes.pointer(query), ctypes.pointer(search))
+  while True:
+    item = ctypes.c_void_p()
+    try:
+      lib.SecKeychainSearchCopyNext(search, ctypes.pointer(item))
+    except KeyError:
+      break
+    attrs = Keychain.SecKeychainAttributeList_p()
+    lib.SecKeychainItemCopyAttributesAndData(item, ctypes.pointer(info), None,
+                                             ctypes.pointer(attrs), None, None)
+    dict(attrs.contents)
+    lib.SecKeychainItemFreeAttributesAndData(attrs, None)
+  lib.CFRelease(search)
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--backend", choices=["standin", "framework"],
+                    default="standin")
+  parser.add_option("--items", type="int", default=500)
+  (options, unused_args) = parser.parse_args()
+
+  if options.backend == "standin":
+    Security.use_backend(StandInSecurity())
+  elif Security.lib is None:
+    parser.error("Security.framework is not available")
+
+  keychain = Keychain.Keychain()
+  service = SERVICE.decode()
+  n = options.items
+
+  def wrapped_add(i):
+    keychain.add(Keychain.GenericPassword(
+        service_name=service, account_name=account(i).decode(),
+        password="secret"))
+
+  def wrapped_find(i):
+    keychain.find_generic_password(service, account(i).decode())
+
+  def wrapped_find_password(i):
+    keychain.find_generic_password(service, account(i).decode()).password
+
+  def wrapped_search(unused_i):
+    list(keychain.search(service_name=service))
+
+  def wrapped_delete(i):
+    keychain.find_generic_password(service, account(i).decode()).delete()
+
+  bare_add = timed(raw_add, n)
+  find = (timed(raw_find, n), timed(wrapped_find, n))
+  find_password = (timed(lambda i: raw_find(i, with_password=True), n),
+                   timed(wrapped_find_password, n))
+  # Per item found by the search:
+  search = (timed(raw_search, 5) / n, timed(wrapped_search, 5) / n)
+  bare_delete = timed(raw_delete, n)
+  # The items are gone, so they can be added and deleted again:
+  add = (bare_add, timed(wrapped_add, n))
+  delete = (bare_delete, timed(wrapped_delete, n))
+
+  results = [("add",) + add, ("find",) + find,
+             ("find + password",) + find_password,
+             ("search (per item)",) + search, ("delete",) + delete]
+
+  print("%d items, %s backend" % (n, options.backend))
+  print("%-20s %12s %12s %12s" % ("operation", "bare us", "Keychain us",
+                                  "overhead us"))
+  for name, bare, wrapped in results:
+    print("%-20s %12.1f %12.1f %12.1f" % (name, bare * 1e6, wrapped * 1e6,
+                                          (wrapped - bare) * 1e6))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Compares pymacds query backends and per-attribute versus batch lookups.
+
+Usage: pymacds_queries.py [--users=N] [--attributes=N] [--dscl=PATH]
+
+Reads N attributes of each of N users, once with UserAttribute per user and
+attribute and once with a single UserAttributes call, against:
+
+  plist:   a PlistBackend over generated records
+  dscl:    a DsclBackend; with --dscl=/usr/bin/dscl on Mac OS X the users
+           must exist locally, otherwise a shell script that prints the
+           generated records stands in for dscl, which measures the process
+           spawns
+  session: a DsclSessionBackend, with one interactive dscl or, without
+           --dscl, the stand-in for it from pymacds' tests
+"""
+
+import optparse
+import os
+import plistlib
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+PYMACDS_DIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "..", "pymacds-dist")
+sys.path.insert(0, PYMACDS_DIST)
+
+import pymacds  # pylint: disable=C6204
+
+ATTRIBUTES = ["RealName", "UniqueID", "PrimaryGroupID", "NFSHomeDirectory",
+              "UserShell", "GeneratedUID", "AuthenticationAuthority",
+              "Comment", "Picture", "Password", "PasswordPolicyOptions",
+              "dsAttrTypeNative:_writers_passwd"]
+
+
+def make_records(root, users):
+  """Writes user records for PlistBackend and a fake dscl script."""
+  os.makedirs(os.path.join(root, "Users"))
+  records = []
+  for i, name in enumerate(users):
+    record = dict(("dsAttrTypeStandard:%s" % a if ":" not in a else a,
+                   ["%s-%d" % (a, i)]) for a in ATTRIBUTES)
+    record["dsAttrTypeStandard:RecordName"] = [name]
+    records.append(record)
+    with open(os.path.join(root, "Users", name + ".plist"), "wb") as f:
+      plistlib.dump(record, f)
+  all_records = os.path.join(root, "all.plist")
+  with open(all_records, "wb") as f:
+    plistlib.dump(records, f)
+
+  dscl = os.path.join(root, "dscl")
+  with open(dscl, "w") as f:
+    f.write("#!/bin/sh\n"
+            "case \"$*\" in\n"
+            "  *-readall*) cat %s ;;\n"
+            "  *) cat %s/Users/$(basename \"$4\").plist ;;\n"
+            "esac\n" % (all_records, root))
+  os.chmod(dscl, stat.S_IRWXU)
+  return dscl
+
+
+def timed(func):
+  start = time.perf_counter()
+  func()
+  return time.perf_counter() - start
+
+
+def main():
+  parser = optparse.OptionParser(__doc__.strip())
+  parser.add_option("--users", type="int", default=20)
+  parser.add_option("--attributes", type="int", default=len(ATTRIBUTES))
+  parser.add_option("--dscl", default=None)
+  (options, unused_args) = parser.parse_args()
+
+  users = ["user%03d" % i for i in range(options.users)]
+  attributes = ATTRIBUTES[:options.attributes]
+  root = tempfile.mkdtemp()
+  try:
+    fake_dscl = make_records(root, users)
+    if options.dscl:
+      session = pymacds.DsclSession([options.dscl, "-plist"])
+    else:
+      session = pymacds.DsclSession([
+          sys.executable,
+          os.path.join(PYMACDS_DIST, "pymacds", "tests", "dscl_standin.py"),
+          root])
+    backends = [("plist", pymacds.PlistBackend(root)),
+                ("dscl", pymacds.DsclBackend(dscl=options.dscl or fake_dscl)),
+                ("session", pymacds.DsclSessionBackend(session))]
+
+    print("%d users x %d attributes, dscl=%s" % (
+        len(users), len(attributes), options.dscl or "simulated"))
+    print("%-8s %14s %14s %9s" % ("backend", "per-attr ms", "batch ms",
+                                  "speedup"))
+    for name, backend in backends:
+      pymacds.SetQueryBackend(backend)
+      each = timed(lambda: [pymacds.UserAttribute(u, a)
+                            for u in users for a in attributes])
+      batch = timed(lambda: pymacds.UserAttributes(users, attributes))
+      print("%-8s %14.1f %14.1f %8.1fx" % (name, each * 1e3, batch * 1e3,
+                                           each / batch))
+    session.Close()
+  finally:
+    shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+  main()